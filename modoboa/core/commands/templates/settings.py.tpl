@@ -36,6 +36,18 @@ DATABASES = { {{ default_conn|safe }}
 
 DATABASE_ROUTERS = ["modoboa.extensions.amavis.dbrouter.AmavisRouter"]
 
+# Modoboa keeps parameters and the state of extensions in memory and
+# uses the cache to notify other processes when they change. With the
+# default backend (local to each process), they are loaded again by
+# each request. If Modoboa runs inside several processes, use a shared
+# backend instead, for example:
+# CACHES = {
+#     "default": {
+#         "BACKEND": "django.core.cache.backends.memcached.MemcachedCache",
+#         "LOCATION": "127.0.0.1:11211",
+#     }
+# }
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
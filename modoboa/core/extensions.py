@@ -1,5 +1,15 @@
 from django.conf import settings
 from django.conf.urls import include
+from modoboa.lib.cacheutils import ProcessCache
+
+# The state of extensions is kept by each process (see cacheutils)
+version_key = "extensions:version"
+
+
+def _load_states():
+    from modoboa.core.models import Extension
+
+    return dict(Extension.objects.values_list("name", "enabled"))
 
 
 class ModoExtension(object):
@@ -38,6 +48,7 @@ class ExtensionsPool(object):
 
     def __init__(self):
         self.extensions = dict()
+        self.states = ProcessCache(version_key, _load_states)
 
     def register_extension(self, ext, show=True):
         self.extensions[ext.name] = dict(cls=ext, show=show)
@@ -55,21 +66,41 @@ class ExtensionsPool(object):
             return None
         return instance.infos()
 
-    def load_all(self):
-        from modoboa.core.models import Extension
+    def get_states(self):
+        """Return the state of extensions stored in the database
+
+        :return: a dictionary (name => enabled)
+        """
+        return self.states.get()
 
+    def is_enabled(self, name):
+        """Tell if an extension is enabled
+
+        Extensions unknown to the database are enabled only if they
+        are always active.
+
+        :param name: the extension's name
+        :return: a boolean
+        """
+        states = self.get_states()
+        if name in states:
+            return states[name]
+        extinstance = self.get_extension(name)
+        return extinstance is not None and extinstance.always_active
+
+    def invalidate(self):
+        """Must be called each time an extension is modified"""
+        self.states.invalidate()
+
+    def load_all(self):
         for ext in settings.MODOBOA_APPS:
             __import__(ext)
         result = []
         for extname in self.extensions.keys():
             extinstance = self.get_extension(extname)
-            if not extinstance.always_active:
-                try:
-                    ext = Extension.objects.get(name=extname)
-                    if not ext.enabled:
-                        continue
-                except Extension.DoesNotExist:
-                    continue
+            if not extinstance.always_active \
+                    and not self.get_states().get(extname, False):
+                continue
             extinstance.load()
             try:
                 baseurl = extinstance.url if extinstance.url is not None else extname
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from modoboa.lib import events
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Display statistics about events dispatch'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sort',
+                    type='choice',
+                    choices=['calls', 'total', 'max', 'queries'],
+                    default='total',
+                    help='Sort events and callbacks by calls, total, '
+                    'max or queries (default: total)'),
+        make_option('--reset',
+                    action='store_true',
+                    default=False,
+                    help='Forget collected statistics')
+    )
+
+    def handle(self, *args, **options):
+        if options["reset"]:
+            events.reset_stats()
+            return
+        stats = events.get_stats()
+        if not stats:
+            if not events.is_profiling():
+                raise CommandError(
+                    "No statistics available, set MODOBOA_EVENTS_PROFILING "
+                    "to True inside settings.py to collect them"
+                )
+            print "No statistics available"
+            return
+        print "%-50s %8s %10s %10s %8s" % (
+            "Event / callback", "Calls", "Total (ms)", "Max (ms)", "Queries"
+        )
+        for event, entry, cbstats in events.group_stats(stats, options["sort"]):
+            for name, values, indent in \
+                    [(event, entry, "")] + [(n, v, "  ") for n, v in cbstats]:
+                print "%-50s %8d %10.1f %10.1f %8d" % (
+                    (indent + name)[:50], values["calls"],
+                    values["total"] * 1000, values["max"] * 1000,
+                    values["queries"]
+                )
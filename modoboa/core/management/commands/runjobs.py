@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+import datetime
+import sys
+import time
+import traceback
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from modoboa.core import load_settings
+from modoboa.core.extensions import exts_pool
+from modoboa.lib.models import EventJob
+
+
+def get_callback(fullname):
+    """Return the function called by a job
+
+    The extension of the callback may have been disabled since the
+    job was queued: the job must then be dropped.
+
+    :param fullname: the callback's module and name
+    :return: a function, or None if its extension is disabled
+    """
+    modname, name = fullname.rsplit(".", 1)
+    __import__(modname)
+    callback = getattr(sys.modules[modname], name)
+    if hasattr(callback, "is_enabled") and not callback.is_enabled():
+        return None
+    return getattr(callback, "original", callback)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Run event callbacks deferred to the job queue'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    default=False,
+                    help='Wait for new jobs instead of exiting'),
+        make_option('--interval',
+                    type='int',
+                    default=5,
+                    help='Delay between two checks of the queue (in seconds, '
+                    'with --loop, default: 5)'),
+        make_option('--max-attempts',
+                    type='int',
+                    default=5,
+                    help='Number of attempts before a job is given up '
+                    '(default: 5)'),
+        make_option('--retry-failed',
+                    action='store_true',
+                    default=False,
+                    help='Try again the jobs that were given up'),
+        make_option('--verbose',
+                    action='store_true',
+                    default=False,
+                    help='Display informational messages')
+    )
+
+    # Delay before the first retry of a failed job (doubled after each
+    # failure)
+    retry_delay = 60
+    verbose = False
+
+    def __vprint(self, msg):
+        if not self.verbose:
+            return
+        print msg
+
+    def run_job(self, job):
+        """Run a job and delete it, in the same transaction
+
+        :return: True on success
+        """
+        try:
+            with transaction.commit_on_success():
+                callback = get_callback(job.callback)
+                if callback is not None:
+                    args, kwargs = job.get_arguments()
+                    callback(*args, **kwargs)
+                job.delete()
+        except Exception:
+            job.attempts += 1
+            job.last_error = traceback.format_exc()
+            job.next_try = timezone.now() + datetime.timedelta(
+                seconds=self.retry_delay * 2 ** (job.attempts - 1)
+            )
+            job.save()
+            return False
+        return True
+
+    def run_jobs(self, max_attempts=5):
+        """Run pending jobs
+
+        Jobs are run in creation order. When a job fails or must wait,
+        the following jobs of the same object wait too.
+
+        :param max_attempts: number of attempts before a job is given up
+        :return: a tuple (number of jobs done, number of failures)
+        """
+        done = failed = 0
+        blocked = set()
+        now = timezone.now()
+        for job in EventJob.objects.order_by("id"):
+            if job.key in blocked:
+                continue
+            if job.attempts >= max_attempts or job.next_try > now:
+                blocked.add(job.key)
+                continue
+            if self.run_job(job):
+                done += 1
+                continue
+            failed += 1
+            blocked.add(job.key)
+            self.__vprint("Job %d (%s) failed:\n%s" % (
+                job.id, job.callback, job.last_error
+            ))
+        return done, failed
+
+    def handle(self, *args, **options):
+        self.verbose = options["verbose"]
+        load_settings()
+        exts_pool.load_all()
+        if options["retry_failed"]:
+            EventJob.objects.filter(attempts__gte=options["max_attempts"]) \
+                .update(attempts=0, next_try=timezone.now())
+        while True:
+            done, failed = self.run_jobs(options["max_attempts"])
+            if done or failed:
+                self.__vprint("%d jobs done, %d failed" % (done, failed))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+        given_up = EventJob.objects.filter(
+            attempts__gte=options["max_attempts"]
+        ).count()
+        if given_up:
+            print "%d jobs were given up, fix the problem and use " \
+                "--retry-failed" % given_up
@@ -7,6 +7,7 @@ import base64
 from random import Random
 import reversion
 from django.db import models
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext as _, ugettext_lazy
@@ -46,6 +47,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(default=True)
     date_joined = models.DateTimeField(default=timezone.now)
     is_local = models.BooleanField(default=True)
+    owners = generic.GenericRelation("ObjectAccess", related_name="+")
 
     objects = UserManager()
 
@@ -368,16 +370,42 @@ def populate_callback(user):
 
     :param user: a ``User`` instance
     """
-    from modoboa.lib.permissions import grant_access_to_object
-
     sadmins = User.objects.filter(is_superuser=True)
     user.set_role("SimpleUsers")
+    # Other super administrators are granted access too
     user.post_create(sadmins[0])
-    for su in sadmins[1:]:
-        grant_access_to_object(su, user)
     events.raiseEvent("AccountAutoCreated", user)
 
 
+@receiver(post_init, sender=User)
+def user_loaded_handler(sender, instance, **kwargs):
+    """``User`` post_init signal receiver
+
+    Remember if the account was a super administrator (None if the
+    field is deferred).
+    """
+    instance._was_superuser = instance.__dict__.get("is_superuser")
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed_handler(sender, instance, **kwargs):
+    """``User`` post_save and post_delete signals receiver
+
+    The list of super administrators cached by the permissions module
+    is outdated if a super administrator is created or deleted, or if
+    an account gains or loses this role.
+    """
+    if kwargs.get("created", False) or "created" not in kwargs:
+        changed = instance.is_superuser
+    else:
+        changed = instance.is_superuser != instance._was_superuser
+    instance._was_superuser = instance.is_superuser
+    if changed:
+        from modoboa.lib.permissions import invalidate_superuser_ids
+        invalidate_superuser_ids()
+
+
 class ObjectAccess(models.Model):
     user = models.ForeignKey(User)
     content_type = models.ForeignKey(ContentType)
@@ -387,6 +415,7 @@ class ObjectAccess(models.Model):
 
     class Meta:
         unique_together = (("user", "content_type", "object_id"),)
+        index_together = [["content_type", "object_id"]]
 
     def __unicode__(self):
         return "%s => %s (%s)" % (self.user, self.content_object, self.content_type)
@@ -405,6 +434,10 @@ class Extension(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super(Extension, self).save(*args, **kwargs)
+        exts_pool.invalidate()
+
     def __get_ext_instance(self):
         if not self.name:
             return None
@@ -91,6 +91,11 @@ def admin_menu(selection, user):
          "img": "",
          "label": _("Parameters")},
     ]
+    if events.is_profiling():
+        entries.insert(3, {"name": "events",
+                           "class": "ajaxlink",
+                           "url": "events/",
+                           "label": _("Events")})
     return render_to_string('common/menu.html', {
         "entries": entries,
         "css": "nav nav-list",
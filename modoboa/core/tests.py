@@ -1,6 +1,11 @@
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
 from modoboa.lib.tests import ModoTestCase
 from . import factories
+from .extensions import exts_pool, version_key
+from .models import Extension
 
 
 class ProfileTestCase(ModoTestCase):
@@ -40,3 +45,58 @@ class ProfileTestCase(ModoTestCase):
         self.assertEqual(
             self.clt.login(username="user@test.com", password="tutu"), True
         )
+
+
+class ExtensionsPoolTestCase(TestCase):
+
+    def setUp(self):
+        exts_pool.invalidate()
+        self.ext = Extension.objects.create(name="amavis", enabled=False)
+
+    @override_settings(MODOBOA_SHARED_CACHE=True)
+    def test_cached_states(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(exts_pool.is_enabled("amavis"))
+            self.assertFalse(exts_pool.is_enabled("unknown"))
+            self.assertFalse(exts_pool.is_enabled("amavis"))
+        self.ext.enabled = True
+        self.ext.save()
+        self.assertTrue(exts_pool.is_enabled("amavis"))
+        # Another process modified an extension
+        Extension.objects.filter(name="amavis").update(enabled=False)
+        cache.set(version_key, "other")
+        with self.assertNumQueries(1):
+            self.assertFalse(exts_pool.is_enabled("amavis"))
+
+    @override_settings(MODOBOA_SHARED_CACHE=False)
+    def test_local_cache(self):
+        from modoboa.lib import cacheutils
+
+        cacheutils._start_request()
+        try:
+            with self.assertNumQueries(1):
+                self.assertFalse(exts_pool.is_enabled("amavis"))
+                self.assertFalse(exts_pool.is_enabled("amavis"))
+        finally:
+            cacheutils._finish_request()
+        # Another process enabled the extension
+        Extension.objects.filter(name="amavis").update(enabled=True)
+        cacheutils._start_request()
+        try:
+            self.assertTrue(exts_pool.is_enabled("amavis"))
+        finally:
+            cacheutils._finish_request()
+
+
+@override_settings(MODOBOA_EVENTS_PROFILING=True)
+class EventStatsTestCase(ModoTestCase):
+    fixtures = ['initial_users.json']
+
+    def test_view(self):
+        self.clt.get(reverse("modoboa.core.views.admin.viewsettings"))
+        response = self.clt.get(
+            reverse("modoboa.core.views.admin.eventstats"),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("AdminMenuDisplay", response.content)
@@ -4,7 +4,7 @@ from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import (
     login_required, user_passes_test
 )
-from modoboa.lib import parameters
+from modoboa.lib import parameters, events
 from modoboa.lib.webutils import (
     ajax_simple_response, _render_to_string
 )
@@ -105,6 +105,21 @@ def information(request, tplname="core/information.html"):
     })
 
 
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def eventstats(request, tplname="core/eventstats.html"):
+    order = request.GET.get("sort_order", "total").lstrip("-")
+    if not order in ["calls", "total", "max", "queries"]:
+        order = "total"
+    return ajax_simple_response({
+        "status": "ok",
+        "content": render_to_string(tplname, {
+            "profiling": events.is_profiling(),
+            "stats": events.group_stats(events.get_stats(), order)
+        })
+    })
+
+
 @login_required
 @user_passes_test(lambda u: u.is_superuser)
 def logs(request, tplname="core/logs.html"):
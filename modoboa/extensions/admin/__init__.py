@@ -93,6 +93,7 @@ def user_menu(target, user):
     ]
 
 
+# Not deferred: the role could change again before the job runs
 @events.observe("RoleChanged")
 def grant_access_to_all_objects(user, role):
     from django.contrib.contenttypes.models import ContentType
@@ -160,8 +161,8 @@ def import_account_mailbox(user, account, row):
 @events.observe("AccountAutoCreated")
 def account_auto_created(user):
     from modoboa.core.models import User
-    from modoboa.lib.permissions import grant_access_to_object
 
+    # Other super administrators are granted access by post_create
     sadmins = User.objects.filter(is_superuser=True)
     localpart, domname = split_mailbox(user.username)
     try:
@@ -169,8 +170,6 @@ def account_auto_created(user):
     except Domain.DoesNotExist:
         domain = Domain(name=domname, enabled=True, quota=0)
         domain.save(creator=sadmins[0])
-        for su in sadmins[1:]:
-            grant_access_to_object(su, domain)
     try:
         mb = Mailbox.objects.get(domain=domain, address=localpart)
     except Mailbox.DoesNotExist:
@@ -179,8 +178,6 @@ def account_auto_created(user):
         )
         mb.set_quota(override_rules=True)
         mb.save(creator=sadmins[0])
-        for su in sadmins[1:]:
-            grant_access_to_object(su, mb)
 
 
 @events.observe("UserLogin")
@@ -2,7 +2,6 @@
 from functools import wraps
 from django.db.models import Q
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.contrib.contenttypes.models import ContentType
 from modoboa.core.models import User
 from modoboa.lib import parameters
 from modoboa.lib.exceptions import ModoboaException
@@ -69,10 +68,7 @@ def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
 
     accounts = []
     if idtfilter is None or not idtfilter or idtfilter == "account":
-        ids = user.objectaccess_set \
-            .filter(content_type=ContentType.objects.get_for_model(user)) \
-            .values_list('object_id', flat=True)
-        q = Q(pk__in=ids)
+        q = Q() if user.is_superuser else Q(owners__user=user)
         if searchquery is not None:
             q &= Q(username__icontains=searchquery) \
                 | Q(email__icontains=searchquery)
@@ -86,10 +82,7 @@ def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
     aliases = []
     if idtfilter is None or not idtfilter \
             or (idtfilter in ["alias", "forward", "dlist"]):
-        alct = ContentType.objects.get_for_model(Alias)
-        ids = user.objectaccess_set.filter(content_type=alct) \
-            .values_list('object_id', flat=True)
-        q = Q(pk__in=ids)
+        q = Q() if user.is_superuser else Q(owners__user=user)
         if searchquery is not None:
             if '@' in searchquery:
                 local_part, domname = split_mailbox(searchquery)
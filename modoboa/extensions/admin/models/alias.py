@@ -1,9 +1,11 @@
 import reversion
 from django.db import models
+from django.contrib.contenttypes import generic
 from django.utils.translation import ugettext as _, ugettext_lazy
 from modoboa.lib import events
 from modoboa.lib.emailutils import split_mailbox
 from modoboa.lib.exceptions import PermDeniedException
+from modoboa.core.models import ObjectAccess
 from modoboa.extensions.admin.exceptions import AdminError
 from .base import DatesAware
 from .domain import Domain
@@ -29,6 +31,7 @@ class Alias(DatesAware):
         ugettext_lazy('enabled'),
         help_text=ugettext_lazy("Check to activate this alias")
     )
+    owners = generic.GenericRelation(ObjectAccess)
 
     class Meta:
         permissions = (
@@ -79,12 +82,12 @@ class Alias(DatesAware):
         return [{"name": altype, "label": labels[altype], "type": "idt"}]
 
     def post_create(self, creator):
-        from modoboa.lib.permissions import grant_access_to_object
+        from modoboa.lib.permissions import \
+            grant_access_to_object, grant_access_to_users
         grant_access_to_object(creator, self, is_owner=True)
         events.raiseEvent("MailboxAliasCreated", creator, self)
         if creator.is_superuser:
-            for admin in self.domain.admins:
-                grant_access_to_object(admin, self)
+            grant_access_to_users(self.domain.admins, self)
 
     def save(self, *args, **kwargs):
         if 'ext_rcpts' in kwargs:
@@ -4,13 +4,13 @@ import reversion
 from django.db import models
 from django.db.models import Q
 from django.db.models.manager import Manager
-from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes import generic
 from django.utils.translation import ugettext as _, ugettext_lazy
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from modoboa.lib import parameters, events
 from modoboa.lib.sysutils import exec_cmd
-from modoboa.core.models import User
+from modoboa.core.models import User, ObjectAccess
 from modoboa.extensions.admin.exceptions import AdminError
 from .base import DatesAware
 from .domain import Domain
@@ -36,14 +36,12 @@ class MailboxManager(Manager):
                 qf = Q(address__contains=addrfilter) & Q(domain__name__contains=domfilter)
             else:
                 qf = Q(address__contains=squery) | Q(domain__name__contains=squery)
-        ids = admin.objectaccess_set \
-            .filter(content_type=ContentType.objects.get_for_model(Mailbox)) \
-            .values_list('object_id', flat=True)
+        qs = self.get_query_set()
+        if not admin.is_superuser:
+            qs = qs.filter(owners__user=admin)
         if qf is not None:
-            qf = Q(pk__in=ids) & qf
-        else:
-            qf = Q(pk__in=ids)
-        return self.get_query_set().filter(qf)
+            qs = qs.filter(qf)
+        return qs
 
 
 class Mailbox(DatesAware):
@@ -55,6 +53,7 @@ class Mailbox(DatesAware):
     use_domain_quota = models.BooleanField(default=False)
     domain = models.ForeignKey(Domain)
     user = models.ForeignKey(User)
+    owners = generic.GenericRelation(ObjectAccess)
 
     objects = MailboxManager()
 
@@ -185,7 +184,8 @@ class Mailbox(DatesAware):
         return int(q.bytes / float(self.quota * 1048576) * 100)
 
     def post_create(self, creator):
-        from modoboa.lib.permissions import grant_access_to_object
+        from modoboa.lib.permissions import \
+            grant_access_to_object, grant_access_to_users
         grant_access_to_object(creator, self, True)
         events.raiseEvent("CreateMailbox", creator, self)
         if creator.is_superuser and not self.user.has_perm("admin.add_domain"):
@@ -194,9 +194,9 @@ class Mailbox(DatesAware):
             # account) to the appropriate domain admins,
             # except if the new account has a more important
             # role (SuperAdmin, Reseller)
-            for admin in self.domain.admins:
-                grant_access_to_object(admin, self)
-                grant_access_to_object(admin, self.user)
+            admins = self.domain.admins
+            grant_access_to_users(admins, self)
+            grant_access_to_users(admins, self.user)
 
     def save(self, *args, **kwargs):
         if "creator" in kwargs:
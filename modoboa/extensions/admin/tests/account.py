@@ -1,4 +1,5 @@
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
 from modoboa.core.models import User
 from modoboa.lib.tests import ModoTestCase
 from modoboa.extensions.admin.models import (
@@ -125,6 +126,15 @@ class PermissionsTestCase(ModoTestCase):
         )
         self.assertEqual(User.objects.get(username="user@test.com").is_superuser, False)
 
+    def test_superusers_async_events(self):
+        from modoboa.lib.models import EventJob
+
+        with self.settings(MODOBOA_ASYNC_EVENTS=True):
+            self.user.set_role("SuperAdmins")
+        # Access is granted at once, not by a job
+        self.assertEqual(EventJob.objects.count(), 0)
+        self.assertTrue(self.user.can_access(Domain.objects.all()[0]))
+
     def test_self_modif(self):
         self.clt.logout()
         self.assertEqual(self.clt.login(username="admin@test.com", password="toto"),
@@ -211,3 +221,121 @@ class PermissionsTestCase(ModoTestCase):
         self.check_ajax_post(
             reverse("modoboa.extensions.admin.views.alias.newdlist"), values
         )
+
+    @override_settings(MODOBOA_SHARED_CACHE=True)
+    def test_superadmins_access(self):
+        from django.contrib.contenttypes.models import ContentType
+        from modoboa.core.models import ObjectAccess
+        from modoboa.lib.permissions import (
+            get_superuser_ids, grant_access_to_object
+        )
+
+        admin = User.objects.get(username="admin")
+        sadmin = User.objects.create(username="sadmin", is_superuser=True)
+        self.assertEqual(sorted(get_superuser_ids()), [admin.id, sadmin.id])
+
+        account = User.objects.create(username="tester@test.com")
+        ContentType.objects.get_for_model(account)
+        get_superuser_ids()
+        with self.assertNumQueries(3):
+            grant_access_to_object(admin, account, is_owner=True)
+        self.assertTrue(
+            ObjectAccess.objects.get(user=admin, object_id=account.id,
+                                     content_type__model="user").is_owner
+        )
+        self.assertTrue(ObjectAccess.objects.filter(
+            user=sadmin, object_id=account.id, content_type__model="user"
+        ).exists())
+
+        # Granting again only updates the owner flag
+        grant_access_to_object(admin, account)
+        self.assertEqual(ObjectAccess.objects.filter(
+            object_id=account.id, content_type__model="user",
+            is_owner=True
+        ).count(), 0)
+
+        sadmin.delete(admin)
+        self.assertEqual(get_superuser_ids(), [admin.id])
+
+    @override_settings(MODOBOA_SHARED_CACHE=True)
+    def test_superuser_ids_invalidation(self):
+        from modoboa.lib.permissions import get_superuser_ids
+
+        admin = User.objects.get(username="admin")
+        get_superuser_ids()
+        # Saving an account without changing its role (a login for
+        # example) keeps the list
+        admin.save()
+        self.user.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_superuser_ids(), [admin.id])
+
+        self.user.set_role("SuperAdmins")
+        self.assertEqual(sorted(get_superuser_ids()),
+                         [admin.id, self.user.id])
+        self.user = User.objects.get(pk=self.user.pk)
+        self.user.set_role("SimpleUsers")
+        self.assertEqual(get_superuser_ids(), [admin.id])
+
+    def test_superuser_ids_local_cache(self):
+        from modoboa.lib import cacheutils
+        from modoboa.lib.permissions import get_superuser_ids
+
+        admin = User.objects.get(username="admin")
+        cacheutils._start_request()
+        try:
+            get_superuser_ids()
+            with self.assertNumQueries(0):
+                get_superuser_ids()
+            # Another process changed the role: the list is only kept
+            # until the end of the request
+            User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        finally:
+            cacheutils._finish_request()
+        self.assertEqual(sorted(get_superuser_ids()),
+                         [admin.id, self.user.id])
+
+    def test_concurrent_grants(self):
+        from django.contrib.contenttypes.models import ContentType
+        from modoboa.core.models import ObjectAccess
+        from modoboa.lib.permissions import _create_accesses
+
+        admin = User.objects.get(username="admin")
+        ct = ContentType.objects.get_for_model(Domain)
+        domains = list(Domain.objects.all())
+        # Another process granted access to the first domain
+        ObjectAccess.objects.filter(user=admin, content_type=ct).delete()
+        ObjectAccess.objects.create(
+            user=admin, content_type=ct, object_id=domains[0].id
+        )
+        _create_accesses([
+            ObjectAccess(user=admin, content_type=ct, object_id=dom.id)
+            for dom in domains
+        ])
+        self.assertEqual(
+            ObjectAccess.objects.filter(user=admin, content_type=ct).count(),
+            len(domains)
+        )
+
+    def test_get_for_admin(self):
+        from modoboa.extensions.admin.lib import get_identities
+
+        dadmin = User.objects.get(username="admin@test.com")
+        self.assertEqual(
+            sorted(mb.full_address
+                   for mb in Mailbox.objects.get_for_admin(dadmin)),
+            ["admin@test.com", "user@test.com"]
+        )
+        self.assertEqual(
+            [mb.full_address
+             for mb in Mailbox.objects.get_for_admin(dadmin, "user")],
+            ["user@test.com"]
+        )
+        sadmin = User.objects.get(username="admin")
+        self.assertEqual(Mailbox.objects.get_for_admin(sadmin).count(), 4)
+
+        identities = [
+            idt.username for idt in get_identities(dadmin, idtfilter="account")
+        ]
+        self.assertEqual(sorted(identities),
+                         ["admin@test.com", "user@test.com"])
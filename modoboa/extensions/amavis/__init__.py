@@ -11,7 +11,7 @@ Provides:
 from django.utils.translation import ugettext as _, ugettext_lazy
 from django.core.urlresolvers import reverse
 from django.template import Template, Context
-from modoboa.lib import events, parameters
+from modoboa.lib import events, parameters, cacheutils
 from modoboa.core.extensions import ModoExtension, exts_pool
 
 
@@ -62,7 +62,7 @@ def menu(target, user):
     return []
 
 
-@events.observe("CreateDomain")
+@events.observe("CreateDomain", async=True)
 def on_create_domain(user, domain):
     from .models import Users, Policy
     p = Policy.objects.create(policy_name=domain.name)
@@ -70,7 +70,7 @@ def on_create_domain(user, domain):
                          priority=7, policy=p)
 
 
-@events.observe("DomainModified")
+@events.observe("DomainModified", async=True)
 def on_domain_modified(domain):
     if domain.oldname != domain.name:
         from .models import Users
@@ -82,7 +82,7 @@ def on_domain_modified(domain):
         u.save()
 
 
-@events.observe("DeleteDomain")
+@events.observe("DeleteDomain", async=True)
 def on_delete_domain(domain):
     from .models import Users
 
@@ -96,23 +96,40 @@ def on_delete_domain(domain):
 
 @events.observe("GetStaticContent")
 def extra_static_content(user):
+    from .lib import get_requests_version
+
     if user.group == "SimpleUsers":
         return []
 
+    # With a cache local to each process, versions differ between
+    # processes: the number of requests is polled directly
+    shared = cacheutils.is_shared()
     tpl = Template("""<script type="text/javascript">
 $(document).ready(function() {
-    {% if user_can_release == "no" %}var poller = new Poller("{{ url }}", {
+    {% if user_can_release == "no" %}var display_requests = function(data) {
+        var $link = $("#nbrequests");
+        if (data.requests > 0) {
+            $link.html(data.requests + " " + "{{ text }}");
+            $link.parent().removeClass('hidden');
+        } else {
+            $link.parent().addClass('hidden');
+        }
+    };
+    {% if shared %}var version = "{{ version }}";
+    var poller = new Poller("{{ version_url }}", {
         interval: {{ interval }},
         success_cb: function(data) {
-            var $link = $("#nbrequests");
-            if (data.requests > 0) {
-                $link.html(data.requests + " " + "{{ text }}");
-                $link.parent().removeClass('hidden');
-            } else {
-                $link.parent().addClass('hidden');
+            if (data.version == version) {
+                return;
             }
+            version = data.version;
+            $.ajax({url: "{{ url }}", dataType: "json"})
+                .done(display_requests);
         }
-    });{% endif %}
+    });{% else %}var poller = new Poller("{{ url }}", {
+        interval: {{ interval }},
+        success_cb: display_requests
+    });{% endif %}{% endif %}
 
     $(document).bind('domform_init', function() {
         activate_widget.call($('#id_spam_subject_tag2_act'));
@@ -123,6 +140,11 @@ $(document).ready(function() {
     return [tpl.render(
         Context(dict(
             url=reverse("modoboa.extensions.amavis.views.nbrequests"),
+            shared=shared,
+            version_url=reverse(
+                "modoboa.extensions.amavis.views.requests_version"
+            ),
+            version=get_requests_version() if shared else None,
             interval=int(parameters.get_admin("CHECK_REQUESTS_INTERVAL")) * 1000,
             text=_("pending requests"),
             user_can_release=parameters.get_admin("USER_CAN_RELEASE")
@@ -132,12 +154,12 @@ $(document).ready(function() {
 
 @events.observe("TopNotifications")
 def display_requests(user):
-    from .sql_listing import get_wrapper
+    from .lib import get_pending_requests
 
     if parameters.get_admin("USER_CAN_RELEASE") == "yes" \
             or user.group == "SimpleUsers":
         return []
-    nbrequests = get_wrapper().get_pending_requests(user)
+    nbrequests = get_pending_requests(user)
 
     url = reverse("modoboa.extensions.amavis.views.index")
     url += "#listing/?viewrequests=1"
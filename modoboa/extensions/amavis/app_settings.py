@@ -16,6 +16,15 @@ class ParametersForm(AdminParametersForm):
         help_text=_("Quarantine messages maximum age (in days) before deletion")
     )
 
+    search_index = YesNoField(
+        label=_("Use search index"),
+        initial="no",
+        help_text=_("Search messages using the index maintained by the "
+                    "qindex command. Each searched word must match the "
+                    "beginning of a word, and messages are not found "
+                    "until qindex has indexed them")
+    )
+
     sep1 = SeparatorField(label=_("Messages releasing"))
                           
     released_msgs_cleanup = YesNoField(
@@ -1,12 +1,17 @@
 # coding: utf-8
 import socket
 import re
+import itertools
 import struct
 import string
+import threading
 from functools import wraps
+from email.feedparser import FeedParser
+from email.parser import Parser
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
-from modoboa.lib import parameters
+from modoboa.lib import parameters, cacheutils
 from modoboa.lib.exceptions import ModoboaException
 
 
@@ -36,23 +41,182 @@ def selfservice(ssfunc=None):
     return decorator
 
 
+# Pending release requests are counted once per administrator and per
+# version of the quarantine. The version changes each time a request
+# is made or processed by Modoboa; the timeout bounds the staleness of
+# counters when the quarantine is modified by something else.
+requests_version_key = "amavis:requests_version"
+pending_requests_key = "amavis:pending_requests:%d"
+pending_requests_timeout = 300
+
+
+def get_requests_version():
+    """Return the current version of release requests
+
+    :return: a string
+    """
+    return cacheutils.get_version(requests_version_key)
+
+
+def bump_requests_version():
+    """Invalidate the pending requests counters
+
+    Must be called each time a release request is made or processed.
+
+    :return: the new version (a string)
+    """
+    return cacheutils.bump_version(requests_version_key)
+
+
+def get_pending_requests(user):
+    """Return the number of pending requests visible by an administrator
+
+    The result is cached until the version of requests changes (only
+    if the cache backend is shared by all processes).
+
+    :param user: a ``User`` instance
+    :return: an integer
+    """
+    from .sql_listing import get_wrapper
+
+    if not cacheutils.is_shared():
+        return get_wrapper().get_pending_requests(user)
+    version = get_requests_version()
+    key = pending_requests_key % user.id
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    result = get_wrapper().get_pending_requests(user)
+    cache.set(key, (version, result), pending_requests_timeout)
+    return result
+
+
+# Quarantined messages are cached while an administrator inspects
+# them (the content, then the headers for example). The raw text is
+# cached, not the parsed message, and only for messages smaller than
+# message_max_size: some backends reject big values (1MB for
+# memcached).
+message_key = "amavis:message:%s"
+headers_key = "amavis:headers:%s"
+message_timeout = 300
+message_max_size = 512 * 1024
+
+
+def read_headers(qset):
+    """Read the headers of a quarantined message
+
+    Chunks are fetched one by one, until the end of the headers is
+    found.
+
+    :param qset: a ``Quarantine`` queryset selecting the message
+    :return: the headers (a string)
+    """
+    chunks = []
+    for chunk_ind in itertools.count(1):
+        rows = list(qset.filter(chunk_ind=chunk_ind)[:1])
+        if not rows:
+            break
+        qm = rows[0]
+        # The separator may be split between two chunks
+        tail = chunks[-1][-3:] if chunks else ""
+        chunks.append(qm.mail_text)
+        if re.search(r"\r?\n\r?\n", tail + qm.mail_text):
+            break
+    content = "".join(chunks)
+    match = re.search(r"\r?\n\r?\n", content)
+    if match is not None:
+        content = content[:match.end()]
+    return content
+
+
+def get_message(mail_id, headers_only=False):
+    """Return a quarantined message
+
+    Chunks are streamed in order to a feed parser. If only the headers
+    are needed, the message is not read entirely.
+
+    :param mail_id: the message's identifier
+    :param headers_only: only parse headers
+    :return: an ``email.message.Message`` object
+    """
+    from .sql_listing import get_wrapper
+
+    content = cache.get(message_key % mail_id)
+    if content is not None:
+        return Parser().parsestr(content)
+    if headers_only:
+        content = cache.get(headers_key % mail_id)
+        if content is None:
+            content = read_headers(
+                get_wrapper().get_mail_content(mail_id).order_by("chunk_ind")
+            )
+            if len(content) <= message_max_size:
+                cache.set(headers_key % mail_id, content, message_timeout)
+        return Parser().parsestr(content, headersonly=True)
+    qset = get_wrapper().get_mail_content(mail_id).order_by("chunk_ind")
+    parser = FeedParser()
+    chunks, size = [], 0
+    for qm in qset.iterator():
+        parser.feed(qm.mail_text)
+        size += len(qm.mail_text)
+        if size <= message_max_size:
+            chunks.append(qm.mail_text)
+    if size <= message_max_size:
+        cache.set(message_key % mail_id, "".join(chunks), message_timeout)
+    return parser.close()
+
+
 class AMrelease(object):
+    """AM.PDP client used to release quarantined messages
+
+    Several requests can be sent before reading the answers
+    (pipelining) and the connection can be kept open between calls
+    (see ``get_amrelease``).
+    """
+    # Maximum number of requests sent before reading answers
+    window = 50
+
     def __init__(self):
+        self.sock = None
+        self.buffer = ""
+        self.address = None
+        self.connect()
+
+    def __del__(self):
+        self.close()
+
+    @staticmethod
+    def get_address():
+        """Return the address of the PDP server
+
+        :return: a (socket family, address) tuple
+        """
         mode = parameters.get_admin("AM_PDP_MODE")
+        if mode == "inet":
+            host = parameters.get_admin('AM_PDP_HOST')
+            port = parameters.get_admin('AM_PDP_PORT')
+            return socket.AF_INET, (host, int(port))
+        return socket.AF_UNIX, parameters.get_admin('AM_PDP_SOCKET')
+
+    def connect(self):
+        self.close()
+        self.address = self.get_address()
         try:
-            if mode == "inet":
-                host = parameters.get_admin('AM_PDP_HOST')
-                port = parameters.get_admin('AM_PDP_PORT')
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((host, int(port)))
-            else:
-                path = parameters.get_admin('AM_PDP_SOCKET')
-                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self.sock.connect(path)
+            self.sock = socket.socket(self.address[0], socket.SOCK_STREAM)
+            self.sock.connect(self.address[1])
         except socket.error, err:
+            self.sock = None
             raise ModoboaException(
                 _("Connection to amavis failed: %s" % str(err))
             )
+        self.buffer = ""
+        # Nothing has been received on this connection yet
+        self.fresh = True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
     def decode(self, answer):
         def repl(match):
@@ -60,19 +224,103 @@ class AMrelease(object):
 
         return re.sub(r"%([0-9a-fA-F]{2})", repl, answer)
 
-    def __del__(self):
-        self.sock.close()
+    def encode(self, value):
+        """Escape an attribute value
+
+        :param value: a string
+        :return: the value with special characters encoded as %XX
+        """
+        if type(value) is unicode:
+            value = value.encode("utf-8")
+        return re.sub(r"[^\w\.@\+\-]",
+                      lambda match: "%%%02X" % ord(match.group(0)), value)
+
+    def build_request(self, mailid, secretid, recipient):
+        return "request=release\nmail_id=%s\nsecret_id=%s\nquar_type=Q\n" \
+            "recipient=%s\n\n" % tuple(
+                self.encode(value) for value in [mailid, secretid, recipient]
+            )
+
+    def read_response(self):
+        """Read the next answer sent by the server
+
+        An answer is a list of ``name=value`` lines ended by an empty
+        line; it may be received in several pieces.
+
+        :return: a dictionary of attributes
+        """
+        while True:
+            match = re.search(r"\r?\n\r?\n", self.buffer)
+            if match is not None:
+                break
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("connection closed by amavis")
+            self.buffer += data
+        answer = self.buffer[:match.start()]
+        self.buffer = self.buffer[match.end():]
+        self.fresh = False
+        result = {}
+        for line in answer.splitlines():
+            if "=" not in line:
+                continue
+            name, value = line.split("=", 1)
+            result[name] = self.decode(value)
+        return result
+
+    def sendreqs(self, requests):
+        """Send release requests
+
+        If the connection has been closed by the server since it was
+        last used, it is opened again.
+
+        :param requests: a list of (mail_id, secret_id, recipient) tuples
+        :return: a list of booleans (True if the message was released)
+        """
+        results = []
+        retry = True
+        while len(results) < len(requests):
+            pos = len(results)
+            chunk = requests[pos:pos + self.window]
+            try:
+                self.sock.sendall(
+                    "".join(self.build_request(*req) for req in chunk)
+                )
+                for req in chunk:
+                    answer = self.read_response()
+                    results.append(re.match(
+                        r"250 [\d\.]+ Ok", answer.get("setreply", "")
+                    ) is not None)
+            except socket.error:
+                if retry and self.fresh is False and len(results) == pos \
+                        and not self.buffer:
+                    # Nothing was answered: the server probably
+                    # closed an idle connection
+                    retry = False
+                    self.connect()
+                    continue
+                self.close()
+                results += [False] * (len(requests) - len(results))
+        return results
 
     def sendreq(self, mailid, secretid, recipient, *others):
-        self.sock.send("""request=release
-mail_id=%s
-secret_id=%s
-quar_type=Q
-recipient=%s
-
-""" % (mailid, secretid, recipient))
-        answer = self.sock.recv(1024)
-        answer = self.decode(answer)
-        if re.search("250 [\d\.]+ Ok", answer):
-            return True
-        return False
+        return self.sendreqs([(mailid, secretid, recipient)])[0]
+
+
+_local = threading.local()
+
+
+def get_amrelease():
+    """Return the AM.PDP client of the current thread
+
+    The connection is kept open and reused by the next calls, unless
+    the PDP server's address changed.
+
+    :return: an ``AMrelease`` instance
+    """
+    amr = getattr(_local, "amrelease", None)
+    if amr is None or amr.sock is None \
+            or amr.address != AMrelease.get_address():
+        amr = AMrelease()
+        _local.amrelease = amr
+    return amr
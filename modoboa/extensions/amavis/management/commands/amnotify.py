@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 # coding: utf-8
+import time
+import socket
+import smtplib
 from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
 from django.template.loader import render_to_string
@@ -13,7 +16,34 @@ from modoboa.extensions.amavis import Amavis
 from modoboa.extensions.amavis.models import (
     Msgrcpt
 )
-from modoboa.extensions.amavis.sql_listing import get_wrapper
+from modoboa.extensions.amavis.sql_listing import reverse_domain_name
+
+# Number of requests displayed inside a notification
+sample_size = 10
+
+
+class PendingRequests(object):
+    """Pending requests of a set of recipients
+
+    Only the total and the most recent requests are kept.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.sample = []
+
+    def add(self, req):
+        """Add a request (requests must be added newest first)"""
+        self.total += 1
+        if len(self.sample) < sample_size:
+            self.sample.append(req)
+
+    def merge(self, other):
+        self.total += other.total
+        self.sample = sorted(
+            self.sample + other.sample,
+            key=lambda req: req.mail.time_num, reverse=True
+        )[:sample_size]
 
 
 class Command(BaseCommand):
@@ -30,6 +60,8 @@ class Command(BaseCommand):
                     help="The address of the SMTP server used to send notifications"),
         make_option("--smtp_port", type="int", default=25,
                     help="The listening port of the SMTP server used to send notifications"),
+        make_option("--dry-run", action="store_true", default=False,
+                    help="Display notifications instead of sending them"),
         make_option("--verbose", action="store_true",
                     help="Activate verbose mode")
     )
@@ -41,26 +73,127 @@ class Command(BaseCommand):
         Amavis().load()
         self.notify_admins_pending_requests()
 
-    def send_pr_notification(self, rcpt, reqs):
-        if self.options["verbose"]:
-            print "Sending notification to %s" % rcpt
-        total = reqs.count()
-        reqs = reqs.all()[:10]
-        content = render_to_string(
+    def get_pending_requests(self):
+        """Return pending requests grouped by domain
+
+        A single query is sent to the amavis database.
+
+        :return: a tuple (dictionary of ``PendingRequests`` per
+                 reversed domain name, ``PendingRequests`` of all domains)
+        """
+        result = {}
+        everything = PendingRequests()
+        reqs = Msgrcpt.objects.filter(rs='p') \
+            .select_related("mail__sid", "rid").order_by("-mail__time_num")
+        for req in reqs.iterator():
+            result.setdefault(req.rid.domain, PendingRequests()).add(req)
+            everything.add(req)
+        return result, everything
+
+    def get_notifications(self):
+        """Return the notifications to send
+
+        :return: a list of (recipient, ``PendingRequests``) tuples
+        """
+        bydomain, everything = self.get_pending_requests()
+        if not everything.total:
+            return []
+        # Domains of all domain administrators, in a single query
+        domains = {}
+        for uid, name in Domain.objects \
+                .filter(owners__user__groups__name="DomainAdmins") \
+                .values_list("owners__user", "name"):
+            domains.setdefault(uid, []).append(name)
+        result = []
+        for da in User.objects.filter(groups__name="DomainAdmins") \
+                .prefetch_related("mailbox_set__domain"):
+            mailboxes = da.mailbox_set.all()
+            if not mailboxes:
+                continue
+            reqs = PendingRequests()
+            for name in domains.get(da.id, []):
+                name = reverse_domain_name(name)
+                if name in bydomain:
+                    reqs.merge(bydomain[name])
+            if reqs.total:
+                result.append((mailboxes[0].full_address, reqs))
+
+        for su in User.objects.filter(is_superuser=True) \
+                .prefetch_related("mailbox_set__domain"):
+            mailboxes = su.mailbox_set.all()
+            if not mailboxes:
+                continue
+            result.append((mailboxes[0].full_address, everything))
+        return result
+
+    def render_notification(self, reqs):
+        return render_to_string(
             "amavis/notifications/pending_requests.html", dict(
-                total=total, requests=reqs,
+                total=reqs.total, requests=reqs.sample,
                 baseurl=self.baseurl, listingurl=self.listingurl
             )
         )
-        status, msg = sendmail_simple(
+
+    def connect(self):
+        return smtplib.SMTP(self.options["smtp_host"],
+                            self.options["smtp_port"])
+
+    def is_connected(self, connection):
+        try:
+            connection.noop()
+        except smtplib.SMTPServerDisconnected:
+            return False
+        return True
+
+    def send_notification(self, connection, rcpt, reqs):
+        return sendmail_simple(
             self.sender, rcpt,
             subject=_("[modoboa] Pending release requests"),
-            content=content,
-            server=self.options["smtp_host"],
-            port=self.options["smtp_port"]
+            content=self.render_notification(reqs),
+            connection=connection
         )
-        if not status:
-            print msg
+
+    def send_notifications(self, notifications):
+        """Send notifications using a single SMTP connection
+
+        If the server closes the connection, a new one is opened
+        (only once).
+
+        :return: the number of notifications sent
+        """
+        try:
+            connection = self.connect()
+        except (smtplib.SMTPException, socket.error), e:
+            print "SMTP error: %s" % str(e)
+            return 0
+        sent = 0
+        reconnected = False
+        try:
+            for rcpt, reqs in notifications:
+                if self.options["verbose"]:
+                    print "Sending notification to %s" % rcpt
+                status, msg = self.send_notification(connection, rcpt, reqs)
+                if not status and not reconnected \
+                        and not self.is_connected(connection):
+                    reconnected = True
+                    try:
+                        connection = self.connect()
+                    except (smtplib.SMTPException, socket.error), e:
+                        connection = None
+                        print "SMTP error: %s" % str(e)
+                        break
+                    status, msg = self.send_notification(connection, rcpt, reqs)
+                if not status:
+                    print msg
+                    continue
+                sent += 1
+        finally:
+            if connection is not None:
+                try:
+                    connection.quit()
+                except (smtplib.SMTPException, socket.error):
+                    pass
+        return sent
 
     def notify_admins_pending_requests(self):
         self.sender = parameters.get_admin("NOTIFICATIONS_SENDER",
@@ -70,23 +203,22 @@ class Command(BaseCommand):
             + reverse("modoboa.extensions.amavis.views._listing") \
             + "?viewrequests=1"
 
-        for da in User.objects.filter(groups__name="DomainAdmins"):
-            if not da.mailbox_set.count():
-                continue
-            rcpt = da.mailbox_set.all()[0].full_address
-            reqs = get_wrapper().get_domains_pending_requests(
-                Domain.objects.get_for_admin(da)
-            )
-            if reqs.count():
-                self.send_pr_notification(rcpt, reqs)
-
-        reqs = Msgrcpt.objects.filter(rs='p')
-        if not reqs.count():
+        start = time.time()
+        notifications = self.get_notifications()
+        computed = time.time()
+        if not notifications:
             if self.options["verbose"]:
                 print "No release request currently pending"
             return
-        for su in User.objects.filter(is_superuser=True):
-            if not su.mailbox_set.count():
-                continue
-            rcpt = su.mailbox_set.all()[0].full_address
-            self.send_pr_notification(rcpt, reqs)
+        if self.options["dry_run"]:
+            for rcpt, reqs in notifications:
+                print "To: %s" % rcpt
+                print self.render_notification(reqs).encode("utf-8")
+            sent = 0
+        else:
+            sent = self.send_notifications(notifications)
+        if self.options["verbose"] or self.options["dry_run"]:
+            print "%d notifications computed in %.2fs, %d sent in %.2fs" % (
+                len(notifications), computed - start,
+                sent, time.time() - computed
+            )
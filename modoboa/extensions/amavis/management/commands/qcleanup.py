@@ -4,16 +4,27 @@
 import time
 from optparse import make_option
 from django.core.management.base import BaseCommand
+from django.db import connections, transaction
 from modoboa.lib import parameters
 from modoboa.extensions.amavis import Amavis
+from modoboa.extensions.amavis.lib import bump_requests_version
 from modoboa.extensions.amavis.models import (
-    Msgrcpt, Msgs, Maddr
+    Msgrcpt, Msgs, Maddr, Quarantine
 )
+from modoboa.extensions.amavis import search
+
+# Maximum number of identifiers sent in a single DELETE statement
+# (SQLite doesn't accept more than 999 parameters)
+chunk_size = 500
+
+# Number of addresses checked by a single DELETE statement
+maddr_step = 10000
 
 
 class Command(BaseCommand):
     args = ''
     help = 'Amavis quarantine cleanup'
+    verbose = False
 
     option_list = BaseCommand.option_list + (
         make_option('--debug',
@@ -23,7 +34,19 @@ class Command(BaseCommand):
         make_option('--verbose',
                     action='store_true',
                     default=False,
-                    help='Display informational messages')
+                    help='Display informational messages'),
+        make_option('--dry-run',
+                    action='store_true',
+                    default=False,
+                    help='Only report the number of rows that would be '
+                    'deleted (unreferenced addresses are counted before '
+                    'messages are deleted)'),
+        make_option('--batch',
+                    type='int',
+                    default=24,
+                    metavar='HOURS',
+                    help='Process messages by time ranges of HOURS hours '
+                    '(default: 24)')
     )
 
     def __vprint(self, msg):
@@ -31,6 +54,156 @@ class Command(BaseCommand):
             return
         print msg
 
+    def execute_sql(self, query, params=None):
+        """Execute a query against the amavis database
+
+        Each statement is committed right away so locks are not kept
+        during the whole cleanup.
+
+        :return: the number of affected rows
+        """
+        cursor = connections["amavis"].cursor()
+        cursor.execute(query, params or [])
+        transaction.commit_unless_managed(using="amavis")
+        return cursor.rowcount
+
+    def fetch_sql(self, query, params=None):
+        cursor = connections["amavis"].cursor()
+        cursor.execute(query, params or [])
+        return cursor.fetchall()
+
+    def messages_condition(self, flags, limit):
+        """Return the condition selecting messages to delete
+
+        A message is deleted when it is older than ``limit`` or when
+        all its recipients are marked with one of ``flags``.
+
+        :return: a (SQL, parameters) tuple
+        """
+        placeholders = ", ".join(["%s"] * len(flags))
+        rcpt_query = "SELECT 1 FROM {rcpt} WHERE {rcpt}.mail_id = {msgs}.mail_id AND {rcpt}.rs {{}} ({placeholders})".format(
+            rcpt=Msgrcpt._meta.db_table, msgs=Msgs._meta.db_table,
+            placeholders=placeholders
+        )
+        condition = "(time_num < %s OR (EXISTS ({}) AND NOT EXISTS ({})))".format(
+            rcpt_query.format("IN"), rcpt_query.format("NOT IN")
+        )
+        return condition, [limit] + flags + flags
+
+    def delete_messages(self, mail_ids, dry_run):
+        """Delete messages and their recipients and contents
+
+        Children are deleted first, so it works with or without
+        foreign key constraints.
+
+        :param mail_ids: a list of message identifiers
+        :return: a dictionary of deleted rows per table
+        """
+        result = {}
+        for table in self.tables:
+            result[table] = 0
+            for pos in range(0, len(mail_ids), chunk_size):
+                chunk = mail_ids[pos:pos + chunk_size]
+                where = "mail_id IN (%s)" % ", ".join(["%s"] * len(chunk))
+                if dry_run:
+                    result[table] += self.fetch_sql(
+                        "SELECT COUNT(*) FROM %s WHERE %s" % (table, where),
+                        chunk
+                    )[0][0]
+                else:
+                    result[table] += self.execute_sql(
+                        "DELETE FROM %s WHERE %s" % (table, where), chunk
+                    )
+        return result
+
+    def cleanup_messages(self, flags, limit, step, dry_run=False):
+        """Delete marked and old messages
+
+        Messages are processed by time ranges of ``step`` seconds.
+        Empty ranges are skipped: each range starts at the first
+        message following the previous one.
+
+        :param flags: recipient statuses marking deleted messages
+        :param limit: messages older than this timestamp are deleted
+        :param step: size of time ranges
+        :return: a dictionary of deleted rows per table
+        """
+        self.tables = [model._meta.db_table
+                       for model in [Quarantine, Msgrcpt, Msgs]]
+        if search.table_exists():
+            # Remove messages from the search index too
+            self.tables.insert(0, search.table)
+        total = dict.fromkeys(self.tables, 0)
+        tmin, tmax = self.fetch_sql(
+            "SELECT MIN(time_num), MAX(time_num) FROM %s" % Msgs._meta.db_table
+        )[0]
+        if tmin is None:
+            return total
+        condition, params = self.messages_condition(flags, limit)
+        start = tmin
+        while start is not None:
+            mail_ids = [row[0] for row in self.fetch_sql(
+                "SELECT mail_id FROM %s WHERE time_num >= %%s AND time_num < %%s AND %s"
+                % (Msgs._meta.db_table, condition),
+                [start, start + step] + params
+            )]
+            result = self.delete_messages(mail_ids, dry_run)
+            for table, count in result.iteritems():
+                total[table] += count
+            self.__vprint("[%3d%%] %s: %d messages" % (
+                100 * (start - tmin) / max(tmax - tmin, 1),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(start)),
+                result[Msgs._meta.db_table]
+            ))
+            # Jump to the next message (uses the time_num index)
+            start = self.fetch_sql(
+                "SELECT MIN(time_num) FROM %s WHERE time_num >= %%s"
+                % Msgs._meta.db_table, [start + step]
+            )[0][0]
+        return total
+
+    def cleanup_addresses(self, dry_run=False):
+        """Delete addresses used by no message
+
+        :return: the number of deleted rows
+        """
+        idmin, idmax = self.fetch_sql(
+            "SELECT MIN(id), MAX(id) FROM %s" % Maddr._meta.db_table
+        )[0]
+        if idmin is None:
+            return 0
+        where = "id >= %s AND id < %s " \
+            "AND NOT EXISTS (SELECT 1 FROM {msgs} WHERE {msgs}.sid = {maddr}.id) " \
+            "AND NOT EXISTS (SELECT 1 FROM {rcpt} WHERE {rcpt}.rid = {maddr}.id)".format(
+                msgs=Msgs._meta.db_table, rcpt=Msgrcpt._meta.db_table,
+                maddr=Maddr._meta.db_table
+            )
+        total = 0
+        for start in range(idmin, idmax + 1, maddr_step):
+            params = [start, start + maddr_step]
+            if dry_run:
+                total += self.fetch_sql(
+                    "SELECT COUNT(*) FROM %s WHERE %s"
+                    % (Maddr._meta.db_table, where), params
+                )[0][0]
+            else:
+                total += self.execute_sql(
+                    "DELETE FROM %s WHERE %s" % (Maddr._meta.db_table, where),
+                    params
+                )
+        return total
+
+    def cleanup(self, flags, limit, step, dry_run=False):
+        """Clean the quarantine up
+
+        :return: a dictionary of deleted rows per table
+        """
+        self.__vprint("Deleting marked and old messages...")
+        result = self.cleanup_messages(flags, limit, step, dry_run)
+        self.__vprint("Deleting unreferenced e-mail addresses...")
+        result[Maddr._meta.db_table] = self.cleanup_addresses(dry_run)
+        return result
+
     def handle(self, *args, **options):
         if options["debug"]:
             import logging
@@ -49,19 +222,16 @@ class Command(BaseCommand):
                                 app="amavis") == "yes":
             flags += ['R']
 
-        self.__vprint("Deleting marked messages...")
-        ids = Msgrcpt.objects.filter(rs__in=flags).values("mail_id")
-        for msg in Msgs.objects.filter(mail_id__in=ids):
-            if not msg.msgrcpt_set.exclude(rs__in=flags).count():
-                msg.delete()
-
-        self.__vprint("Deleting messages older than %d days..." % max_messages_age)
+        self.__vprint("Messages older than %d days will be deleted" % max_messages_age)
         limit = int(time.time()) - (max_messages_age * 24 * 3600)
-        Msgs.objects.filter(time_num__lt=limit).delete()
+        result = self.cleanup(flags, limit, options["batch"] * 3600,
+                              options["dry_run"])
+        if options["dry_run"]:
+            for table in sorted(result):
+                print "%s: %d rows would be deleted" % (table, result[table])
+            return
 
-        self.__vprint("Deleting unreferenced e-mail addresses...")
-        for maddr in Maddr.objects.all():
-            if not maddr.msgs_set.count() and not maddr.msgrcpt_set.count():
-                maddr.delete()
+        # Pending requests may have been removed
+        bump_requests_version()
 
         self.__vprint("Done.")
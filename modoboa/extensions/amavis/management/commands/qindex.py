@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# coding: utf-8
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from modoboa.extensions.amavis.search import (
+    Indexer, table_exists, create_table
+)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Add new quarantined messages to the search index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch',
+                    type='int',
+                    default=1000,
+                    help='Number of messages indexed at once '
+                    '(default: 1000)'),
+        make_option('--verbose',
+                    action='store_true',
+                    default=False,
+                    help='Display informational messages')
+    )
+
+    def __vprint(self, msg):
+        if not self.verbose:
+            return
+        print msg
+
+    def handle(self, *args, **options):
+        self.verbose = options["verbose"]
+        if not table_exists():
+            self.__vprint("Creating the index table...")
+            create_table()
+        start = time.time()
+        total = Indexer(options["batch"]).run(
+            lambda count: self.__vprint("%d messages indexed" % count)
+        )
+        self.__vprint("%d messages indexed in %.2fs" % (
+            total, time.time() - start
+        ))
@@ -0,0 +1,223 @@
+# coding: utf-8
+"""
+Quarantine search index.
+
+Searching the quarantine with ``LIKE '%pattern%'`` scans the ``msgs``
+and ``maddr`` tables. Instead, the ``qindex`` command splits senders,
+subjects and recipients into terms stored inside the ``msgterm``
+table (in the amavis database, next to the tables it indexes), and
+the listing looks terms up by prefix, which uses an index. The table
+holds several rows per message and has no primary key: it is only
+accessed with raw SQL.
+
+Each indexed message also gets a marker row, so messages without any
+term are not indexed again. The marker holds the message's date
+(``time_num``), so each run starts from the last indexed date instead
+of scanning the whole ``msgs`` table.
+
+"""
+import re
+from django.db import connections, transaction
+from django.db.models import Q
+from .models import Msgs, Msgrcpt, Maddr
+
+table = "msgterm"
+# Columns are truncated to this length
+max_term_length = 64
+
+# Fields of the index (msgterm.field values)
+fields = {
+    "from_addr": "f",
+    "subject": "s",
+    "to": "r",
+}
+marker = "*"
+# Runs start this number of seconds before the last indexed date, to
+# catch messages amavis was still processing during the previous run
+checkpoint_margin = 3600
+
+schema = [
+    """CREATE TABLE %s (
+    mail_id varchar(16) NOT NULL, field char(1) NOT NULL,
+    term varchar(%d) NOT NULL)""" % (table, max_term_length),
+    "CREATE INDEX {0}_idx_term ON {0} (field, term, mail_id)".format(table),
+    "CREATE INDEX {0}_idx_mail_id ON {0} (mail_id)".format(table),
+]
+
+
+def tokenize(value):
+    """Split a value into search terms
+
+    Terms are lower case words. E-mail addresses are also indexed as a
+    whole, so they can be searched with their domain.
+
+    :param value: a string
+    :return: a set of unicode strings
+    """
+    if value is None:
+        return set()
+    if not isinstance(value, unicode):
+        value = str(value).decode("utf-8", "replace")
+    value = value.lower()
+    terms = set(re.findall(r"\w+", value, re.UNICODE))
+    terms.update(re.findall(r"[^\s<>\"',;]+@[^\s<>\"',;]+", value))
+    return set(term[:max_term_length] for term in terms)
+
+
+def table_exists(using="amavis"):
+    """Tell if the index table exists
+
+    :return: a boolean
+    """
+    connection = connections[using]
+    return table in connection.introspection.table_names(connection.cursor())
+
+
+def create_table(using="amavis"):
+    """Create the index table and its indexes"""
+    cursor = connections[using].cursor()
+    for statement in schema:
+        cursor.execute(statement)
+    transaction.commit_unless_managed(using=using)
+
+
+def get_search_filter(pattern, criteria):
+    """Return a filter selecting messages matching a pattern
+
+    Each term of the pattern must start one of the terms of the
+    selected fields. A pattern without any term (punctuation only for
+    example) matches no message.
+
+    :param pattern: the searched string
+    :param criteria: a list of fields (keys of ``fields``)
+    :return: a ``Q`` object applying to ``Msgrcpt``
+    """
+    try:
+        codes = [fields[c] for c in criteria]
+    except KeyError, e:
+        raise Exception("unsupported search criteria %s" % e)
+    terms = tokenize(pattern)
+    if not terms:
+        return Q(mail__in=[])
+    addresses = [term for term in terms if "@" in term]
+    result = Q()
+    for term in terms:
+        if "@" not in term and any(term in addr for addr in addresses):
+            # Words of an address match too many messages (com, net...)
+            continue
+        # Prefix lookups written as a range so an index is used
+        upper = term[:-1] + unichr(ord(term[-1]) + 1)
+        result &= Q(mail__in=Msgs.objects.extra(
+            where=["mail_id IN (SELECT mail_id FROM %s WHERE field IN (%s) "
+                   "AND term >= %%s AND term < %%s)"
+                   % (table, ", ".join(["%s"] * len(codes)))],
+            params=codes + [term, upper]
+        ).values("mail_id"))
+    return result
+
+
+class Indexer(object):
+    """Add messages to the search index
+
+    :param batch: number of messages indexed at once
+    """
+
+    def __init__(self, batch=1000, using="amavis"):
+        self.batch = batch
+        self.using = using
+        # Batches start from the last indexed date, so already indexed
+        # messages are not scanned again (see ``checkpoint``)
+        self.since = None
+
+    def fetch(self, query, params=None):
+        cursor = connections[self.using].cursor()
+        cursor.execute(query, params or [])
+        return cursor.fetchall()
+
+    @staticmethod
+    def _text(value):
+        # bytea columns (postgres) are returned as buffers
+        if isinstance(value, buffer):
+            value = str(value)
+        return value
+
+    def checkpoint(self):
+        """Return the date the next run must start from
+
+        The last indexed date is read from marker rows (an index
+        lookup), minus ``checkpoint_margin``.
+
+        :return: an integer (epoch)
+        """
+        last = self.fetch(
+            "SELECT MAX(term) FROM %s WHERE field = %%s" % table, [marker]
+        )[0][0]
+        if not last:
+            return 0
+        return max(0, int(last) - checkpoint_margin)
+
+    def index_batch(self):
+        """Index the next messages
+
+        Messages still being processed by amavis (whose content is
+        not set yet) are skipped.
+
+        :return: the number of indexed messages
+        """
+        if self.since is None:
+            self.since = self.checkpoint()
+        msgs = self.fetch(
+            "SELECT mail_id, from_addr, subject, time_num FROM {msgs} "
+            "WHERE time_num >= %s AND content IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM {terms} WHERE {terms}.mail_id = {msgs}.mail_id) "
+            "ORDER BY time_num LIMIT %s".format(
+                msgs=Msgs._meta.db_table, terms=table
+            ), [self.since, self.batch]
+        )
+        if not msgs:
+            return 0
+        self.since = msgs[-1][3]
+        mail_ids = [row[0] for row in msgs]
+        rows = []
+        for mail_id, from_addr, subject, time_num in msgs:
+            # Dates are padded so they sort as strings
+            rows.append((mail_id, marker, "%010d" % time_num))
+            rows += [(mail_id, fields["from_addr"], term)
+                     for term in tokenize(self._text(from_addr))]
+            rows += [(mail_id, fields["subject"], term)
+                     for term in tokenize(self._text(subject))]
+        for pos in range(0, len(mail_ids), 500):
+            chunk = mail_ids[pos:pos + 500]
+            for mail_id, email in self.fetch(
+                "SELECT {rcpt}.mail_id, {maddr}.email FROM {rcpt}, {maddr} "
+                "WHERE {rcpt}.rid = {maddr}.id AND {rcpt}.mail_id IN ({ids})".format(
+                    rcpt=Msgrcpt._meta.db_table, maddr=Maddr._meta.db_table,
+                    ids=", ".join(["%s"] * len(chunk))
+                ), chunk
+            ):
+                rows += [(mail_id, fields["to"], term)
+                         for term in tokenize(self._text(email))]
+        cursor = connections[self.using].cursor()
+        cursor.executemany(
+            "INSERT INTO %s (mail_id, field, term) VALUES (%%s, %%s, %%s)"
+            % table, rows
+        )
+        transaction.commit_unless_managed(using=self.using)
+        return len(msgs)
+
+    def run(self, callback=None):
+        """Index all messages not indexed yet
+
+        :param callback: a function called with the number of messages
+                         indexed after each batch
+        :return: the number of indexed messages
+        """
+        total = 0
+        while True:
+            count = self.index_batch()
+            if not count:
+                break
+            total += count
+            if callback is not None:
+                callback(total)
+        return total
@@ -33,57 +33,158 @@ class Qtable(tables.Table):
         return datetime.fromtimestamp(value)
 
 
+def parse_cursor(value):
+    """Parse the position of a listing row
+
+    :param value: a string like "<time_num>:<mail_id>:<rid>" (or None)
+    :return: a (time_num, mail_id, rid) tuple or None if invalid
+    """
+    if not value:
+        return None
+    try:
+        time_num, mail_id, rid = value.split(":")
+        return int(time_num), mail_id, int(rid)
+    except ValueError:
+        return None
+
+
 class SQLconnector(MBconnector):
+    """Quarantine listing backend
+
+    One row is returned per recipient. Messages, recipients and
+    addresses are fetched using a single joined query. Pagination
+    counts rows too: a message sent to three recipients takes three
+    rows, so ``messages_count`` returns the number of recipients,
+    not of messages.
+
+    When rows are sorted by date, a page is reached from the last (or
+    first) row of its neighbour (keyset pagination on (time_num,
+    mail_id, rid)) instead of using an OFFSET, so deep pages cost the
+    same as the first one. Pages reached directly (without cursor)
+    are read from the nearest end of the listing. Links using a
+    cursor also give the total computed for the first page, so it is
+    not counted again.
+    """
     orders = {
         "from": "mail__from_addr",
         "subject": "mail__subject",
         "date": "mail__time_num"
     }
+    keyset_fields = ["mail__time_num", "mail__mail_id", "rid"]
 
-    def __init__(self, mail_ids=None, filter=None):
+    def __init__(self, mail_ids=None, filter=None, after=None, before=None,
+                 total=None):
         self.count = None
         self.mail_ids = mail_ids
         self.filter = filter
+        self.after = parse_cursor(after)
+        self.before = parse_cursor(before)
+        self.order = ["-%s" % field for field in self.keyset_fields]
+        self.keyset = True
+        self.first_cursor = self.last_cursor = None
+        try:
+            self.total = int(total) if total else None
+        except ValueError:
+            self.total = None
 
     def messages_count(self, **kwargs):
         if self.count is None:
-            filter = Q(chunk_ind=1)
+            filter = Q(mail__quarantine__chunk_ind=1)
             if self.mail_ids is not None:
                 filter &= Q(mail__in=self.mail_ids)
             if self.filter:
                 filter &= self.filter
-            self.messages = Quarantine.objects.filter(filter)
-            if "order" in kwargs:
+            self.messages = Msgrcpt.objects.filter(filter)
+            if kwargs.get("order", None):
                 totranslate = kwargs["order"][1:]
                 sign = kwargs["order"][:1]
                 if sign == " ":
                     sign = ""
-                order = sign + self.orders[totranslate]
-                self.messages = self.messages.order_by(order)
-            self.count = self.messages.count()
+                if totranslate == "date":
+                    self.order = [sign + field for field in self.keyset_fields]
+                else:
+                    self.order = [sign + self.orders[totranslate]] + self.order
+                    self.keyset = False
+            if self.keyset and self.total is not None \
+                    and (self.after is not None or self.before is not None):
+                self.count = self.total
+            else:
+                self.count = self.messages.count()
         return self.count
 
+    @staticmethod
+    def _reverse(order):
+        return [field[1:] if field.startswith("-") else "-" + field
+                for field in order]
+
+    def _keyset_filter(self, cursor, forward):
+        """Return a filter selecting rows after (or before) a cursor
+
+        :param cursor: a (time_num, mail_id, rid) tuple
+        :param forward: select rows after the cursor if True
+        :return: a ``Q`` object
+        """
+        descending = self.order[0].startswith("-")
+        op = "lt" if descending == forward else "gt"
+        result = None
+        for pos, field in enumerate(self.keyset_fields):
+            cond = Q(**{"%s__%s" % (field, op): cursor[pos]})
+            for prev in range(pos):
+                cond &= Q(**{self.keyset_fields[prev]: cursor[prev]})
+            result = cond if result is None else result | cond
+        return result
+
     def fetch(self, start=None, stop=None, **kwargs):
-        messages = self.messages[start - 1:stop]
+        rows = self.messages.select_related("mail", "rid")
+        if self.keyset and self.after is not None:
+            rows = list(rows.filter(self._keyset_filter(self.after, True))
+                        .order_by(*self.order)[:stop - start + 1])
+        elif self.keyset and self.before is not None:
+            rows = list(rows.filter(self._keyset_filter(self.before, False))
+                        .order_by(*self._reverse(self.order))[:stop - start + 1])
+            rows.reverse()
+        elif start - 1 > self.count - stop:
+            # Closer to the end: the last page needs no offset
+            rows = list(rows.order_by(*self._reverse(self.order))
+                        [self.count - stop:self.count - start + 1])
+            rows.reverse()
+        else:
+            rows = list(rows.order_by(*self.order)[start - 1:stop])
         emails = []
-        for qm in messages:
-            for rcpt in qm.mail.msgrcpt_set.all():
-                m = {"from": qm.mail.from_addr,
-                     "to": rcpt.rid.email,
-                     "subject": qm.mail.subject,
-                     "mailid": qm.mail_id,
-                     "date": qm.mail.time_num,
-                     "type": rcpt.content}
-                if rcpt.rs == '':
-                    m["class"] = "unseen"
-                elif rcpt.rs == 'R':
-                    m["img_rstatus"] = static_url("pics/release.png")
-                elif rcpt.rs == 'p':
-                    m["class"] = "pending"
-                emails.append(m)
+        for rcpt in rows:
+            m = {"from": rcpt.mail.from_addr,
+                 "to": rcpt.rid.email,
+                 "subject": rcpt.mail.subject,
+                 "mailid": rcpt.mail_id,
+                 "date": rcpt.mail.time_num,
+                 "type": rcpt.content}
+            if rcpt.rs == '':
+                m["class"] = "unseen"
+            elif rcpt.rs == 'R':
+                m["img_rstatus"] = static_url("pics/release.png")
+            elif rcpt.rs == 'p':
+                m["class"] = "pending"
+            emails.append(m)
+        if self.keyset and rows:
+            self.first_cursor, self.last_cursor = [
+                "%d:%s:%d" % (rcpt.mail.time_num, rcpt.mail_id, rcpt.rid_id)
+                for rcpt in [rows[0], rows[-1]]
+            ]
         return emails
 
 
+def reverse_domain_name(name):
+    """Return a domain name the way amavis stores it
+
+    amavis fills the ``maddr.domain`` column with the reversed domain
+    name of each address (``com.example`` for ``user@example.com``).
+
+    :param name: a domain name
+    :return: a string
+    """
+    return ".".join(reversed(name.lower().split(".")))
+
+
 class SQLWrapper(object):
     """A simple SQL wrapper.
 
@@ -107,10 +208,9 @@ class SQLWrapper(object):
             q &= Q(rid__email=request.user.email)
         else:
             if not request.user.is_superuser:
-                doms = Domain.objects.get_for_admin(request.user)
-                regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-                doms_q = Q(rid__email__regex=regexp)
-                q &= doms_q
+                q &= self.get_domains_filter(
+                    Domain.objects.get_for_admin(request.user)
+                )
             if rcptfilter is not None:
                 q &= Q(rid__email__contains=rcptfilter)
 
@@ -122,9 +222,35 @@ class SQLWrapper(object):
     def get_recipient_messages(self, address, mailids):
         return Msgrcpt.objects.filter(mail__in=mailids, rid__email=address)
 
+    def set_recipients_status(self, msgrcpts, status):
+        """Update the status of several recipients at once
+
+        :param msgrcpts: a list of ``Msgrcpt`` instances
+        :param status: the new status ('R', 'D', ...)
+        """
+        for pos in range(0, len(msgrcpts), 200):
+            q = reduce(lambda a, b: a | b, [
+                Q(mail=msgrcpt.mail_id, rid=msgrcpt.rid_id)
+                for msgrcpt in msgrcpts[pos:pos + 200]
+            ])
+            Msgrcpt.objects.filter(q).update(rs=status)
+
+    def get_domains_filter(self, domains):
+        """Return a filter selecting recipients of the given domains
+
+        The ``maddr.domain`` column is compared to a list of values,
+        which lets the database use an index (see the documentation).
+
+        :param domains: a list of ``Domain`` instances
+        :return: a ``Q`` object
+        """
+        return Q(rid__domain__in=[reverse_domain_name(dom.name)
+                                  for dom in domains])
+
     def get_domains_pending_requests(self, domains):
-        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
-        return Msgrcpt.objects.filter(rs='p', rid__email__regex=regexp)
+        return Msgrcpt.objects.filter(
+            Q(rs='p') & self.get_domains_filter(domains)
+        )
 
     def get_pending_requests(self, user):
         """Return the number of current pending requests
@@ -136,9 +262,7 @@ class SQLWrapper(object):
             doms = Domain.objects.get_for_admin(user)
             if not doms.count():
                 return 0
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            doms_q = Q(rid__email__regex=regexp)
-            rq &= doms_q
+            rq &= self.get_domains_filter(doms)
         return Msgrcpt.objects.filter(rq).count()
 
     def get_mail_content(self, mailid):
@@ -150,6 +274,9 @@ class PgWrapper(SQLWrapper):
 
     Make use of ``QuerySet.extra`` and postgres ``convert_from``
     function to let the quarantine manager work as expected !
+
+    ``maddr.domain`` is a varchar column so domain filters don't need
+    any conversion.
     """
 
     def get_mails(self, request, rcptfilter=None):
@@ -158,6 +285,7 @@ class PgWrapper(SQLWrapper):
         else:
             q = ~Q(rs='D')
         where = ["U0.rid=maddr.id"]
+        params = []
         if request.user.group == 'SimpleUsers':
             where.append("convert_from(maddr.email, 'UTF8') = '%s'" % request.user.email)
             return Msgrcpt.objects.filter(q).extra(
@@ -165,12 +293,20 @@ class PgWrapper(SQLWrapper):
             )
 
         if not request.user.is_superuser:
-            doms = Domain.objects.get_for_admin(request.user)
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            where.append("convert_from(maddr.email, 'UTF8') ~ '%s'" % regexp)
+            names = [reverse_domain_name(dom.name) for dom in
+                     Domain.objects.get_for_admin(request.user)]
+            if not names:
+                # "IN ()" is a syntax error
+                return Msgrcpt.objects.filter(q, rid__domain__in=[]) \
+                    .values("mail_id")
+            where.append("maddr.domain IN (%s)"
+                         % ", ".join(["%s"] * len(names)))
+            params += names
         if rcptfilter is not None:
             where.append("convert_from(maddr.email, 'UTF8') LIKE '%%%s%%'" % rcptfilter)
-        return Msgrcpt.objects.filter(q).extra(where=where, tables=['maddr']).values("mail_id")
+        return Msgrcpt.objects.filter(q).extra(
+            where=where, params=params, tables=['maddr']
+        ).values("mail_id")
 
     def get_recipient_message(self, address, mailid):
         qset = Msgrcpt.objects.filter(mail=mailid).extra(
@@ -185,26 +321,6 @@ class PgWrapper(SQLWrapper):
             tables=['maddr']
         )
 
-    def get_domains_pending_requests(self, domains):
-        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
-        return Msgrcpt.objects.filter(rs='p').extra(
-            where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') ~ '%s'" % regexp],
-            tables=['maddr']
-        )
-
-    def get_pending_requests(self, user):
-        rq = Q(rs='p')
-        if not user.is_superuser:
-            doms = Domain.objects.get_for_admin(user)
-            if not doms.count():
-                return 0
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            return Msgrcpt.objects.filter(rq).extra(
-                where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') ~ '%s'" % (regexp,)],
-                tables=['maddr']
-            ).count()
-        return Msgrcpt.objects.filter(rq).count()
-
     def get_mail_content(self, mailid):
         return Quarantine.objects.filter(mail=mailid).extra(
             select={'mail_text': "convert_from(mail_text, 'UTF8')"}
@@ -228,15 +344,26 @@ class SQLlisting(EmailListing):
     defcallback = "updatelisting"
     reset_wm_url = True
 
-    def __init__(self, user, msgs, filter, **kwargs):
+    def __init__(self, user, msgs, filter, after=None, before=None,
+                 total=None, **kwargs):
         if user.group == 'SimpleUsers':
             Qtable.cols_order = ['type', 'rstatus', 'from_', 'subject', 'time']
         else:
             Qtable.cols_order = ['type', 'rstatus', 'to', 'from_', 'subject', 'time']
-        self.mbc = SQLconnector(msgs, filter)
+        self.mbc = SQLconnector(msgs, filter, after, before, total)
         super(SQLlisting, self).__init__(**kwargs)
         self.show_listing_headers = True
 
+    def set_cursors(self, page):
+        """Give the positions of the last fetched rows to a page
+
+        Links of the navigation bar will then use keyset pagination.
+
+        :param page: a ``Page`` instance
+        """
+        page.previous_cursor = self.mbc.first_cursor
+        page.next_cursor = self.mbc.last_cursor
+
 
 class SQLemail(Email):
     def __init__(self, msg, *args, **kwargs):
@@ -25,6 +25,8 @@ Quarantine.prototype = {
         }
         if (data.navbar) {
             $("#bottom-bar-right").html(data.navbar);
+            /* Cursors are only valid for the pagination links */
+            this.navobj.delparam("after").delparam("before").delparam("total");
         }
         if (data.listing != undefined) {
             $("#listing").html(data.listing);
@@ -56,7 +58,8 @@ Quarantine.prototype = {
         e.preventDefault();
         var $link = $(e.target).parent();
 
-        this.navobj.delparam("rcpt");
+        this.navobj.delparam("rcpt").delparam("after").delparam("before")
+            .delparam("total");
         this.navobj.parse_string($link.attr("href")).update();
     },
 
@@ -0,0 +1,761 @@
+# coding: utf-8
+import sys
+import email
+import smtplib
+import threading
+import SocketServer
+from StringIO import StringIO
+from django.db import connections
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+from modoboa.lib import parameters
+from modoboa.lib.tests import ModoTestCase
+from modoboa.core.models import Extension, User
+from modoboa.core.extensions import exts_pool
+from modoboa.extensions.admin.models import Domain
+from modoboa.extensions.admin.factories import populate_database
+from modoboa.extensions.amavis import Amavis
+from . import lib
+from .lib import (
+    get_pending_requests, get_requests_version, bump_requests_version,
+    get_amrelease, get_message
+)
+from .sql_listing import (
+    SQLconnector, SQLWrapper, PgWrapper, get_wrapper, reverse_domain_name
+)
+from .management.commands.qcleanup import Command as QCleanupCommand
+from . import search
+from .management.commands import amnotify
+
+# amavis tables are not managed by Django: the tests create a
+# minimal version of them (see amavisd-new's README.sql)
+amavis_schema = [
+    """CREATE TABLE maddr (
+    partition_tag integer DEFAULT 0, id integer PRIMARY KEY,
+    email varchar(255) NOT NULL UNIQUE, domain varchar(255) NOT NULL)""",
+    """CREATE TABLE msgs (
+    partition_tag integer DEFAULT 0, mail_id varchar(12) PRIMARY KEY,
+    secret_id varchar(12) DEFAULT '', am_id varchar(20) NOT NULL,
+    time_num integer NOT NULL, time_iso char(16) NOT NULL,
+    sid integer NOT NULL, policy varchar(255) DEFAULT '',
+    client_addr varchar(255) DEFAULT '', size integer NOT NULL,
+    originating char(1) DEFAULT ' ', content char(1),
+    quar_type char(1), quar_loc varchar(255) DEFAULT '',
+    dsn_sent char(1), spam_level real, message_id varchar(255) DEFAULT '',
+    from_addr varchar(255) DEFAULT '', subject varchar(255) DEFAULT '',
+    host varchar(255) NOT NULL)""",
+    """CREATE TABLE msgrcpt (
+    partition_tag integer DEFAULT 0, mail_id varchar(12) NOT NULL,
+    rseqnum integer DEFAULT 0, rid integer NOT NULL,
+    is_local char(1) DEFAULT ' ', content char(1) DEFAULT ' ',
+    ds char(1) NOT NULL, rs char(1) NOT NULL, bl char(1) DEFAULT ' ',
+    wl char(1) DEFAULT ' ', bspam_level real,
+    smtp_resp varchar(255) DEFAULT '')""",
+    """CREATE TABLE quarantine (
+    partition_tag integer DEFAULT 0, mail_id varchar(12) NOT NULL,
+    chunk_ind integer NOT NULL, mail_text text NOT NULL)""",
+    "CREATE INDEX msgs_idx_sid ON msgs (sid)",
+    "CREATE INDEX msgs_idx_time_num ON msgs (time_num)",
+    "CREATE INDEX msgrcpt_idx_mail_id ON msgrcpt (mail_id)",
+    "CREATE INDEX msgrcpt_idx_rid ON msgrcpt (rid)",
+    "CREATE INDEX quarantine_idx_mail_id ON quarantine (mail_id)",
+]
+
+
+class AmavisMixin(object):
+    """Create a quarantine
+
+    Tables are created again for each test, so the amavis database
+    doesn't need to be flushed.
+    """
+
+    def create_quarantine(self):
+        cursor = connections["amavis"].cursor()
+        for table in ["msgterm", "quarantine", "msgrcpt", "msgs", "maddr"]:
+            cursor.execute("DROP TABLE IF EXISTS %s" % table)
+        for statement in amavis_schema:
+            cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO maddr (id, email, domain) VALUES "
+            "(1, 'sender@external.com', 'com.external'), "
+            "(2, 'user1@test.com', 'com.test'), "
+            "(3, 'user2@test.com', 'com.test')"
+        )
+        self.expected = []
+        for i in range(25):
+            mail_id = "mail%02d" % i
+            # Several messages share the same date
+            time_num = 1000 + (i / 3) * 60
+            cursor.execute(
+                "INSERT INTO msgs (mail_id, am_id, time_num, time_iso, sid, "
+                "size, content, from_addr, subject, host) "
+                "VALUES (%s, %s, %s, '', 1, 100, 'S', 'sender@external.com', "
+                "%s, 'localhost')",
+                [mail_id, mail_id, time_num, "Subject %d" % i]
+            )
+            cursor.execute(
+                "INSERT INTO quarantine (mail_id, chunk_ind, mail_text) "
+                "VALUES (%s, 1, 'content')", [mail_id]
+            )
+            for rid in [2, 3]:
+                cursor.execute(
+                    "INSERT INTO msgrcpt (mail_id, rid, content, ds, rs) "
+                    "VALUES (%s, %s, 'S', 'D', '')", [mail_id, rid]
+                )
+                self.expected += [(time_num, mail_id, rid)]
+        self.expected.sort(reverse=True)
+
+
+class AmavisTestCase(AmavisMixin, TestCase):
+
+    def setUp(self):
+        # The state of extensions may come from a rolled back test
+        exts_pool.invalidate()
+        self.create_quarantine()
+
+
+class QuarantineListingTestCase(AmavisTestCase):
+
+    def _keys(self, rows):
+        rcpts = {"user1@test.com": 2, "user2@test.com": 3}
+        return [(row["date"], row["mailid"], rcpts[row["to"]])
+                for row in rows]
+
+    def _fetch(self, start, stop, **kwargs):
+        connector = SQLconnector(**kwargs)
+        self.assertEqual(connector.messages_count(order="-date"), 50)
+        with self.assertNumQueries(1, using="amavis"):
+            rows = connector.fetch(start, stop)
+        return connector, self._keys(rows)
+
+    def test_offset_pagination(self):
+        connector, keys = self._fetch(11, 20)
+        self.assertEqual(keys, self.expected[10:20])
+        # Deep pages are read from the end of the listing
+        connector, keys = self._fetch(41, 50)
+        self.assertEqual(keys, self.expected[40:50])
+
+    def test_keyset_pagination(self):
+        connector, keys = self._fetch(1, 10)
+        self.assertEqual(keys, self.expected[:10])
+        for start in range(11, 51, 10):
+            connector, keys = self._fetch(
+                start, start + 9, after=connector.last_cursor
+            )
+            self.assertEqual(keys, self.expected[start - 1:start + 9])
+        for start in range(31, 0, -10):
+            connector, keys = self._fetch(
+                start, start + 9, before=connector.first_cursor
+            )
+            self.assertEqual(keys, self.expected[start - 1:start + 9])
+
+    def test_invalid_cursor(self):
+        connector, keys = self._fetch(1, 10, after="garbage")
+        self.assertEqual(keys, self.expected[:10])
+
+    def test_known_total(self):
+        connector, keys = self._fetch(1, 10)
+        # The total given with a cursor is not counted again
+        with self.assertNumQueries(1, using="amavis"):
+            self._fetch(11, 20, after=connector.last_cursor, total="50")
+        with self.assertNumQueries(2, using="amavis"):
+            self._fetch(1, 10, total="50")
+        with self.assertNumQueries(2, using="amavis"):
+            self._fetch(11, 20, after=connector.last_cursor, total="x")
+
+
+class DomainFilterTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(DomainFilterTestCase, self).setUp()
+        cursor = connections["amavis"].cursor()
+        cursor.execute(
+            "INSERT INTO maddr (id, email, domain) VALUES "
+            "(4, 'user@nottest.com', 'com.nottest')"
+        )
+        cursor.execute(
+            "INSERT INTO msgrcpt (mail_id, rid, content, ds, rs) "
+            "VALUES ('mail00', 4, 'S', 'D', 'p')"
+        )
+        cursor.execute("UPDATE msgrcpt SET rs='p' WHERE mail_id='mail01'")
+
+    def test_reverse_domain_name(self):
+        self.assertEqual(reverse_domain_name("Sub.Test.com"), "com.test.sub")
+
+    def test_domains_pending_requests(self):
+        wrapper = get_wrapper()
+        reqs = wrapper.get_domains_pending_requests([Domain(name="test.com")])
+        self.assertEqual(
+            sorted(reqs.values_list("rid__email", flat=True)),
+            ["user1@test.com", "user2@test.com"]
+        )
+        reqs = wrapper.get_domains_pending_requests(
+            [Domain(name="test.com"), Domain(name="nottest.com")]
+        )
+        self.assertEqual(reqs.count(), 3)
+        self.assertEqual(wrapper.get_domains_pending_requests([]).count(), 0)
+
+    def test_admin_without_domain(self):
+        from django.contrib.auth.models import Group
+        from django.test.client import RequestFactory
+
+        request = RequestFactory().get("/")
+        request.user = User.objects.create(username="dadmin")
+        request.user.groups.add(
+            Group.objects.get_or_create(name="DomainAdmins")[0]
+        )
+        for wrapper in [SQLWrapper(), PgWrapper()]:
+            connector = SQLconnector(mail_ids=wrapper.get_mails(request))
+            # No query is sent (PgWrapper used to send "IN ()")
+            with self.assertNumQueries(0, using="amavis"):
+                self.assertEqual(connector.messages_count(), 0)
+
+
+class PendingRequestsTestCase(AmavisMixin, ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(PendingRequestsTestCase, self).setUp()
+        Extension.objects.create(name="amavis", enabled=True)
+        Amavis().load()
+        self.create_quarantine()
+        connections["amavis"].cursor().execute(
+            "UPDATE msgrcpt SET rs='p' WHERE mail_id IN ('mail00', 'mail01')"
+        )
+        cache.clear()
+        self.user = User.objects.get(username="admin")
+
+    @override_settings(MODOBOA_SHARED_CACHE=True)
+    def test_cached_counter(self):
+        self.assertEqual(get_pending_requests(self.user), 4)
+        with self.assertNumQueries(0, using="amavis"):
+            self.assertEqual(get_pending_requests(self.user), 4)
+        connections["amavis"].cursor().execute(
+            "UPDATE msgrcpt SET rs='D' WHERE mail_id='mail00'"
+        )
+        version = get_requests_version()
+        self.assertNotEqual(bump_requests_version(), version)
+        self.assertEqual(get_pending_requests(self.user), 2)
+
+    @override_settings(MODOBOA_SHARED_CACHE=False)
+    def test_local_cache(self):
+        self.assertEqual(get_pending_requests(self.user), 4)
+        connections["amavis"].cursor().execute(
+            "UPDATE msgrcpt SET rs='D' WHERE mail_id='mail00'"
+        )
+        # Another process may have processed the request
+        self.assertEqual(get_pending_requests(self.user), 2)
+
+    def test_poller(self):
+        from modoboa.extensions.amavis import extra_static_content
+
+        parameters.save_admin("USER_CAN_RELEASE", "no", app="amavis")
+        with self.settings(MODOBOA_SHARED_CACHE=True):
+            content = extra_static_content(self.user)[0]
+        self.assertIn(
+            reverse("modoboa.extensions.amavis.views.requests_version"),
+            content
+        )
+        with self.settings(MODOBOA_SHARED_CACHE=False):
+            content = extra_static_content(self.user)[0]
+        self.assertNotIn(
+            reverse("modoboa.extensions.amavis.views.requests_version"),
+            content
+        )
+
+    @override_settings(MODOBOA_SHARED_CACHE=True)
+    def test_views(self):
+        version = get_requests_version()
+        response = self.clt.get(
+            reverse("modoboa.extensions.amavis.views.requests_version")
+        )
+        self.assertEqual(simplejson.loads(response.content),
+                         {"status": "ok", "version": version})
+        url = reverse("modoboa.extensions.amavis.views.nbrequests")
+        response = self.clt.get(url)
+        self.assertEqual(simplejson.loads(response.content)["requests"], 4)
+        with self.assertNumQueries(0, using="amavis"):
+            self.clt.get(url)
+
+    @override_settings(MODOBOA_SHARED_CACHE=False)
+    def test_views_local_cache(self):
+        response = self.clt.get(
+            reverse("modoboa.extensions.amavis.views.requests_version")
+        )
+        self.assertEqual(response.status_code, 404)
+        url = reverse("modoboa.extensions.amavis.views.nbrequests")
+        response = self.clt.get(url)
+        self.assertEqual(simplejson.loads(response.content)["requests"], 4)
+        connections["amavis"].cursor().execute(
+            "UPDATE msgrcpt SET rs='D' WHERE mail_id='mail00'"
+        )
+        with self.assertNumQueries(1, using="amavis"):
+            response = self.clt.get(url)
+        self.assertEqual(simplejson.loads(response.content)["requests"], 2)
+
+
+class QCleanupTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(QCleanupTestCase, self).setUp()
+        cursor = connections["amavis"].cursor()
+        cursor.execute("UPDATE msgrcpt SET rs='D' WHERE mail_id='mail10'")
+        cursor.execute(
+            "UPDATE msgrcpt SET rs='D' WHERE mail_id='mail11' AND rid=2"
+        )
+        cursor.execute(
+            "INSERT INTO maddr (id, email, domain) VALUES "
+            "(4, 'unused@test.com', 'com.test')"
+        )
+
+    def _count(self, table):
+        cursor = connections["amavis"].cursor()
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        return cursor.fetchone()[0]
+
+    def test_cleanup(self):
+        expected = {"msgs": 4, "msgrcpt": 8, "quarantine": 4, "maddr": 1}
+        # Messages older than 1060 (mail00 to mail02) and mail10
+        result = QCleanupCommand().cleanup(["D"], 1060, 120, dry_run=True)
+        self.assertEqual(result, expected)
+        self.assertEqual(self._count("msgs"), 25)
+
+        result = QCleanupCommand().cleanup(["D"], 1060, 120)
+        self.assertEqual(result, expected)
+        self.assertEqual(self._count("msgs"), 21)
+        self.assertEqual(self._count("msgrcpt"), 42)
+        self.assertEqual(self._count("quarantine"), 21)
+        self.assertEqual(self._count("maddr"), 3)
+        cursor = connections["amavis"].cursor()
+        cursor.execute("SELECT rs FROM msgrcpt WHERE mail_id='mail11'")
+        self.assertEqual(sorted(row[0] for row in cursor.fetchall()),
+                         ["", "D"])
+
+    def test_cleanup_sparse(self):
+        connections["amavis"].cursor().execute(
+            "INSERT INTO msgs (mail_id, am_id, time_num, time_iso, sid, "
+            "size, content, from_addr, subject, host) "
+            "VALUES ('outlier', 'outlier', 0, '', 1, 100, 'S', "
+            "'sender@external.com', 'Outlier', 'localhost')"
+        )
+        ranges = []
+
+        class Command(QCleanupCommand):
+            def delete_messages(self, mail_ids, dry_run):
+                ranges.append(len(mail_ids))
+                return super(Command, self).delete_messages(mail_ids, dry_run)
+
+        result = Command().cleanup(["D"], 1060, 1, dry_run=True)
+        self.assertEqual(result["msgs"], 5)
+        # One range per distinct date, empty ones are skipped
+        self.assertEqual(len(ranges), 10)
+
+
+class SearchIndexTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(SearchIndexTestCase, self).setUp()
+        search.create_table()
+        cursor = connections["amavis"].cursor()
+        cursor.execute(
+            "UPDATE msgs SET subject='Meeting report', "
+            "from_addr='Boss <boss@corp.example.com>' WHERE mail_id='mail05'"
+        )
+        # Still being processed by amavis
+        cursor.execute("UPDATE msgs SET content=NULL WHERE mail_id='mail06'")
+
+    def _search(self, pattern, criteria):
+        connector = SQLconnector(filter=search.get_search_filter(pattern, criteria))
+        count = connector.messages_count(order="-date")
+        if not count:
+            return []
+        return sorted(set(row["mailid"] for row in connector.fetch(1, count)))
+
+    def test_tokenize(self):
+        self.assertEqual(
+            search.tokenize("John Doe <John.Doe@Example.com>"),
+            set([u"john", u"doe", u"example", u"com", u"john.doe@example.com"])
+        )
+        self.assertEqual(search.tokenize(None), set())
+
+    def test_index(self):
+        self.assertTrue(search.table_exists())
+        indexer = search.Indexer(batch=10)
+        self.assertEqual(indexer.index_batch(), 10)
+        self.assertEqual(indexer.run(), 14)
+        self.assertEqual(indexer.run(), 0)
+
+        self.assertEqual(self._search("meet", ["subject"]), ["mail05"])
+        self.assertEqual(self._search("REPORT meeting", ["subject"]), ["mail05"])
+        self.assertEqual(self._search("report other", ["subject"]), [])
+        self.assertEqual(self._search("corp.example", ["subject"]), [])
+        self.assertEqual(self._search("corp.example", ["from_addr", "subject"]),
+                         ["mail05"])
+        self.assertEqual(len(self._search("user1@test", ["to"])), 24)
+        self.assertRaises(Exception, search.get_search_filter, "x", ["body"])
+        # Patterns without terms match nothing
+        self.assertEqual(self._search("@", ["subject"]), [])
+        self.assertEqual(self._search("?!", ["from_addr", "to"]), [])
+
+    def test_checkpoint(self):
+        self.assertEqual(search.Indexer().checkpoint(), 0)
+        search.Indexer().run()
+        cursor = connections["amavis"].cursor()
+        cursor.execute("SELECT MAX(time_num) FROM msgs WHERE content IS NOT NULL")
+        last = cursor.fetchone()[0]
+        margin = search.checkpoint_margin
+        search.checkpoint_margin = 60
+        try:
+            indexer = search.Indexer()
+            self.assertEqual(indexer.checkpoint(), last - 60)
+            self.assertEqual(indexer.run(), 0)
+            self.assertEqual(indexer.since, last - 60)
+        finally:
+            search.checkpoint_margin = margin
+
+    def test_cleanup(self):
+        search.Indexer().run()
+        QCleanupCommand().cleanup(["D"], 1060, 120)
+        cursor = connections["amavis"].cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM msgterm WHERE mail_id IN "
+            "('mail00', 'mail01', 'mail02')"
+        )
+        self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertEqual(self._search("subject", ["subject"]),
+                         ["mail%02d" % i for i in range(3, 25)
+                          if i not in (5, 6)])
+
+
+class FakePDPHandler(SocketServer.StreamRequestHandler):
+    """Answer release requests like amavisd-new's AM.PDP server"""
+
+    def handle(self):
+        self.server.connections += 1
+        request = {}
+        nbrequests = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip("\r\n")
+            if line:
+                name, value = line.split("=", 1)
+                request[name] = value
+                continue
+            self.server.requests.append(request)
+            if request["mail_id"] in self.server.failures:
+                self.wfile.write("setreply=450%204.5.0%20Failure\n\n")
+            else:
+                # Send the answer in two pieces
+                self.wfile.write("setreply=250%202.5.0%20Ok,%20id=rel-")
+                self.wfile.write("%s\nreturn_value=0\n\n" % request["mail_id"])
+            request = {}
+            nbrequests += 1
+            if nbrequests == self.server.max_requests:
+                return
+
+
+class FakePDPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(
+            self, ("127.0.0.1", 0), FakePDPHandler
+        )
+        self.connections = 0
+        self.requests = []
+        self.failures = set()
+        self.max_requests = None
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class AMreleaseTestCase(AmavisMixin, ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(AMreleaseTestCase, self).setUp()
+        Extension.objects.create(name="amavis", enabled=True)
+        Amavis().load()
+        self.create_quarantine()
+        self.server = FakePDPServer()
+        parameters.save_admin("AM_PDP_MODE", "inet", app="amavis")
+        parameters.save_admin("AM_PDP_HOST", "127.0.0.1", app="amavis")
+        parameters.save_admin(
+            "AM_PDP_PORT", self.server.server_address[1], app="amavis"
+        )
+
+    def tearDown(self):
+        lib._local.amrelease = None
+        self.server.stop()
+
+    def test_pipelining(self):
+        self.server.failures.add("mail01")
+        amr = get_amrelease()
+        requests = [("mail%02d" % i, "secret", "user1@test.com")
+                    for i in range(120)]
+        results = amr.sendreqs(requests)
+        self.assertEqual(results, [i != 1 for i in range(120)])
+        self.assertEqual(len(self.server.requests), 120)
+        self.assertEqual(self.server.requests[2], {
+            "request": "release", "mail_id": "mail02",
+            "secret_id": "secret", "quar_type": "Q",
+            "recipient": "user1@test.com"
+        })
+        # The connection is kept for the next calls
+        self.assertIs(get_amrelease(), amr)
+        self.assertEqual(amr.sendreq("mail00", "secret", "a b@test.com"), True)
+        self.assertEqual(self.server.requests[-1]["recipient"], "a%20b@test.com")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnection(self):
+        self.server.max_requests = 1
+        amr = get_amrelease()
+        self.assertEqual(amr.sendreq("mail00", "secret", "user1@test.com"), True)
+        self.assertEqual(amr.sendreq("mail01", "secret", "user1@test.com"), True)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_release_view(self):
+        self.server.failures.add("mail01")
+        response = self.clt.post(
+            reverse("modoboa.extensions.amavis.views.process"),
+            {"action": "release",
+             "selection": "user1@test.com mail00,user2@test.com mail00,"
+             "user1@test.com mail01"},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        self.assertEqual(simplejson.loads(response.content)["status"], "ko")
+        cursor = connections["amavis"].cursor()
+        cursor.execute(
+            "SELECT mail_id, rid, rs FROM msgrcpt "
+            "WHERE mail_id IN ('mail00', 'mail01') ORDER BY mail_id, rid"
+        )
+        self.assertEqual(cursor.fetchall(), [
+            ("mail00", 2, "R"), ("mail00", 3, "R"),
+            ("mail01", 2, ""), ("mail01", 3, "")
+        ])
+
+    def test_delete_view(self):
+        response = self.clt.post(
+            reverse("modoboa.extensions.amavis.views.process"),
+            {"action": "delete", "selection": "user1@test.com mail00"},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        self.assertEqual(simplejson.loads(response.content)["status"], "ok")
+        cursor = connections["amavis"].cursor()
+        cursor.execute(
+            "SELECT rid, rs FROM msgrcpt WHERE mail_id='mail00' ORDER BY rid"
+        )
+        # Other recipients of the message are not modified
+        self.assertEqual(cursor.fetchall(), [(2, "D"), (3, "")])
+
+
+class MessageReaderTestCase(AmavisTestCase):
+
+    def setUp(self):
+        super(MessageReaderTestCase, self).setUp()
+        cache.clear()
+        self.content = "From: sender@external.com\r\nTo: user1@test.com\r\n" \
+            "Subject: Test\r\n\r\n" + "Body line\r\n" * 100
+        # The headers separator is split between the second and third chunks
+        chunks = [self.content[:30], self.content[30:62],
+                  self.content[62:500], self.content[500:]]
+        cursor = connections["amavis"].cursor()
+        cursor.execute("DELETE FROM quarantine WHERE mail_id='mail00'")
+        for idx, chunk in reversed(list(enumerate(chunks))):
+            cursor.execute(
+                "INSERT INTO quarantine (mail_id, chunk_ind, mail_text) "
+                "VALUES ('mail00', %s, %s)", [idx + 1, chunk]
+            )
+
+    def test_headers(self):
+        with self.assertNumQueries(3, using="amavis"):
+            msg = get_message("mail00", headers_only=True)
+        self.assertEqual(msg["Subject"], "Test")
+        self.assertEqual(msg.get_payload(), "")
+        with self.assertNumQueries(0, using="amavis"):
+            get_message("mail00", headers_only=True)
+
+    def test_message(self):
+        with self.assertNumQueries(1, using="amavis"):
+            msg = get_message("mail00")
+        self.assertEqual(msg.as_string(),
+                         email.message_from_string(self.content).as_string())
+        with self.assertNumQueries(0, using="amavis"):
+            self.assertEqual(get_message("mail00")["To"], "user1@test.com")
+            get_message("mail00", headers_only=True)
+
+    def test_big_message(self):
+        """Check that big messages are not cached."""
+        max_size = lib.message_max_size
+        lib.message_max_size = 100
+        try:
+            get_message("mail00")
+            with self.assertNumQueries(1, using="amavis"):
+                msg = get_message("mail00")
+        finally:
+            lib.message_max_size = max_size
+        self.assertEqual(msg["Subject"], "Test")
+
+
+class FakeSMTP(object):
+    """Record messages instead of sending them"""
+    instances = []
+
+    def __init__(self, host, port):
+        self.messages = []
+        self.closed = False
+        self.instances.append(self)
+
+    def sendmail(self, sender, rcpts, msgstring):
+        self.messages.append((sender, rcpts, msgstring))
+
+    def noop(self):
+        pass
+
+    def quit(self):
+        self.closed = True
+
+
+class DisconnectingSMTP(FakeSMTP):
+    """Simulate a server closing the connection on the first message
+
+    Only the first ``disconnections`` connections are closed.
+    """
+    disconnections = 1
+
+    def __init__(self, host, port):
+        super(DisconnectingSMTP, self).__init__(host, port)
+        self.disconnected = False
+        self.failing = len(self.instances) <= self.disconnections
+
+    def sendmail(self, sender, rcpts, msgstring):
+        if self.failing:
+            self.disconnected = True
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        super(DisconnectingSMTP, self).sendmail(sender, rcpts, msgstring)
+
+    def noop(self):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+
+    def quit(self):
+        self.noop()
+        super(DisconnectingSMTP, self).quit()
+
+
+class AmnotifyTestCase(AmavisTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(AmnotifyTestCase, self).setUp()
+        populate_database()
+        cursor = connections["amavis"].cursor()
+        cursor.execute(
+            "INSERT INTO maddr (id, email, domain) VALUES "
+            "(4, 'user@test2.com', 'com.test2')"
+        )
+        cursor.execute(
+            "INSERT INTO msgrcpt (mail_id, rid, content, ds, rs) "
+            "VALUES ('mail03', 4, 'S', 'D', 'p')"
+        )
+        cursor.execute(
+            "UPDATE msgrcpt SET rs='p' WHERE mail_id IN ('mail00', 'mail01')"
+        )
+        self.command = amnotify.Command()
+        self.command.options = {
+            "baseurl": "http://localhost", "smtp_host": "localhost",
+            "smtp_port": 25, "dry_run": False, "verbose": False
+        }
+        self.command.sender = "notification@modoboa.org"
+        FakeSMTP.instances = []
+
+    def _send(self, smtp_class):
+        self.command.render_notification = lambda reqs: "%d" % reqs.total
+        smtp = amnotify.smtplib.SMTP
+        amnotify.smtplib.SMTP = smtp_class
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            sent = self.command.send_notifications(
+                self.command.get_notifications()
+            )
+        finally:
+            sys.stdout = stdout
+            amnotify.smtplib.SMTP = smtp
+        return sent
+
+    def test_notifications(self):
+        with self.assertNumQueries(1, using="amavis"):
+            with self.assertNumQueries(6):
+                notifications = self.command.get_notifications()
+        self.assertEqual(
+            [(rcpt, reqs.total) for rcpt, reqs in notifications],
+            [("admin@test.com", 4), ("admin@test2.com", 1)]
+        )
+        # mail00 and mail01 have the same date
+        self.assertEqual(
+            sorted(req.mail_id for req in notifications[0][1].sample),
+            ["mail00", "mail00", "mail01", "mail01"]
+        )
+
+    def test_send(self):
+        smtp = amnotify.smtplib.SMTP
+        amnotify.smtplib.SMTP = FakeSMTP
+        try:
+            sent = self.command.send_notifications(
+                self.command.get_notifications()
+            )
+        finally:
+            amnotify.smtplib.SMTP = smtp
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(FakeSMTP.instances), 1)
+        self.assertEqual(FakeSMTP.instances[0].closed, True)
+        self.assertEqual(
+            [rcpts for sender, rcpts, msg in FakeSMTP.instances[0].messages],
+            [["admin@test.com"], ["admin@test2.com"]]
+        )
+
+    def test_connection_error(self):
+        # Nothing listens on this port
+        self.command.options.update(smtp_host="127.0.0.1", smtp_port=1)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            sent = self.command.send_notifications(
+                self.command.get_notifications()
+            )
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(sent, 0)
+        self.assertTrue(output.startswith("SMTP error:"))
+
+    def test_reconnect(self):
+        self.assertEqual(self._send(DisconnectingSMTP), 2)
+        self.assertEqual(len(FakeSMTP.instances), 2)
+        self.assertEqual(FakeSMTP.instances[1].closed, True)
+        self.assertEqual(
+            [rcpts for sender, rcpts, msg in FakeSMTP.instances[1].messages],
+            [["admin@test.com"], ["admin@test2.com"]]
+        )
+
+    def test_reconnect_once(self):
+        DisconnectingSMTP.disconnections = 2
+        try:
+            # quit() fails too but must not raise
+            self.assertEqual(self._send(DisconnectingSMTP), 0)
+        finally:
+            DisconnectingSMTP.disconnections = 1
+        self.assertEqual(len(FakeSMTP.instances), 2)
@@ -7,6 +7,7 @@ urlpatterns = patterns(
     (r'^getmailcontent/(?P<mail_id>[\w\-\+]+)/$', 'getmailcontent'),
     (r'^process/$', 'process'),
     (r'^nbrequests/$', 'nbrequests'),
+    (r'^requests_version/$', 'requests_version'),
     (r'^delete/(?P<mail_id>[\w\-\+]+)/$', 'delete'),
     (r'^release/(?P<mail_id>[\w\-\+]+)/$', 'release'),
     (r'^(?P<mail_id>[\w\-\+]+)/$', 'viewmail'),
@@ -1,5 +1,4 @@
 # coding: utf-8
-import email
 from django.shortcuts import render
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.template import Template, Context
@@ -9,7 +8,7 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators \
     import login_required, user_passes_test
 from django.db.models import Q
-from modoboa.lib import parameters
+from modoboa.lib import parameters, cacheutils
 from modoboa.lib.exceptions import ModoboaException
 from modoboa.lib.webutils import (
     getctx, ajax_response, ajax_simple_response
@@ -17,9 +16,13 @@ from modoboa.lib.webutils import (
 from modoboa.lib.email_listing import parse_search_parameters
 from modoboa.extensions.admin.models import Mailbox, Domain
 from templatetags.amavis_tags import quar_menu, viewm_menu
-from .lib import selfservice, AMrelease
+from .lib import (
+    selfservice, get_amrelease, bump_requests_version, get_requests_version,
+    get_pending_requests, get_message
+)
 from .sql_listing import SQLlisting, SQLemail, get_wrapper
 from .models import Msgrcpt
+from .search import get_search_filter
 
 
 def __back_to_listing(request):
@@ -70,17 +73,22 @@ def _listing(request):
         criteria = request.session["criteria"]
         if criteria == "both":
             criteria = "from_addr,subject,to"
-        for c in criteria.split(","):
-            if c == "from_addr":
-                nfilter = Q(mail__from_addr__contains=request.session["pattern"])
-            elif c == "subject":
-                nfilter = Q(mail__subject__contains=request.session["pattern"])
-            elif c == "to":
-                rcptfilter = request.session["pattern"]
-                continue
-            else:
-                raise Exception("unsupported search criteria %s" % c)
-            flt = nfilter if flt is None else flt | nfilter
+        if isinstance(criteria, basestring):
+            criteria = criteria.split(",")
+        if parameters.get_admin("SEARCH_INDEX") == "yes":
+            flt = get_search_filter(request.session["pattern"], criteria)
+        else:
+            for c in criteria:
+                if c == "from_addr":
+                    nfilter = Q(mail__from_addr__contains=request.session["pattern"])
+                elif c == "subject":
+                    nfilter = Q(mail__subject__contains=request.session["pattern"])
+                elif c == "to":
+                    rcptfilter = request.session["pattern"]
+                    continue
+                else:
+                    raise Exception("unsupported search criteria %s" % c)
+                flt = nfilter if flt is None else flt | nfilter
 
     msgs = get_wrapper().get_mails(request, rcptfilter)
 
@@ -94,6 +102,9 @@ def _listing(request):
 
     lst = SQLlisting(
         request.user, msgs, flt,
+        after=request.GET.get("after", None),
+        before=request.GET.get("before", None),
+        total=request.GET.get("total", None),
         navparams=request.session["navparams"],
         elems_per_page=int(parameters.get_user(request.user, "MESSAGES_PER_PAGE"))
     )
@@ -102,6 +113,7 @@ def _listing(request):
         return empty_quarantine(request)
 
     content = lst.fetch(request, page.id_start, page.id_stop)
+    lst.set_cursors(page)
     navbar = lst.render_navbar(page, "listing/?")
     ctx = getctx("ok", listing=content, navbar=navbar,
                  menu=quar_menu(request.user))
@@ -116,12 +128,7 @@ def index(request):
 
 
 def getmailcontent_selfservice(request, mail_id):
-    qmails = get_wrapper().get_mail_content(mail_id)
-    content = ""
-    for qm in qmails:
-        content += qm.mail_text
-    msg = email.message_from_string(content)
-    mail = SQLemail(msg, mformat="plain", links="0")
+    mail = SQLemail(get_message(mail_id), mformat="plain", links="0")
     return render(request, "common/viewmail.html", {
         "headers": mail.render_headers(),
         "mailbody": mail.body
@@ -130,12 +137,7 @@ def getmailcontent_selfservice(request, mail_id):
 
 @selfservice(getmailcontent_selfservice)
 def getmailcontent(request, mail_id):
-    qmails = get_wrapper().get_mail_content(mail_id)
-    content = ""
-    for qm in qmails:
-        content += qm.mail_text
-    msg = email.message_from_string(content)
-    mail = SQLemail(msg, mformat="plain", links="0")
+    mail = SQLemail(get_message(mail_id), mformat="plain", links="0")
     return render(request, "common/viewmail.html", {
         "headers": mail.render_headers(),
         "mailbody": mail.body
@@ -167,9 +169,9 @@ def viewmail(request, mail_id):
     if request.user.mailbox_set.count():
         mb = Mailbox.objects.get(user=request.user)
         if not rcpt or rcpt == mb.full_address:
-            msgrcpt = get_wrapper().get_recipient_message(mb.full_address, mail_id)
-            msgrcpt.rs = 'V'
-            msgrcpt.save()
+            wrapper = get_wrapper()
+            msgrcpt = wrapper.get_recipient_message(mb.full_address, mail_id)
+            wrapper.set_recipients_status([msgrcpt], 'V')
 
     content = Template("""
 <iframe src="{{ url }}" id="mailcontent"></iframe>
@@ -181,10 +183,7 @@ def viewmail(request, mail_id):
 
 @login_required
 def viewheaders(request, mail_id):
-    content = ""
-    for qm in get_wrapper().get_mail_content(mail_id):
-        content += qm.mail_text
-    msg = email.message_from_string(content)
+    msg = get_message(mail_id, headers_only=True)
     return render(request, 'amavis/viewheader.html', {
         "headers": msg.items()
     })
@@ -203,32 +202,32 @@ def delete_selfservice(request, mail_id):
     rcpt = request.GET.get("rcpt", None)
     if rcpt is None:
         raise ModoboaException(_("Invalid request"))
+    wrapper = get_wrapper()
     try:
-        msgrcpt = get_wrapper().get_recipient_message(rcpt, mail_id)
-        msgrcpt.rs = 'D'
-        msgrcpt.save()
+        msgrcpt = wrapper.get_recipient_message(rcpt, mail_id)
     except Msgrcpt.DoesNotExist:
         raise ModoboaException(_("Invalid request"))
+    wrapper.set_recipients_status([msgrcpt], 'D')
+    bump_requests_version()
     return ajax_simple_response(dict(status="ok", respmsg=_("Message deleted")))
 
 
 @selfservice(delete_selfservice)
 def delete(request, mail_id):
     mail_id = check_mail_id(request, mail_id)
+    wrapper = get_wrapper()
     if request.user.group == 'SimpleUsers':
         mb = Mailbox.objects.get(user=request.user)
-        msgrcpts = get_wrapper().get_recipient_messages(mb.full_address, mail_id)
-        #msgrcpts.update(rs='D')
-        for msgrcpt in msgrcpts:
-            msgrcpt.rs = 'D'
-            msgrcpt.save()
+        msgrcpts = list(
+            wrapper.get_recipient_messages(mb.full_address, mail_id)
+        )
     else:
-        wrapper = get_wrapper()
+        msgrcpts = []
         for mid in mail_id:
             r, i = mid.split()
-            msgrcpt = wrapper.get_recipient_message(r, i)
-            msgrcpt.rs = 'D'
-            msgrcpt.save()
+            msgrcpts += [wrapper.get_recipient_message(r, i)]
+    wrapper.set_recipients_status(msgrcpts, 'D')
+    bump_requests_version()
 
     message = ungettext("%(count)d message deleted successfully",
                         "%(count)d messages deleted successfully",
@@ -242,24 +241,25 @@ def release_selfservice(request, mail_id):
     secret_id = request.GET.get("secret_id", None)
     if rcpt is None or secret_id is None:
         raise ModoboaException(_("Invalid request"))
+    wrapper = get_wrapper()
     try:
-        msgrcpt = get_wrapper().get_recipient_message(rcpt, mail_id)
+        msgrcpt = wrapper.get_recipient_message(rcpt, mail_id)
     except Msgrcpt.DoesNotExist:
         raise ModoboaException(_("Invalid request"))
     if secret_id != msgrcpt.mail.secret_id:
         raise ModoboaException(_("Invalid request"))
     if parameters.get_admin("USER_CAN_RELEASE") == "no":
-        msgrcpt.rs = 'p'
+        status = 'p'
         msg = _("Request sent")
     else:
-        amr = AMrelease()
-        result = amr.sendreq(mail_id, secret_id, rcpt)
+        result = get_amrelease().sendreq(mail_id, secret_id, rcpt)
         if result:
-            rcpt.rs = 'R'
+            status = 'R'
             msg = _("Message released")
         else:
-            raise ModoboaException(result)
-    msgrcpt.save()
+            raise ModoboaException(_("Failed to release message"))
+    wrapper.set_recipients_status([msgrcpt], status)
+    bump_requests_version()
     return ajax_simple_response(dict(status="ok", respmsg=msg))
 
 
@@ -268,16 +268,12 @@ def release(request, mail_id):
     mail_id = check_mail_id(request, mail_id)
     if request.user.group == 'SimpleUsers':
         mb = Mailbox.objects.get(user=request.user)
-        msgrcpts = get_wrapper().get_recipient_messages(mb.full_address, mail_id)
+        msgrcpts = list(
+            get_wrapper().get_recipient_messages(mb.full_address, mail_id)
+        )
         if parameters.get_admin("USER_CAN_RELEASE") == "no":
-            # FIXME : can't use this syntax because extra SQL (using
-            # .extra() for postgres) is not propagated (the 'tables'
-            # parameter is lost somewhere...)
-            #
-            # msgrcpts.update(rs='p')
-            for msgrcpt in msgrcpts:
-                msgrcpt.rs = 'p'
-                msgrcpt.save()
+            get_wrapper().set_recipients_status(msgrcpts, 'p')
+            bump_requests_version()
             message = ungettext("%(count)d request sent",
                                 "%(count)d requests sent",
                                 len(mail_id)) % {"count": len(mail_id)}
@@ -290,23 +286,24 @@ def release(request, mail_id):
             r, i = mid.split()
             msgrcpts += [wrapper.get_recipient_message(r, i)]
 
-    amr = AMrelease()
-    error = None
-    for rcpt in msgrcpts:
-        result = amr.sendreq(rcpt.mail.mail_id, rcpt.mail.secret_id, rcpt.rid.email)
-        if result:
-            rcpt.rs = 'R'
-            rcpt.save()
-        else:
-            error = result
-            break
+    results = get_amrelease().sendreqs([
+        (rcpt.mail.mail_id, rcpt.mail.secret_id, rcpt.rid.email)
+        for rcpt in msgrcpts
+    ])
+    released = [rcpt for rcpt, result in zip(msgrcpts, results) if result]
+    get_wrapper().set_recipients_status(released, 'R')
+    bump_requests_version()
 
+    error = len(released) != len(msgrcpts)
     if not error:
         message = ungettext("%(count)d message released successfully",
                             "%(count)d messages released successfully",
                             len(mail_id)) % {"count": len(mail_id)}
     else:
-        message = error
+        nbfailures = len(msgrcpts) - len(released)
+        message = ungettext("%(count)d message could not be released",
+                            "%(count)d messages could not be released",
+                            nbfailures) % {"count": nbfailures}
     return ajax_response(request, "ko" if error else "ok", respmsg=message,
                          url=__back_to_listing(request))
 
@@ -328,5 +325,21 @@ def process(request):
 @login_required
 @user_passes_test(lambda u: u.group != 'SimpleUsers')
 def nbrequests(request):
-    result = get_wrapper().get_pending_requests(request.user)
+    result = get_pending_requests(request.user)
     return ajax_simple_response(dict(status="ok", requests=result))
+
+
+@login_required
+@user_passes_test(lambda u: u.group != 'SimpleUsers')
+def requests_version(request):
+    """Return the current version of release requests
+
+    This view doesn't query the amavis database: pollers only ask for
+    the number of pending requests when the version changes. Versions
+    are only meaningful if the cache is shared by all processes.
+    """
+    if not cacheutils.is_shared():
+        raise Http404
+    return ajax_simple_response(
+        dict(status="ok", version=get_requests_version())
+    )
@@ -80,7 +80,7 @@ def menu(target, user):
     ]
 
 
-@events.observe("CreateDomain")
+@events.observe("CreateDomain", async=True)
 def onCreateDomain(user, domain):
     transport = Transport()
     transport.domain = "autoreply.%s" % domain.name
@@ -88,7 +88,7 @@ def onCreateDomain(user, domain):
     transport.save()
 
 
-@events.observe("DomainModified")
+@events.observe("DomainModified", async=True)
 def onDomainModified(domain):
     if domain.oldname == domain.name:
         return
@@ -101,7 +101,7 @@ def onDomainModified(domain):
         al.save()
 
 
-@events.observe("DeleteDomain")
+@events.observe("DeleteDomain", async=True)
 def onDeleteDomain(domain):
     Transport.objects.filter(domain="autoreply.%s" % domain.name).delete()
 
@@ -46,7 +46,15 @@ def menu(target, user):
 
 @events.observe("GetGraphSets")
 def get_default_graph_sets():
-    from modoboa.extensions.stats.graph_templates import MailTraffic
-
-    gset = MailTraffic()
-    return {gset.html_id: gset}
+    from modoboa.extensions.stats.graph_templates import (
+        MailTraffic, Latency, ContentFilter
+    )
+
+    gsets = [MailTraffic(), ContentFilter()]
+    # Latencies are only recorded by the SQLite store
+    if parameters.get_admin("SQLITE_STORE", app="stats") == "yes":
+        gsets.insert(1, Latency())
+    result = {}
+    for gset in gsets:
+        result[gset.html_id] = gset
+    return result
@@ -2,7 +2,7 @@
 from django.utils.translation import ugettext_lazy
 from django import forms
 from modoboa.lib.parameters import AdminParametersForm
-from modoboa.lib.formutils import SeparatorField
+from modoboa.lib.formutils import SeparatorField, YesNoField
 
 
 class ParametersForm(AdminParametersForm):
@@ -25,5 +25,29 @@ class ParametersForm(AdminParametersForm):
     img_rootdir = forms.CharField(
         label=ugettext_lazy("Directory to store PNG files"),
         initial="/tmp/modoboa",
-        help_text=ugettext_lazy("Path to directory where PNG files are stored")
+        help_text=ugettext_lazy("Path to directory where rendered PNG files are cached")
     )
+
+    rrdcached_address = forms.CharField(
+        label=ugettext_lazy("RRDcached address"),
+        initial="",
+        help_text=ugettext_lazy("Address of a rrdcached daemon used to coalesce RRD updates (for example unix:/var/run/rrdcached.sock). Leave empty to update RRD files directly"),
+        required=False
+    )
+
+    sqlite_store = YesNoField(
+        label=ugettext_lazy("Enable the SQLite store"),
+        initial="no",
+        help_text=ugettext_lazy("Also record statistics into a SQLite database (faster range queries and rankings over many domains)")
+    )
+
+    sqlite_path = forms.CharField(
+        label=ugettext_lazy("Path to the SQLite database"),
+        initial="/tmp/modoboa/stats.db",
+        help_text=ugettext_lazy("Path to the SQLite database used to store statistics"),
+        required=False
+    )
+
+    visibility_rules = {
+        "sqlite_path": "sqlite_store=yes"
+    }
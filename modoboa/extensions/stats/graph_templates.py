@@ -7,6 +7,9 @@ class Graph(object):
     width = 540
     height = 120
     cf = 'AVERAGE'
+    # Kind of latency histogram (see histograms.py) the graph is built
+    # from, None for counters
+    histogram = None
 
     def __init__(self, **ds):
         self.vars = {}
@@ -57,6 +60,50 @@ class AvgTrafficSize(Graph):
         )
 
 
+class AvgFilteredTraffic(Graph):
+    title = ugettext_lazy('Average filtered traffic')
+    vertlabel = ugettext_lazy('msgs/min')
+
+    def __init__(self):
+        super(AvgFilteredTraffic, self).__init__(
+            spam={'type': 'AREA', 'color': '#FF9900',
+                  "legend": ugettext_lazy("spam messages")},
+            virus={"type": "AREA", "color": "#FF0000",
+                   "legend": ugettext_lazy("infected messages")}
+        )
+
+
+class PercentilesGraph(Graph):
+
+    def __init__(self):
+        super(PercentilesGraph, self).__init__(
+            p50={"type": "LINE", "color": "#00AA00",
+                 "legend": ugettext_lazy("median")},
+            p95={"type": "LINE", "color": "#FF9900",
+                 "legend": ugettext_lazy("95th percentile")},
+            p99={"type": "LINE", "color": "#FF0000",
+                 "legend": ugettext_lazy("99th percentile")}
+        )
+
+
+class QueueLatency(PercentilesGraph):
+    title = ugettext_lazy('Queue time')
+    vertlabel = ugettext_lazy('seconds')
+    histogram = "queue"
+
+
+class DeliveryLatency(PercentilesGraph):
+    title = ugettext_lazy('Delivery time')
+    vertlabel = ugettext_lazy('seconds')
+    histogram = "delivery"
+
+
+class SpamScores(PercentilesGraph):
+    title = ugettext_lazy('Spam scores')
+    vertlabel = ugettext_lazy('score')
+    histogram = "spam_score"
+
+
 class GraphSet(object):
     title = None
     graphs = []
@@ -77,3 +124,13 @@ class GraphSet(object):
 class MailTraffic(GraphSet):
     title = ugettext_lazy('Mail traffic')
     graphs = [AvgTraffic, AvgBadTraffic, AvgTrafficSize]
+
+
+class Latency(GraphSet):
+    title = ugettext_lazy('Latency')
+    graphs = [QueueLatency, DeliveryLatency]
+
+
+class ContentFilter(GraphSet):
+    title = ugettext_lazy('Content filtering')
+    graphs = [AvgFilteredTraffic, SpamScores]
@@ -1,14 +1,23 @@
 # coding: utf-8
 import sys
 import os
+import glob
 import time
+from django.utils import translation
 from django.utils.translation import ugettext as _, ugettext_lazy
 from modoboa.lib import parameters
 
-periods = [{"name": "day", "label": ugettext_lazy("Day")},
-           {"name": "week", "label": ugettext_lazy("Week")},
-           {"name": "month", "label": ugettext_lazy("Month")},
-           {"name": "year", "label": ugettext_lazy("Year")}]
+periods = [{"name": "day", "label": ugettext_lazy("Day"),
+            "duration": 3600 * 24},
+           {"name": "week", "label": ugettext_lazy("Week"),
+            "duration": 3600 * 24 * 7},
+           {"name": "month", "label": ugettext_lazy("Month"),
+            "duration": 3600 * 24 * 31},
+           {"name": "year", "label": ugettext_lazy("Year"),
+            "duration": 3600 * 24 * 365}]
+# Graphs of custom periods are removed when they have not been
+# requested for this time (seconds)
+custom_graphs_lifetime = 3600
 
 
 def str2Time(y, M, d, h="00", m="00", s="00"):
@@ -36,16 +45,93 @@ class Grapher(object):
     def __init__(self):
         self.rrd_rootdir = parameters.get_admin("RRD_ROOTDIR")
         self.img_rootdir = parameters.get_admin("IMG_ROOTDIR")
+        rrdcached = parameters.get_admin("RRDCACHED_ADDRESS")
+        # Graphing through the daemon flushes pending updates first
+        self.daemon_args = ["--daemon", str(rrdcached)] if rrdcached else []
 
-    def process(self, target, suffix, start, end, graph_tpl):
+    def last_update(self, target):
+        """Return the last update recorded for a target
+
+        :param target: a domain name or "global"
+        :return: an integer (epoch) or None if no statistics exist
+        """
+        import rrdtool
+
+        rrdfile = str("%s/%s.rrd" % (self.rrd_rootdir, target))
+        if not os.path.exists(rrdfile):
+            return None
+        return int(rrdtool.last(rrdfile, *self.daemon_args))
+
+    def render(self, target, graph_tpl, period, start=None, end=None):
+        """Return the path of an up-to-date graph
+
+        Graphs are rendered on demand and cached on disk. The cache
+        key includes the last update of the RRD file, so a graph is
+        only rendered again when new data has been recorded.
+        Predefined periods end at the last update. Each custom period
+        gets its own graph: they are purged after
+        ``custom_graphs_lifetime`` (see ``purge_custom_graphs``).
+
+        :param target: a domain name or "global"
+        :param graph_tpl: a ``Graph`` instance
+        :param period: a predefined period name or "custom"
+        :param start: beginning of the custom period (epoch)
+        :param end: end of the custom period (epoch)
+        :return: a path or None if no statistics exist
+        """
+        last = self.last_update(target)
+        if last is None:
+            return None
+        if period == "custom":
+            suffix = "custom_%s_%s" % (start, end)
+        else:
+            suffix = period
+            start, end = "end-1%s" % period, last
+        key = "%s/%s_%s_%s_%s" % (self.img_rootdir, graph_tpl.display_name,
+                                  target, graph_tpl.cf, suffix)
+        path = "%s_%s_%d.png" % (key, translation.get_language(), last)
+        if os.path.exists(path):
+            if period == "custom":
+                # Keep it as long as it is requested
+                os.utime(path, None)
+            return path
+        if period == "custom":
+            self.purge_custom_graphs()
+        for oldpath in glob.glob("%s_*.png" % key):
+            if not oldpath.endswith("_%d.png" % last):
+                os.unlink(oldpath)
+        # Render into a temporary file so concurrent requests never
+        # read a partial image
+        tmppath = "%s.%d" % (path, os.getpid())
+        self.process(target, tmppath, start, end, graph_tpl)
+        if not os.path.exists(tmppath):
+            return None
+        os.rename(tmppath, path)
+        return path
+
+    def purge_custom_graphs(self):
+        """Remove graphs of custom periods not requested for a while
+
+        :return: the number of removed files
+        """
+        limit = time.time() - custom_graphs_lifetime
+        removed = 0
+        for path in glob.glob("%s/*_custom_*.png" % self.img_rootdir):
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                # Already removed by another request
+                continue
+        return removed
+
+    def process(self, target, path, start, end, graph_tpl):
         import rrdtool
 
         rrdfile = "%s/%s.rrd" % (self.rrd_rootdir, target)
         if not os.path.exists(rrdfile):
             return
-        ext = "png"
-        path = "%s/%s_%s_%s_%s.%s" % (self.img_rootdir, graph_tpl.display_name,
-                                      target, graph_tpl.cf, suffix, ext)
         start = str(start)
         end = str(end)
         defs = []
@@ -66,7 +152,7 @@ class Grapher(object):
         defs.append('GPRINT:%s_last:%s %%c\\c:strftime' % (first_ds, "to"))
         defs.append('COMMENT:\\s')
 
-        params = defs + lines
+        params = self.daemon_args + defs + lines
         rrdtool.graph(
             str(path),
             "--imgformat", "PNG",
@@ -84,10 +170,3 @@ class Grapher(object):
 
         if not os.path.exists(path):
             print "[graph] Impossible to create %s graph" % path
-
-    def make_defaults(self, target, graph_tpl):
-        end = "%d" % int(time.mktime(time.localtime()))
-        self.process(target, "day", "-1day", end, graph_tpl)
-        self.process(target, "week", "-1week", end, graph_tpl)
-        self.process(target, "month", "-1month", end, graph_tpl)
-        self.process(target, "year", "-1year", end, graph_tpl)
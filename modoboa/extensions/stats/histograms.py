@@ -0,0 +1,154 @@
+# coding: utf-8
+"""
+Histograms.
+
+Delays are counted into logarithmic buckets (as HDR histograms do):
+each power of two is divided into ``sub_buckets`` buckets, so the
+relative error of a percentile is bounded (about 19% with 4 sub
+buckets) whatever the delay, and a histogram only holds a few dozen
+counters. Spam scores use linear buckets (one per point).
+
+Histograms can be merged, which allows minutes to be consolidated
+into hours or days.
+
+"""
+import math
+
+# postfix logs delays with a 10ms precision
+min_value = 0.01
+sub_buckets = 4
+
+# Scores outside these bounds are counted into the first or last bucket
+min_score = -20
+max_score = 50
+
+
+class Histogram(object):
+    """Base class of histograms
+
+    Sub classes define how values are mapped to buckets.
+
+    :param counts: initial counters ({bucket index: count})
+    """
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.counts == other.counts
+
+    def __ne__(self, other):
+        return not self == other
+
+    @staticmethod
+    def index(value):
+        """Return the bucket of a value
+
+        :param value: the value
+        :return: an integer
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def upper_bound(index):
+        """Return the upper bound of a bucket
+
+        :param index: the bucket's index
+        :return: a value
+        """
+        raise NotImplementedError
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def add(self, value, count=1):
+        """Count a value
+
+        :param value: the value
+        :param count: the number of occurrences
+        """
+        idx = self.index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+
+    def merge(self, other):
+        """Add the counters of another histogram
+
+        :param other: an instance of the same class
+        """
+        for idx, count in other.counts.iteritems():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+
+    def percentile(self, p):
+        """Return a percentile
+
+        The upper bound of the bucket containing the percentile is
+        returned.
+
+        :param p: the percentile (between 0 and 100)
+        :return: a value or None if the histogram is empty
+        """
+        total = self.total
+        if not total:
+            return None
+        rank = max(1, int(math.ceil(total * p / 100.0)))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return self.upper_bound(idx)
+
+    def dump(self):
+        """Return a compact representation of this histogram
+
+        :return: a list of [bucket index, count] lists
+        """
+        return sorted([idx, count] for idx, count in self.counts.iteritems())
+
+    @classmethod
+    def load(cls, content):
+        """Build a histogram from the result of ``dump``
+
+        :param content: a list of [bucket index, count] lists
+        :return: a histogram
+        """
+        return cls(dict((int(idx), count) for idx, count in content))
+
+
+class LogHistogram(Histogram):
+    """A histogram with logarithmic buckets, used for delays"""
+
+    @staticmethod
+    def index(value):
+        if value < min_value:
+            return 0
+        return 1 + int(math.floor(
+            math.log(value / min_value, 2) * sub_buckets
+        ))
+
+    @staticmethod
+    def upper_bound(index):
+        return min_value * 2 ** (float(index) / sub_buckets)
+
+
+class ScoreHistogram(Histogram):
+    """A histogram with one bucket per point, used for spam scores"""
+
+    @staticmethod
+    def index(value):
+        return max(min_score, min(max_score, int(math.floor(value))))
+
+    @staticmethod
+    def upper_bound(index):
+        return index + 1
+
+
+# Histograms collected by the log parser:
+# * queue: time before and inside the queue manager (delays=a/b/.../...)
+# * delivery: connection setup and transmission (delays=.../.../c/d)
+# * spam_score: scores given by amavis
+kinds = {
+    "queue": LogHistogram,
+    "delivery": LogHistogram,
+    "spam_score": ScoreHistogram
+}
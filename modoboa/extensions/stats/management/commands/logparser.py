@@ -7,8 +7,19 @@ This scripts parses a log file produced by postfix (or using the same
 format). It looks for predefined events and build statistics about
 their occurence rate.
 
-At the, somes default graphics are generated using the grapher module.
-(see grapher.py)
+Graphics are not generated here: they are rendered on demand by the
+web interface (see grapher.py).
+
+Parsing is incremental: the position reached inside the log file is
+saved into a checkpoint file (stored with the RRD files) and the next
+run resumes from there. Log rotation is detected (the file's inode or
+first line changed) and the end of the rotated file (compressed or
+not) is read before the new one.
+
+Several log files (one per MX host for example) can be parsed in
+parallel: each file is given to a worker process and the collected
+counters are merged before the stores (RRD files and, if enabled, a
+SQLite database, see storage.py) are updated.
 
 Predefined events are:
  * Per domain sent/received messages,
@@ -16,42 +27,90 @@ Predefined events are:
  * Per domain sent/received traffics size,
  * Global consolidation of all previous events.
 
+Top talkers (heaviest senders, most rejected client addresses, most
+bounced recipients) are also counted per domain and per hour, using
+bounded sketches (see sketches.py).
+
+Delays reported by delivery agents (delays=a/b/c/d) are counted into
+per domain and per minute histograms (see histograms.py): queue time
+(a + b) and delivery time (c + d).
+
+amavisd-new lines (Passed/Blocked ...) are parsed in the same pass:
+they feed the spam and virus counters and the spam scores
+histograms. They are correlated with postfix lines using the
+Queue-ID field: a blocked message is discarded by amavis, it must not
+be counted as received when postfix reports its (successful) handoff.
+
 """
 import time
 import sys
 import os
 import re
-import rrdtool
+import glob
+import gzip
+import bz2
 import string
+import cPickle
+import multiprocessing
+from collections import namedtuple
+from django.db import connection
 from django.core.management.base import BaseCommand
 from optparse import make_option
 from modoboa.lib import parameters
 from modoboa.extensions.admin.models import Domain
 from modoboa.extensions.stats import Stats
-from modoboa.extensions.stats.grapher import str2Time, Grapher
-from modoboa.extensions.stats.graph_templates import MailTraffic
+from modoboa.extensions.stats.grapher import str2Time
+from modoboa.extensions.stats.storage import (
+    rrdstep, talkers_step, variables, RRDStore, get_stores
+)
+from modoboa.extensions.stats.sketches import SpaceSaving
+from modoboa.extensions.stats import histograms
 
-rrdstep = 60
-xpoints = 540
-points_per_sample = 3
-variables = ["sent", "recv", "bounced", "reject", "spam", "virus",
-             "size_sent", "size_recv"]
+checkpoint_name = "logparser.checkpoint"
+checkpoint_version = 2
+head_size = 256
+queue_sweep_interval = 3600
+
+# In-flight message (one per postfix queue ID), kept as small as possible
+QueueEntry = namedtuple(
+    "QueueEntry", ["sender", "size", "last_seen", "blocked"]
+)
+# Entries saved by older versions have no 'blocked' field
+QueueEntry.__new__.__defaults__ = (False,)
+
+# amavisd-new categories counted as spam or virus
+amavis_counters = {"SPAM": "spam", "SPAMMY": "spam", "INFECTED": "virus"}
+
+# The parser used by worker processes (inherited when forking)
+_parser = None
 
 
 class LogParser(object):
-    def __init__(self, options, workdir, year=None):
-        self.logfile = options["logfile"]
-        try:
-            self.f = open(self.logfile)
-        except IOError, errno:
-            if options["debug"]:
-                print "%s" % errno
-            sys.exit(1)
+    def __init__(self, options, workdir, year=None, stores=None):
+        self.logfiles = options["logfile"]
+        if isinstance(self.logfiles, basestring):
+            self.logfiles = [self.logfiles]
+        for logfile in self.logfiles:
+            try:
+                os.stat(logfile)
+            except OSError, errno:
+                if options["debug"]:
+                    print "%s" % errno
+                sys.exit(1)
+        self.logfile = None
+        self.jobs = options.get("jobs", 1)
         self.workdir = workdir
+        self.checkpoint_file = os.path.join(workdir, checkpoint_name)
+        self.reset = options.get("reset", False)
+        self.max_queue_age = \
+            int(options.get("max_queue_age", 5)) * 24 * 3600
         self.__year = year
         self.debug = options["debug"]
         self.verbose = options["verbose"]
-        self.cfs = ['AVERAGE', 'MAX']
+        if stores is None:
+            stores = [RRDStore(workdir, options.get("rrdcached"),
+                               debug=self.debug, verbose=self.verbose)]
+        self.stores = stores
 
         curtime = time.localtime()
         if not self.__year:
@@ -66,103 +125,155 @@ class LogParser(object):
             self.data[str(dom.name)] = {}
         self.data["global"] = {}
 
+        self.talkers = {}
+        self.histograms = {}
         self.workdict = {}
-        self.lupdates = {}
+        self.qstats = dict.fromkeys(["removed", "expired", "unknown"], 0)
+        self.position = None
+        self.pending = {}
         self.line_expr = re.compile("(\w+)\s+(\d+)\s+(\d+):(\d+):(\d+)\s+([-\w]+)\s+(\w+)/?\w*[[](\d+)[]]:\s+(.*)")
 
-    def init_rrd(self, fname, m):
-        """init_rrd
+    def _open(self, path):
+        """Open a log file
 
-        Set-up Data Sources (DS)
-        Set-up Round Robin Archives (RRA):
-        - day,week,month and year archives
-        - 2 types : AVERAGE and MAX
+        Rotated files compressed by logrotate are transparently
+        decompressed.
 
-        parameter : start time
-        return    : last epoch recorded
+        :param path: the file's path
+        :return: a file object
         """
-        ds_type = 'ABSOLUTE'
-        rows = xpoints / points_per_sample
-        realrows = int(rows * 1.1)    # ensure that the full range is covered
-        day_steps = int(3600 * 24 / (rrdstep * rows))
-        week_steps = day_steps * 7
-        month_steps = week_steps * 5
-        year_steps = month_steps * 12
-
-        # Set up data sources for our RRD
-        params = []
-        for v in variables:
-            params += ['DS:%s:%s:%s:0:U' % (v, ds_type, rrdstep * 2)]
+        if path.endswith(".gz"):
+            return gzip.open(path, "rb")
+        if path.endswith(".bz2"):
+            return bz2.BZ2File(path, "rb")
+        return open(path, "rb")
 
-        # Set up RRD to archive data
-        for cf in ['AVERAGE', 'MAX']:
-            for step in [day_steps, week_steps, month_steps, year_steps]:
-                params += ['RRA:%s:0.5:%s:%s' % (cf, step, realrows)]
+    def _read_head(self, path):
+        """Return the first line of a log file
 
-        # With those setup, we can now created the RRD
-        rrdtool.create(str(fname),
-                       '--start', str(m),
-                       '--step', str(rrdstep),
-                       *params)
-        return m
+        It is used to recognize a file once it has been renamed or
+        compressed.
 
-    def update_rrd(self, dom, t):
-        """update_rrd
+        :param path: the file's path
+        :return: a string or None
+        """
+        try:
+            fp = self._open(path)
+            try:
+                return fp.readline(head_size)
+            finally:
+                fp.close()
+        except IOError:
+            return None
+
+    def load_checkpoint(self):
+        """Load the state saved by the previous run into
+        ``self.checkpoint``
+        """
+        self.checkpoint = {
+            "version": checkpoint_version, "files": {}, "pending": {}
+        }
+        if self.reset or not os.path.exists(self.checkpoint_file):
+            return
+        try:
+            fp = open(self.checkpoint_file, "rb")
+            try:
+                chk = cPickle.load(fp)
+            finally:
+                fp.close()
+        except (IOError, EOFError, cPickle.UnpicklingError), errno:
+            if self.debug:
+                print "[checkpoint] ignoring invalid checkpoint: %s" % errno
+            return
+        if chk.get("version") != checkpoint_version:
+            return
+        self.checkpoint = chk
 
-        Update RRD with records at t time.
+    def save_checkpoint(self):
+        """Save the current state for the next run
 
-        True  : if data are up-to-date for current minute
-        False : syslog may have probably been already recorded
-        or something wrong
+        The file is replaced atomically so an interrupted run can't
+        leave a corrupted checkpoint behind.
         """
-        fname = "%s/%s.rrd" % (self.workdir, dom)
-        m = t - (t % rrdstep)
-        if not os.path.exists(fname):
-            self.lupdates[fname] = self.init_rrd(fname, m)
-            if self.debug:
-                print "[rrd] create new RRD file %s" % fname
-        else:
-            if not fname in self.lupdates:
-                self.lupdates[fname] = rrdtool.last(str(fname))
+        self.checkpoint["pending"] = self.pending
+        tmpname = "%s.tmp" % self.checkpoint_file
+        fp = open(tmpname, "wb")
+        try:
+            cPickle.dump(self.checkpoint, fp, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        os.rename(tmpname, self.checkpoint_file)
 
-        if m <= self.lupdates[fname]:
-            if self.verbose:
-                print "[rrd] VERBOSE events at %s already recorded in RRD" % m
-            return False
+    def _find_rotated(self, state):
+        """Look for the file read by the previous run
 
-        tpl = ""
-        for v in variables:
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        # Missing some RRD steps
-        # Est ce vraiment nécessaire... ?
-        if m > self.lupdates[fname] + rrdstep:
-            values = ""
-            for v in variables:
-                if values != "":
-                    values += ":"
-                values += "0"
-            for p in range(self.lupdates[fname] + rrdstep, m, rrdstep):
-                if self.verbose:
-                    print "[rrd] VERBOSE update -t %s %s:%s (SKIP)" \
-                        % (tpl, p, values)
-                rrdtool.update(str(fname), "-t", tpl, "%s:%s" % (p, values))
-
-        values = "%s" % m
-        tpl = ""
-        for v in variables:
-            values += ":"
-            values += str(self.data[dom][m][v])
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        if self.verbose:
-            print "[rrd] VERBOSE update -t %s %s" % (tpl, values)
+        Candidates are the names given by logrotate (numbered or
+        dated, compressed or not), most recent first. A candidate
+        matches if it still has the recorded inode or if it starts
+        with the recorded line.
 
-        rrdtool.update(str(fname), "-t", tpl, values)
-        self.lupdates[fname] = m
-        return True
+        :param state: the checkpoint of the current log file
+        :return: a path or None
+        """
+        candidates = glob.glob("%s[.-]*" % self.logfile)
+        candidates.sort(key=os.path.getmtime, reverse=True)
+        for path in candidates:
+            if os.stat(path).st_ino == state["inode"] \
+                    or self._read_head(path) == state["head"]:
+                return path
+        return None
+
+    def _sources(self, state):
+        """Return the files to read and where to start
+
+        :param state: the checkpoint of the current log file
+        :return: a list of (path, offset) tuples
+        """
+        if state is None or not state["offset"]:
+            return [(self.logfile, 0)]
+        st = os.stat(self.logfile)
+        if st.st_ino == state["inode"] and st.st_size >= state["offset"] \
+                and self._read_head(self.logfile) == state["head"]:
+            return [(self.logfile, state["offset"])]
+        sources = []
+        rotated = self._find_rotated(state)
+        if rotated is not None:
+            if self.debug:
+                print "[checkpoint] log rotated, resuming from %s" % rotated
+            sources.append((rotated, state["offset"]))
+        elif self.debug:
+            print "[checkpoint] rotated log not found, lines may be missing"
+        sources.append((self.logfile, 0))
+        return sources
+
+    def _read_lines(self, state):
+        """Iterate over the lines not parsed yet
+
+        A rotated file is read until its end. Only complete lines are
+        consumed from the current log file: a trailing partial line
+        will be read again by the next run. The reached position is
+        stored into ``self.position``.
+
+        :param state: the checkpoint of the current log file
+        """
+        for path, offset in self._sources(state):
+            fp = self._open(path)
+            try:
+                fp.seek(offset)
+                for line in iter(fp.readline, ""):
+                    if path == self.logfile and not line.endswith("\n"):
+                        break
+                    offset += len(line)
+                    yield line
+                if path == self.logfile:
+                    st = os.fstat(fp.fileno())
+                    fp.seek(0)
+                    self.position = {
+                        "inode": st.st_ino, "offset": offset,
+                        "head": fp.readline(head_size)
+                    }
+            finally:
+                fp.close()
 
     def initcounters(self, dom, cur_t):
         init = {}
@@ -180,6 +291,80 @@ class LogParser(object):
             self.initcounters("global", cur_t)
         self.data["global"][cur_t][counter] += val
 
+    def inc_talker(self, dom, cur_t, kind, key):
+        """Count one occurrence of a talker
+
+        :param dom: the domain's name (or None)
+        :param cur_t: the current minute
+        :param kind: the kind of talker (see ``sketches.kinds``)
+        :param key: the talker (an address)
+        """
+        bucket = cur_t - cur_t % talkers_step
+        targets = ["global"]
+        if dom is not None and dom in self.domains:
+            targets.append(dom)
+        for target in targets:
+            sketches = self.talkers.setdefault(target, {}) \
+                .setdefault(bucket, {})
+            if not kind in sketches:
+                sketches[kind] = SpaceSaving()
+            sketches[kind].add(key)
+
+    def add_histogram(self, domains, cur_t, kind, value):
+        """Count a value into histograms
+
+        The value is counted once per domain, whatever the number of
+        recipients.
+
+        :param domains: the domains concerned (names)
+        :param cur_t: the current minute
+        :param kind: the kind of histogram (see ``histograms.kinds``)
+        :param value: the value (a delay, a score)
+        """
+        targets = set(["global"])
+        targets.update([dom for dom in domains if dom in self.domains])
+        for target in targets:
+            current = self.histograms.setdefault(target, {}) \
+                .setdefault(cur_t, {})
+            if not kind in current:
+                current[kind] = histograms.kinds[kind]()
+            current[kind].add(value)
+
+    def parse_amavis(self, action, category, log, cur_t):
+        """Handle a line logged by amavisd-new
+
+        Spam and virus counters are incremented for each recipient. A
+        blocked message is flagged using its postfix queue ID so its
+        handoff to amavis is not counted as a delivery.
+
+        :param action: "Passed" or "Blocked"
+        :param category: the amavis category (CLEAN, SPAM, INFECTED...)
+        :param log: the line's message
+        :param cur_t: the current minute
+        """
+        domains = []
+        m = re.search("<[^>]*> -> ((?:<[^>]*>,?)+)", log)
+        if m:
+            for rcpt in re.findall("<([^>]*)>", m.group(1)):
+                addr = re.match("([^@]+)@(.+)", rcpt)
+                domains.append(addr.group(2) if addr is not None else None)
+        counter = amavis_counters.get(category)
+        if counter is not None:
+            for dom in domains:
+                self.inc_counter(dom, cur_t, counter)
+        m = re.search("Hits: (-?[\d.]+)", log)
+        if m:
+            self.add_histogram([dom for dom in domains if dom is not None],
+                               cur_t, "spam_score", float(m.group(1)))
+        if action != "Blocked":
+            return
+        m = re.search("Queue-ID: (\w+)", log)
+        if m is None:
+            return
+        entry = self.get_entry(m.group(1), cur_t)
+        if entry is not None:
+            self.workdict[m.group(1)] = entry._replace(blocked=True)
+
     def year(self, month):
         """Return the appropriate year
 
@@ -203,12 +388,68 @@ class LogParser(object):
             return self.__year - 1
         return self.__year
 
-    def process(self):
+    def get_entry(self, line_id, cur_t):
+        """Return the in-flight entry of a queue ID
+
+        An entry not referenced for more than ``max_queue_age``
+        seconds is considered lost (postfix gave up on the message or
+        some lines are missing): it is evicted.
+
+        :param line_id: the queue ID
+        :param cur_t: the time of the current line
+        :return: a ``QueueEntry`` or None
+        """
+        entry = self.workdict.get(line_id)
+        if entry is None:
+            return None
+        if entry.last_seen < cur_t - self.max_queue_age:
+            del self.workdict[line_id]
+            self.qstats["expired"] += 1
+            return None
+        if entry.last_seen != cur_t:
+            entry = self.workdict[line_id] = entry._replace(last_seen=cur_t)
+        return entry
+
+    def expire_entries(self, cur_t):
+        """Evict all in-flight entries older than ``max_queue_age``
+
+        :param cur_t: the time of the current line
+        """
+        limit = cur_t - self.max_queue_age
+        expired = [line_id for line_id, entry in self.workdict.iteritems()
+                   if entry.last_seen < limit]
+        for line_id in expired:
+            del self.workdict[line_id]
+        self.qstats["expired"] += len(expired)
+
+    def parse_file(self, logfile, state):
+        """Parse the lines appended to a log file since the last run
+
+        Counters are collected from scratch so that results computed
+        by different processes can be merged (see ``merge``).
+
+        :param logfile: the log file's path
+        :param state: the checkpoint of this log file (or None)
+        :return: a (counters, top talkers, histograms, new checkpoint,
+                 queue stats) tuple
+        """
+        self.logfile = logfile
+        self.position = None
+        self.data = dict((dom, {}) for dom in self.data)
+        self.talkers = {}
+        self.histograms = {}
+        self.workdict = state["workdict"] if state is not None else {}
+        self.qstats = dict.fromkeys(self.qstats, 0)
         id_expr = re.compile("([0-9A-F]+): (.*)")
+        delays_expr = re.compile("delays=([\d.]+)/([\d.]+)/([\d.]+)/([\d.]+)")
+        amavis_expr = re.compile("\([\w-]+\) (Passed|Blocked) ([\w-]+)")
+        client_expr = re.compile("NOQUEUE: reject: \w+ from [^\[]*\[([^\]]+)\]")
         prev_se = -1
         prev_mi = -1
         prev_ho = -1
-        for line in self.f.readlines():
+        cur_t = None
+        next_sweep = 0
+        for line in self._read_lines(state):
             m = self.line_expr.match(line)
             if not m:
                 continue
@@ -221,86 +462,280 @@ class LogParser(object):
                 prev_mi = mi
                 prev_ho = ho
                 prev_se = se
+                if cur_t >= next_sweep:
+                    self.expire_entries(cur_t)
+                    next_sweep = cur_t + queue_sweep_interval
             m = id_expr.match(log)
             if m:
                 (line_id, line_log) = m.groups()
 
+                if line_log == "removed":
+                    if self.workdict.pop(line_id, None) is not None:
+                        self.qstats["removed"] += 1
+                    continue
+
                 m = re.search("message-id=<([^>]*)>", line_log)
                 if m:
-                    self.workdict[line_id] = {'from': m.group(1), 'size': 0}
+                    self.workdict[line_id] = QueueEntry(m.group(1), 0, cur_t)
                     continue
 
                 m = re.search("from=<([^>]*)>, size=(\d+)", line_log)
                 if m:
-                    self.workdict[line_id] = {'from': m.group(1),
-                                              'size': string.atoi(m.group(2))}
+                    self.workdict[line_id] = QueueEntry(
+                        m.group(1), string.atoi(m.group(2)), cur_t
+                    )
                     continue
 
                 m = re.search("to=<([^>]*)>.*status=(\S+)", line_log)
                 if m:
-                    if not line_id in self.workdict:
+                    entry = self.get_entry(line_id, cur_t)
+                    if entry is None:
+                        self.qstats["unknown"] += 1
                         if self.debug:
                             print "Inconsistent mail (%s: %s), skipping" % (line_id, m.group(1))
                         continue
+                    if entry.blocked:
+                        # Discarded by amavis, already counted
+                        continue
                     if not m.group(2) in variables:
                         if self.debug:
                             print "Unsupported status %s, skipping" % m.group(2)
                         continue
 
-                    addrfrom = re.match("([^@]+)@(.+)", self.workdict[line_id]['from'])
+                    addrfrom = re.match("([^@]+)@(.+)", entry.sender)
+                    addrto = re.match("([^@]+)@(.+)", m.group(1))
+                    delays = delays_expr.search(line_log)
+                    if delays:
+                        a, b, c, d = [float(v) for v in delays.groups()]
+                        doms = [addr.group(2) for addr in [addrfrom, addrto]
+                                if addr is not None]
+                        self.add_histogram(doms, cur_t, "queue", a + b)
+                        self.add_histogram(doms, cur_t, "delivery", c + d)
                     if addrfrom is not None and addrfrom.group(2) in self.domains:
                         self.inc_counter(addrfrom.group(2), cur_t, 'sent')
                         self.inc_counter(addrfrom.group(2), cur_t, 'size_sent',
-                                         self.workdict[line_id]['size'])
-                    addrto = re.match("([^@]+)@(.+)", m.group(1))
+                                         entry.size)
+                        self.inc_talker(addrfrom.group(2), cur_t, 'senders',
+                                        entry.sender)
                     domname = addrto.group(2) if addrto is not None else None
                     if m.group(2) == "sent":
                         self.inc_counter(addrto.group(2), cur_t, 'recv')
                         self.inc_counter(addrto.group(2), cur_t, 'size_recv',
-                                         self.workdict[line_id]['size'])
+                                         entry.size)
                     else:
                         self.inc_counter(domname, cur_t, m.group(2))
+                        if m.group(2) == "bounced":
+                            self.inc_talker(domname, cur_t,
+                                            'bounced_recipients', m.group(1))
                     continue
 
                 if self.debug:
                     print "Unknown line format: %s" % line_log
             else:
+                m = amavis_expr.match(log)
+                if m:
+                    self.parse_amavis(m.group(1), m.group(2), log, cur_t)
+                    continue
                 m = re.match("NOQUEUE: reject: .*from=<(.*)> to=<([^>]*)>", log)
                 if m:
                     addrto = re.match("([^@]+)@(.+)", m.group(2))
                     if addrto and addrto.group(2) in self.domains:
                         self.inc_counter(addrto.group(2), cur_t, 'reject')
+                        client = client_expr.match(log)
+                        if client:
+                            self.inc_talker(addrto.group(2), cur_t,
+                                            'rejected_clients', client.group(1))
                     continue
                 if self.debug:
                     print "Unknown line format: %s" % log
 
-        # Sort everything by time
-        G = Grapher()
+        if cur_t is not None:
+            self.expire_entries(cur_t)
+        if self.verbose:
+            print "[queue] %s: %d IDs removed, %d expired, %d unknown, " \
+                "%d still in flight" % (
+                    logfile, self.qstats["removed"], self.qstats["expired"],
+                    self.qstats["unknown"], len(self.workdict)
+                )
+        if self.position is not None:
+            self.position["workdict"] = self.workdict
+        return self.data, self.talkers, self.histograms, self.position, \
+            self.qstats
+
+    def merge(self, data):
+        """Add counters collected by ``parse_file`` to ``self.data``
+
+        :param data: the counters to add
+        """
+        for dom, points in data.iteritems():
+            if not dom in self.data:
+                continue
+            for t, counters in points.iteritems():
+                if not t in self.data[dom]:
+                    self.data[dom][t] = counters
+                    continue
+                for v in variables:
+                    self.data[dom][t][v] += counters[v]
+
+    def merge_talkers(self, talkers):
+        """Add top talkers collected by ``parse_file`` to
+        ``self.talkers``
+
+        :param talkers: the sketches to add
+        """
+        for dom, buckets in talkers.iteritems():
+            for bucket, sketches in buckets.iteritems():
+                current = self.talkers.setdefault(dom, {}) \
+                    .setdefault(bucket, {})
+                for kind, sketch in sketches.iteritems():
+                    if kind in current:
+                        current[kind].merge(sketch)
+                    else:
+                        current[kind] = sketch
+
+    def merge_histograms(self, data):
+        """Add histograms collected by ``parse_file`` to
+        ``self.histograms``
+
+        :param data: the histograms to add
+        """
+        for dom, minutes in data.iteritems():
+            for t, hists in minutes.iteritems():
+                current = self.histograms.setdefault(dom, {}).setdefault(t, {})
+                for kind, histogram in hists.iteritems():
+                    if kind in current:
+                        current[kind].merge(histogram)
+                    else:
+                        current[kind] = histogram
+
+    def parse(self):
+        """Parse the lines appended to each log file since the last run
+
+        Log files are parsed one after the other or, if more than one
+        job is allowed, by a pool of worker processes. Counters are
+        stored into ``self.data``.
+        """
+        global _parser
+
+        self.load_checkpoint()
+        tasks = [(logfile, self.checkpoint["files"].get(logfile))
+                 for logfile in self.logfiles]
+        if self.jobs > 1 and len(tasks) > 1:
+            # Workers don't need the database, don't share the
+            # connection with them.
+            connection.close()
+            _parser = self
+            pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+            try:
+                results = pool.map(parse_file, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+                _parser = None
+        else:
+            results = [self.parse_file(*task) for task in tasks]
+
+        self.data = dict((dom, {}) for dom in self.data)
+        self.talkers = {}
+        self.histograms = {}
+        self.merge(self.checkpoint["pending"])
+        qstats = dict.fromkeys(self.qstats, 0)
+        for logfile, (data, talkers, hists, position, stats) \
+                in zip(self.logfiles, results):
+            self.merge(data)
+            self.merge_talkers(talkers)
+            self.merge_histograms(hists)
+            if position is not None:
+                self.checkpoint["files"][logfile] = position
+            for name, value in stats.iteritems():
+                qstats[name] += value
+        self.qstats = qstats
+
+    def flush(self):
+        """Record collected data into the stores
+
+        Recent minutes may still receive events (syslog is not always
+        in order and the last line may belong to a minute not over
+        yet): they are kept aside and saved into the checkpoint
+        instead of being recorded.
+        """
+        limit = int(time.time()) - 2 * rrdstep
         for dom, data in self.data.iteritems():
             if self.debug:
-                print "[rrd] dealing with domain %s" % dom
+                print "[store] dealing with domain %s" % dom
+            # Sort everything by time
+            times = []
             for t in sorted(data.keys()):
-                self.update_rrd(dom, t)
+                if t > limit:
+                    self.pending.setdefault(dom, {})[t] = data[t]
+                    continue
+                times.append(t)
+            if not times:
+                continue
+            points = [(t, data[t]) for t in times]
+            for store in self.stores:
+                store.update(dom, points)
+        # Sketches and histograms are merged with the recorded ones,
+        # they don't need to wait for the end of their bucket.
+        for dom, buckets in self.talkers.iteritems():
+            for bucket, sketches in buckets.iteritems():
+                for kind, sketch in sketches.iteritems():
+                    for store in self.stores:
+                        store.update_talkers(dom, bucket, kind, sketch)
+        for dom, minutes in self.histograms.iteritems():
+            for kind in set([kind for hists in minutes.values()
+                             for kind in hists]):
+                points = [(t, minutes[t][kind]) for t in sorted(minutes)
+                          if kind in minutes[t]]
+                for store in self.stores:
+                    store.update_histograms(dom, kind, points)
+
+    def process(self):
+        self.parse()
+        self.flush()
+        self.save_checkpoint()
+
+
+def parse_file(task):
+    """Worker process entry point
 
-            for graph_tpl in MailTraffic().get_graphs():
-                G.make_defaults(dom, graph_tpl)
+    :param task: a (log file, checkpoint) tuple
+    :return: see ``LogParser.parse_file``
+    """
+    return _parser.parse_file(*task)
 
 
 class Command(BaseCommand):
     help = 'Log file parser'
 
     option_list = BaseCommand.option_list + (
-        make_option("--logfile", default=None,
-                    help="postfix log in syslog format", metavar="FILE"),
+        make_option("--logfile", default=None, action="append",
+                    help="postfix log in syslog format (can be repeated)",
+                    metavar="FILE"),
+        make_option("--jobs", type="int", default=1,
+                    help="Number of log files parsed in parallel"),
         make_option("--verbose", default=False, action="store_true",
                     dest="verbose", help="Set verbose mode"),
         make_option("--debug", default=False, action="store_true",
-                    help="Set debug mode")
+                    help="Set debug mode"),
+        make_option("--reset", default=False, action="store_true",
+                    help="Ignore the saved checkpoint and parse the whole "
+                    "log file"),
+        make_option("--rrdcached", default=None, metavar="ADDRESS",
+                    help="Send RRD updates through this rrdcached daemon "
+                    "(overrides the corresponding parameter)"),
+        make_option("--max-queue-age", type="int", default=5,
+                    dest="max_queue_age", metavar="DAYS",
+                    help="Forget messages still in flight after this "
+                    "delay (default: 5, postfix's maximal_queue_lifetime)")
     )
 
     def handle(self, *args, **options):
         Stats().load()
         if options["logfile"] is None:
             options["logfile"] = parameters.get_admin("LOGFILE", app="stats")
-        p = LogParser(options, parameters.get_admin("RRD_ROOTDIR", app="stats"))
+        stores = get_stores(options["rrdcached"], debug=options["debug"],
+                            verbose=options["verbose"])
+        p = LogParser(options, parameters.get_admin("RRD_ROOTDIR", app="stats"),
+                      stores=stores)
         p.process()
@@ -0,0 +1,3 @@
+# coding: utf-8
+# No model: statistics are stored into RRD files. This module only
+# exists to let Django discover the test suite.
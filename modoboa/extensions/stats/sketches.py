@@ -0,0 +1,96 @@
+# coding: utf-8
+"""
+Bounded counters used to find top talkers.
+
+Counting every sender, recipient or client address seen in the logs
+would require unbounded memory. The *space-saving* algorithm
+(Metwally et al.) keeps at most ``capacity`` counters: when a new key
+arrives and the sketch is full, the smallest counter is given to the
+new key. Each counter may then over-estimate its key's real count by
+at most its ``error`` value, and every key whose real count is bigger
+than total / capacity is guaranteed to be present.
+
+"""
+
+default_capacity = 100
+
+# Kinds of top talkers collected by the log parser
+kinds = ["senders", "rejected_clients", "bounced_recipients"]
+
+
+class SpaceSaving(object):
+    """A space-saving sketch
+
+    :param capacity: the maximum number of counters kept
+    """
+
+    def __init__(self, capacity=default_capacity):
+        self.capacity = capacity
+        self.counters = {}
+
+    def __len__(self):
+        return len(self.counters)
+
+    def __eq__(self, other):
+        return isinstance(other, SpaceSaving) \
+            and self.counters == other.counters
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add(self, key, count=1, error=0):
+        """Count occurrences of a key
+
+        :param key: the key (an address for example)
+        :param count: the number of occurrences
+        :param error: the over-estimation already included in count
+        """
+        if key in self.counters:
+            current = self.counters[key]
+            self.counters[key] = [current[0] + count, current[1] + error]
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [count, error]
+            return
+        victim = min(self.counters, key=lambda k: self.counters[k][0])
+        smallest = self.counters.pop(victim)[0]
+        self.counters[key] = [smallest + count, smallest + error]
+
+    def merge(self, other):
+        """Add the counters of another sketch
+
+        :param other: a ``SpaceSaving`` instance
+        """
+        for key, (count, error) in other.counters.iteritems():
+            self.add(key, count, error)
+
+    def top(self, limit=10):
+        """Return the biggest counters
+
+        :param limit: the number of counters to return
+        :return: list of (key, count, error) tuples, biggest first
+        """
+        result = sorted(self.counters.iteritems(),
+                        key=lambda item: (-item[1][0], item[0]))
+        return [(key, count, error) for key, (count, error) in result[:limit]]
+
+    def dump(self):
+        """Return a compact representation of this sketch
+
+        :return: a list of [key, count, error] lists
+        """
+        return [[key, count, error]
+                for key, (count, error) in self.counters.iteritems()]
+
+    @classmethod
+    def load(cls, content, capacity=default_capacity):
+        """Build a sketch from the result of ``dump``
+
+        :param content: a list of [key, count, error] lists
+        :param capacity: the maximum number of counters kept
+        :return: a ``SpaceSaving`` instance
+        """
+        sketch = cls(capacity)
+        for key, count, error in content:
+            sketch.add(key, count, error)
+        return sketch
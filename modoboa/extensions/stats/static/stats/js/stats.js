@@ -17,6 +17,9 @@ Stats.prototype = {
         var navobj = new History(this.options);
         this.navobj = navobj;
 
+        $("a[data-gset='" + navobj.getparam("gset", "mailtraffic") + "']")
+            .tab("show");
+
         if (navobj.params.searchquery != undefined) {
             $("#searchquery").val(navobj.params.searchquery);
         }
@@ -61,6 +64,7 @@ Stats.prototype = {
     },
 
     listen: function() {
+        $("a[data-gset]").on("shown", $.proxy(this.change_gset, this));
         $(".period_selector").click($.proxy(this.change_period, this));
         $("#customsend").on("click", $.proxy(this.customgraphs, this));
     },
@@ -70,6 +74,10 @@ Stats.prototype = {
             $.proxy(this.graphs_cb, this));
     },
 
+    change_gset: function(e) {
+        this.navobj.setparam("gset", $(e.target).attr("data-gset")).update();
+    },
+
     change_period: function(e) {
         e.preventDefault();
         var $link = $(e.target);
@@ -85,6 +93,17 @@ Stats.prototype = {
         }
         if (data.content) {
             $(".tab-pane.active").html(data.content);
+            $(".tab-pane.active .stats-chart").each(function() {
+                new StatsChart(this);
+            });
+            $(".tab-pane.active .stats-talkers").each(function() {
+                var $div = $(this);
+                $.getJSON($div.attr("data-url"), function(data) {
+                    if (data.status == "ok") {
+                        $div.html(data.content);
+                    }
+                });
+            });
         }
     },
 
@@ -112,3 +131,204 @@ Stats.prototype = {
         }).update();
     }
 };
+
+/*
+ * Draw a chart (stacked areas) from the JSON series returned by the
+ * 'series' view.
+ */
+var StatsChart = function(element, options) {
+    this.initialize(element, options);
+};
+
+StatsChart.prototype = {
+    constructor: StatsChart,
+
+    defaults: {
+        margin: {top: 25, right: 10, bottom: 25, left: 60},
+        ticks: 5
+    },
+
+    initialize: function(element, options) {
+        this.$element = $(element);
+        this.options = $.extend({}, this.defaults, options);
+        this.canvas = this.$element.find("canvas").get(0);
+        if (!this.canvas.getContext) {
+            return;
+        }
+        $.getJSON(this.$element.attr("data-url"), $.proxy(this.draw, this))
+            .fail($.proxy(function() {
+                this.$element.find("canvas").hide();
+                this.$element.find(".stats-nodata").removeClass("hide");
+            }, this));
+    },
+
+    /*
+     * Stack the series: return, for each serie, the cumulated
+     * values. Missing values (null) count as zero.
+     */
+    stack: function(series) {
+        var result = [];
+        var previous = null;
+
+        $.each(series, function(idx, serie) {
+            var values = [];
+            $.each(serie.data, function(pos, point) {
+                values.push((point[1] || 0) + (previous ? previous[pos] : 0));
+            });
+            result.push(values);
+            previous = values;
+        });
+        return result;
+    },
+
+    /* Return the values of each serie, as is */
+    values: function(series) {
+        return $.map(series, function(serie) {
+            return [$.map(serie.data, function(point) {
+                return (point[1] === null) ? [null] : point[1];
+            })];
+        });
+    },
+
+    format_value: function(value) {
+        if (value >= 1000000) {
+            return (value / 1000000).toFixed(1) + "M";
+        }
+        if (value >= 1000) {
+            return (value / 1000).toFixed(1) + "k";
+        }
+        return value.toFixed(value < 10 && value != 0 ? 1 : 0);
+    },
+
+    format_date: function(t, period) {
+        var d = new Date(t * 1000);
+        var pad = function(v) { return (v < 10) ? "0" + v : "" + v; };
+
+        if (period <= 3600 * 24 * 2) {
+            return pad(d.getHours()) + ":" + pad(d.getMinutes());
+        }
+        return d.getFullYear() + "-" + pad(d.getMonth() + 1) + "-" +
+            pad(d.getDate());
+    },
+
+    draw: function(data) {
+        var ctx = this.canvas.getContext("2d");
+        var margin = this.options.margin;
+        var width = this.canvas.width - margin.left - margin.right;
+        var height = this.canvas.height - margin.top - margin.bottom;
+        var stacked = data.stacked ?
+            this.stack(data.series) : this.values(data.series);
+        var max = 0;
+        var i, pos;
+
+        if (data.status == "ko" || !data.series.length ||
+                !data.series[0].data.length) {
+            this.$element.find("canvas").hide();
+            this.$element.find(".stats-nodata").removeClass("hide");
+            return;
+        }
+        $.each(stacked, function(idx, values) {
+            $.each(values, function(pos, value) {
+                max = Math.max(max, value || 0);
+            });
+        });
+        if (max == 0) {
+            max = 1;
+        }
+        var npoints = data.series[0].data.length;
+        var x = function(pos) {
+            return margin.left + pos * width / Math.max(npoints - 1, 1);
+        };
+        var y = function(value) {
+            return margin.top + height - value * height / max;
+        };
+
+        ctx.clearRect(0, 0, this.canvas.width, this.canvas.height);
+        ctx.font = "11px sans-serif";
+        ctx.fillStyle = "#333";
+        ctx.textAlign = "center";
+        ctx.fillText(data.title, this.canvas.width / 2, 15);
+
+        /* Areas, drawn from the top of the stack to the bottom */
+        for (i = stacked.length - 1; data.stacked && i >= 0; i--) {
+            ctx.beginPath();
+            ctx.moveTo(x(0), y(0));
+            for (pos = 0; pos < npoints; pos++) {
+                ctx.lineTo(x(pos), y(stacked[i][pos]));
+            }
+            ctx.lineTo(x(npoints - 1), y(0));
+            ctx.closePath();
+            ctx.fillStyle = data.series[i].color;
+            ctx.fill();
+        }
+        /* Lines, interrupted where values are missing */
+        for (i = 0; !data.stacked && i < stacked.length; i++) {
+            var drawing = false;
+
+            ctx.beginPath();
+            for (pos = 0; pos < npoints; pos++) {
+                if (stacked[i][pos] === null) {
+                    drawing = false;
+                    continue;
+                }
+                if (drawing) {
+                    ctx.lineTo(x(pos), y(stacked[i][pos]));
+                } else {
+                    ctx.moveTo(x(pos), y(stacked[i][pos]));
+                    drawing = true;
+                }
+            }
+            ctx.strokeStyle = data.series[i].color;
+            ctx.stroke();
+        }
+
+        /* Axes */
+        ctx.strokeStyle = "#999";
+        ctx.fillStyle = "#333";
+        ctx.beginPath();
+        ctx.moveTo(margin.left, margin.top);
+        ctx.lineTo(margin.left, margin.top + height);
+        ctx.lineTo(margin.left + width, margin.top + height);
+        ctx.stroke();
+        ctx.textAlign = "right";
+        for (i = 0; i <= this.options.ticks; i++) {
+            var value = max * i / this.options.ticks;
+            ctx.fillText(this.format_value(value), margin.left - 5,
+                         y(value) + 4);
+        }
+        ctx.textAlign = "center";
+        for (i = 0; i <= this.options.ticks; i++) {
+            pos = Math.round((npoints - 1) * i / this.options.ticks);
+            ctx.fillText(
+                this.format_date(data.series[0].data[pos][0],
+                                 data.end - data.start),
+                x(pos), margin.top + height + 15
+            );
+        }
+        ctx.save();
+        ctx.translate(12, margin.top + height / 2);
+        ctx.rotate(-Math.PI / 2);
+        ctx.fillText(data.vertlabel, 0, 0);
+        ctx.restore();
+
+        this.legend(data.series);
+    },
+
+    legend: function(series) {
+        var $legend = this.$element.find(".stats-legend").empty();
+
+        $.each(series, function(idx, serie) {
+            $legend.append(
+                $("<li />").append(
+                    $("<span class=\"swatch\" />")
+                        .css("background-color", serie.color),
+                    document.createTextNode((serie.total === null) ?
+                        serie.legend :
+                        serie.legend + " (" + gettext("Total") + ": " +
+                            serie.total + ")"
+                    )
+                )
+            );
+        });
+    }
+};
@@ -0,0 +1,600 @@
+# coding: utf-8
+"""
+Time-series storage for statistics.
+
+Counters collected by the log parser (one set of ``variables`` per
+domain and per minute) are recorded by one or more stores:
+
+* ``RRDStore``: one RRD file per domain, used to render graphs,
+* ``SQLiteStore``: all domains inside a single SQLite database (one
+  column per variable, with hourly and daily rollups). It answers
+  range queries and per-domain rankings without opening one file per
+  domain.
+
+"""
+import os
+import glob
+import json
+import sqlite3
+from modoboa.lib import parameters
+from modoboa.extensions.stats.sketches import SpaceSaving
+from modoboa.extensions.stats import histograms
+
+rrdstep = 60
+xpoints = 540
+points_per_sample = 3
+variables = ["sent", "recv", "bounced", "reject", "spam", "virus",
+             "size_sent", "size_recv"]
+# Long heartbeat: a single update can cover a gap of several steps
+heartbeat = 3600 * 24
+update_batch = 1000
+# Top talkers are counted per hour
+talkers_step = 3600
+
+
+class StatsStore(object):
+    """Base class of statistics stores
+
+    Timestamps are epochs aligned on ``rrdstep``. Counters are
+    dictionnaries containing one entry per variable.
+
+    Stores able to answer ``talkers`` and ``fetch_histograms`` must
+    set ``has_talkers`` and ``has_histograms``.
+    """
+    has_talkers = False
+    has_histograms = False
+
+    def __init__(self, debug=False, verbose=False):
+        self.debug = debug
+        self.verbose = verbose
+
+    def last_update(self, target):
+        """Return the last minute recorded for a target
+
+        :param target: a domain name or "global"
+        :return: an integer (epoch) or None if nothing was recorded
+        """
+        raise NotImplementedError
+
+    def update(self, target, points):
+        """Record new counters for a target
+
+        Minutes already recorded are skipped.
+
+        :param target: a domain name or "global"
+        :param points: list of (minute, counters) tuples sorted by time
+        :return: the number of recorded minutes
+        """
+        raise NotImplementedError
+
+    def fetch(self, target, start, end, resolution=rrdstep):
+        """Return the counters of a target over a period
+
+        Counters are summed by buckets of ``resolution`` seconds (or
+        of the closest resolution available in the store). Empty
+        buckets are returned as zeros.
+
+        :param target: a domain name or "global"
+        :param start: beginning of the period (epoch)
+        :param end: end of the period (epoch)
+        :param resolution: the wanted bucket size (seconds)
+        :return: a (resolution, list of (bucket, counters)) tuple
+        """
+        raise NotImplementedError
+
+    def top(self, variable, start, end, limit=10):
+        """Rank domains by the total of a variable over a period
+
+        :param variable: the variable's name
+        :param start: beginning of the period (epoch)
+        :param end: end of the period (epoch)
+        :param limit: the number of domains to return
+        :return: list of (domain, total) tuples, biggest first
+        """
+        raise NotImplementedError
+
+    def update_talkers(self, target, bucket, kind, sketch):
+        """Record top talkers of a target
+
+        Stores unable to keep top talkers ignore them.
+
+        :param target: a domain name or "global"
+        :param bucket: the hour the talkers were seen (epoch)
+        :param kind: the kind of talkers (see ``sketches.kinds``)
+        :param sketch: a ``SpaceSaving`` instance
+        """
+        pass
+
+    def talkers(self, target, kind, start, end, limit=10):
+        """Return the top talkers of a target over a period
+
+        :param target: a domain name or "global"
+        :param kind: the kind of talkers (see ``sketches.kinds``)
+        :param start: beginning of the period (epoch)
+        :param end: end of the period (epoch)
+        :param limit: the number of talkers to return
+        :return: list of (key, count, error) tuples, biggest first
+        """
+        raise NotImplementedError
+
+    def update_histograms(self, target, kind, points):
+        """Record histograms (latencies, spam scores) of a target
+
+        Stores unable to keep histograms ignore them.
+
+        :param target: a domain name or "global"
+        :param kind: the kind of histogram (see ``histograms.kinds``)
+        :param points: list of (minute, ``Histogram``) tuples
+        """
+        pass
+
+    def fetch_histograms(self, target, kind, start, end, resolution=rrdstep):
+        """Return the histograms of a target over a period
+
+        :param target: a domain name or "global"
+        :param kind: the kind of histogram (see ``histograms.kinds``)
+        :param start: beginning of the period (epoch)
+        :param end: end of the period (epoch)
+        :param resolution: the wanted bucket size (seconds)
+        :return: a (resolution, list of (bucket, ``Histogram``)) tuple
+        """
+        raise NotImplementedError
+
+
+class RRDStore(StatsStore):
+    """Store statistics into one RRD file per target"""
+
+    def __init__(self, rootdir, daemon=None, **kwargs):
+        super(RRDStore, self).__init__(**kwargs)
+        self.rootdir = rootdir
+        self.daemon_args = ["--daemon", str(daemon)] if daemon else []
+        self.lupdates = {}
+
+    def rrdfile(self, target):
+        return str("%s/%s.rrd" % (self.rootdir, target))
+
+    def init_rrd(self, fname, m):
+        """init_rrd
+
+        Set-up Data Sources (DS)
+        Set-up Round Robin Archives (RRA):
+        - day,week,month and year archives
+        - 2 types : AVERAGE and MAX
+
+        parameter : start time (must be older than the first update)
+        return    : last epoch recorded
+        """
+        import rrdtool
+
+        ds_type = 'ABSOLUTE'
+        rows = xpoints / points_per_sample
+        realrows = int(rows * 1.1)    # ensure that the full range is covered
+        day_steps = int(3600 * 24 / (rrdstep * rows))
+        week_steps = day_steps * 7
+        month_steps = week_steps * 5
+        year_steps = month_steps * 12
+
+        # Set up data sources for our RRD
+        params = []
+        for v in variables:
+            params += ['DS:%s:%s:%s:0:U' % (v, ds_type, heartbeat)]
+
+        # Set up RRD to archive data
+        for cf in ['AVERAGE', 'MAX']:
+            for step in [day_steps, week_steps, month_steps, year_steps]:
+                params += ['RRA:%s:0.5:%s:%s' % (cf, step, realrows)]
+
+        # With those setup, we can now created the RRD
+        rrdtool.create(str(fname),
+                       '--start', str(m),
+                       '--step', str(rrdstep),
+                       *params)
+        return m
+
+    def check_rrd(self, fname):
+        """check_rrd
+
+        Return the last update recorded into an existing RRD file.
+
+        Files created by older versions use a short heartbeat, which
+        requires one zero update per missing step: it is raised.
+        """
+        import rrdtool
+
+        info = rrdtool.info(fname, *self.daemon_args)
+        params = []
+        for v in variables:
+            key = "ds[%s].minimal_heartbeat" % v
+            if key in info and info[key] < heartbeat:
+                params += ["--heartbeat", "%s:%d" % (v, heartbeat)]
+        if params:
+            if self.debug:
+                print "[rrd] raising heartbeat of %s" % fname
+            rrdtool.tune(fname, *params)
+        return int(info["last_update"])
+
+    def last_update(self, target):
+        import rrdtool
+
+        fname = self.rrdfile(target)
+        if not os.path.exists(fname):
+            return None
+        return int(rrdtool.last(fname, *self.daemon_args))
+
+    def update(self, target, points):
+        """Update RRD with records of the given minutes.
+
+        Values are sent in batches (several timestamp:values arguments
+        per rrdtool.update call). Missing steps are not filled one by
+        one: the heartbeat being long, a single zero update per
+        heartbeat period is enough to record the whole gap as zero.
+        """
+        import rrdtool
+
+        fname = self.rrdfile(target)
+        if not os.path.exists(fname):
+            self.lupdates[fname] = self.init_rrd(fname, points[0][0] - rrdstep)
+            if self.debug:
+                print "[rrd] create new RRD file %s" % fname
+        elif not fname in self.lupdates:
+            self.lupdates[fname] = self.check_rrd(fname)
+
+        tpl = ":".join(variables)
+        zeros = ":".join(["0"] * len(variables))
+        last = self.lupdates[fname]
+        values = []
+        recorded = 0
+        for m, counters in points:
+            if m <= last:
+                if self.verbose:
+                    print "[rrd] VERBOSE events at %s already recorded in RRD" % m
+                continue
+            if m > last + rrdstep:
+                values += ["%d:%s" % (p, zeros)
+                           for p in range(last + heartbeat, m - rrdstep,
+                                          heartbeat) + [m - rrdstep]]
+            values.append("%d:%s" % (m, ":".join(
+                [str(counters[v]) for v in variables]
+            )))
+            last = m
+            recorded += 1
+
+        for pos in range(0, len(values), update_batch):
+            batch = values[pos:pos + update_batch]
+            if self.verbose:
+                print "[rrd] VERBOSE update -t %s %s" % (tpl, " ".join(batch))
+            rrdtool.update(fname, *(self.daemon_args + ["-t", tpl] + batch))
+        self.lupdates[fname] = last
+        return recorded
+
+    def fetch(self, target, start, end, resolution=rrdstep):
+        import rrdtool
+
+        fname = self.rrdfile(target)
+        if not os.path.exists(fname):
+            return resolution, []
+        (fstart, fend, step), names, rows = rrdtool.fetch(
+            fname, "AVERAGE", "--start", str(start), "--end", str(end),
+            "--resolution", str(resolution), *self.daemon_args
+        )
+        # Values are rates (per second), convert them into counts
+        result = []
+        for pos, row in enumerate(rows):
+            counters = dict.fromkeys(variables, 0)
+            for name, value in zip(names, row):
+                if value is not None:
+                    counters[name] = int(round(value * step))
+            result.append((fstart + pos * step, counters))
+        return step, result
+
+    def top(self, variable, start, end, limit=10):
+        """Rank domains by the total of a variable over a period
+
+        Every RRD file is read: prefer ``SQLiteStore`` for large
+        installations.
+        """
+        totals = []
+        for fname in glob.glob("%s/*.rrd" % self.rootdir):
+            target = os.path.basename(fname)[:-4]
+            if target == "global":
+                continue
+            step, rows = self.fetch(target, start, end, end - start)
+            totals.append(
+                (target, sum([counters[variable] for t, counters in rows]))
+            )
+        totals.sort(key=lambda item: item[1], reverse=True)
+        return totals[:limit]
+
+
+class SQLiteStore(StatsStore):
+    """Store statistics into a SQLite database
+
+    Each resolution has its own table (one row per target and per
+    bucket, one column per variable): minutes, hours and days. Rollups
+    are updated at the same time as minutes.
+
+    Top talkers are kept as one serialized sketch per target, kind and
+    hour. Histograms (latencies, spam scores) are kept the same way,
+    with the same resolutions as counters.
+    """
+    resolutions = [rrdstep, 3600, 3600 * 24]
+    has_talkers = True
+    has_histograms = True
+
+    def __init__(self, path, **kwargs):
+        super(SQLiteStore, self).__init__(**kwargs)
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self.create_tables()
+        return self._conn
+
+    def create_tables(self):
+        columns = ", ".join(
+            ["%s INTEGER NOT NULL DEFAULT 0" % v for v in variables]
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS target ("
+            "id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, "
+            "last_update INTEGER)"
+        )
+        for resolution in self.resolutions:
+            # (t, target_id) allows one range scan for all targets,
+            # the index one range scan per target.
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sample_%d ("
+                "t INTEGER NOT NULL, target_id INTEGER NOT NULL, %s, "
+                "PRIMARY KEY (t, target_id))" % (resolution, columns)
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS sample_%d_target "
+                "ON sample_%d (target_id, t)" % (resolution, resolution)
+            )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS talkers ("
+            "target_id INTEGER NOT NULL, kind TEXT NOT NULL, "
+            "t INTEGER NOT NULL, content TEXT NOT NULL, "
+            "PRIMARY KEY (target_id, kind, t))"
+        )
+        for resolution in self.resolutions:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS histogram_%d ("
+                "target_id INTEGER NOT NULL, kind TEXT NOT NULL, "
+                "t INTEGER NOT NULL, content TEXT NOT NULL, "
+                "PRIMARY KEY (target_id, kind, t))" % resolution
+            )
+        self._conn.commit()
+
+    def get_resolution(self, resolution):
+        """Return the coarsest resolution not bigger than the wanted one
+        """
+        result = self.resolutions[0]
+        for candidate in self.resolutions:
+            if candidate <= resolution:
+                result = candidate
+        return result
+
+    def _target(self, target):
+        row = self.conn.execute(
+            "SELECT id, last_update FROM target WHERE name = ?", (target,)
+        ).fetchone()
+        return row if row is not None else (None, None)
+
+    def _create_target(self, target):
+        return self.conn.execute(
+            "INSERT INTO target (name) VALUES (?)", (target,)
+        ).lastrowid
+
+    def last_update(self, target):
+        return self._target(target)[1]
+
+    def update(self, target, points):
+        tid, last = self._target(target)
+        points = [(t, counters) for t, counters in points
+                  if last is None or t > last]
+        if not points:
+            return 0
+        assignments = ", ".join(["%s = %s + ?" % (v, v) for v in variables])
+        with self.conn:
+            if tid is None:
+                tid = self._create_target(target)
+            for resolution in self.resolutions:
+                buckets = {}
+                for t, counters in points:
+                    values = buckets.setdefault(
+                        t - t % resolution, [0] * len(variables)
+                    )
+                    for pos, v in enumerate(variables):
+                        values[pos] += counters[v]
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO sample_%d (t, target_id) "
+                    "VALUES (?, ?)" % resolution,
+                    [(t, tid) for t in buckets]
+                )
+                self.conn.executemany(
+                    "UPDATE sample_%d SET %s WHERE t = ? AND target_id = ?"
+                    % (resolution, assignments),
+                    [tuple(values) + (t, tid)
+                     for t, values in buckets.iteritems()]
+                )
+            self.conn.execute(
+                "UPDATE target SET last_update = ? WHERE id = ?",
+                (points[-1][0], tid)
+            )
+        if self.verbose:
+            print "[sqlite] %d minutes recorded for %s" % (len(points), target)
+        return len(points)
+
+    def fetch(self, target, start, end, resolution=rrdstep):
+        """Return the counters of a target over a period
+
+        Rows are read from the coarsest table not bigger than the
+        wanted resolution and summed into buckets by the database.
+        """
+        table = self.get_resolution(resolution)
+        resolution = max(table, resolution - resolution % table)
+        start -= start % resolution
+        tid = self._target(target)[0]
+        if tid is None:
+            return resolution, []
+        rows = dict(
+            (row[0], row[1:]) for row in self.conn.execute(
+                "SELECT t - t %% %d AS bucket, %s FROM sample_%d "
+                "WHERE target_id = ? AND t >= ? AND t < ? GROUP BY bucket"
+                % (resolution,
+                   ", ".join(["SUM(%s)" % v for v in variables]), table),
+                (tid, start, end)
+            )
+        )
+        zeros = [0] * len(variables)
+        return resolution, [
+            (t, dict(zip(variables, rows.get(t, zeros))))
+            for t in range(start, end, resolution)
+        ]
+
+    def top(self, variable, start, end, limit=10):
+        """Rank domains by the total of a variable over a period
+
+        The coarsest table giving at least a hundred buckets over the
+        period is used: boundaries are rounded to its resolution.
+        """
+        if not variable in variables:
+            raise ValueError("unknown variable %s" % variable)
+        resolution = self.get_resolution((end - start) / 100)
+        return self.conn.execute(
+            "SELECT target.name, SUM(s.%s) AS total FROM sample_%d s "
+            "INNER JOIN target ON target.id = s.target_id "
+            "WHERE s.t >= ? AND s.t < ? AND target.name != 'global' "
+            "GROUP BY target.name ORDER BY total DESC LIMIT ?"
+            % (variable, resolution),
+            (start - start % resolution, end - end % resolution, limit)
+        ).fetchall()
+
+    def update_talkers(self, target, bucket, kind, sketch):
+        """Record top talkers of a target
+
+        The given sketch is merged with the one already recorded for
+        the same hour, if any.
+        """
+        with self.conn:
+            tid = self._target(target)[0]
+            if tid is None:
+                tid = self._create_target(target)
+            row = self.conn.execute(
+                "SELECT content FROM talkers WHERE target_id = ? "
+                "AND kind = ? AND t = ?", (tid, kind, bucket)
+            ).fetchone()
+            if row is not None:
+                current = SpaceSaving.load(json.loads(row[0]), sketch.capacity)
+                current.merge(sketch)
+                sketch = current
+            self.conn.execute(
+                "INSERT OR REPLACE INTO talkers (target_id, kind, t, content) "
+                "VALUES (?, ?, ?, ?)",
+                (tid, kind, bucket, json.dumps(sketch.dump()))
+            )
+
+    def talkers(self, target, kind, start, end, limit=10):
+        """Return the top talkers of a target over a period
+
+        Hourly sketches are merged: boundaries are rounded to the hour.
+        """
+        tid = self._target(target)[0]
+        if tid is None:
+            return []
+        result = None
+        for row in self.conn.execute(
+                "SELECT content FROM talkers WHERE target_id = ? "
+                "AND kind = ? AND t >= ? AND t < ?",
+                (tid, kind, start - start % talkers_step, end)):
+            sketch = SpaceSaving.load(json.loads(row[0]))
+            if result is None:
+                result = sketch
+            else:
+                result.merge(sketch)
+        return result.top(limit) if result is not None else []
+
+    def update_histograms(self, target, kind, points):
+        """Record histograms (latencies, spam scores) of a target
+
+        Histograms are merged with the ones already recorded for the
+        same buckets, so recent minutes can be updated by the next
+        runs.
+        """
+        cls = histograms.kinds[kind]
+        with self.conn:
+            tid = self._target(target)[0]
+            if tid is None:
+                tid = self._create_target(target)
+            for resolution in self.resolutions:
+                buckets = {}
+                for t, histogram in points:
+                    buckets.setdefault(t - t % resolution, cls()) \
+                        .merge(histogram)
+                for t, histogram in buckets.iteritems():
+                    row = self.conn.execute(
+                        "SELECT content FROM histogram_%d WHERE target_id = ? "
+                        "AND kind = ? AND t = ?" % resolution, (tid, kind, t)
+                    ).fetchone()
+                    if row is not None:
+                        histogram.merge(cls.load(json.loads(row[0])))
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO histogram_%d "
+                        "(target_id, kind, t, content) VALUES (?, ?, ?, ?)"
+                        % resolution,
+                        (tid, kind, t, json.dumps(histogram.dump()))
+                    )
+
+    def fetch_histograms(self, target, kind, start, end, resolution=rrdstep):
+        cls = histograms.kinds[kind]
+        table = self.get_resolution(resolution)
+        resolution = max(table, resolution - resolution % table)
+        start -= start % resolution
+        tid = self._target(target)[0]
+        if tid is None:
+            return resolution, []
+        buckets = {}
+        for t, content in self.conn.execute(
+                "SELECT t, content FROM histogram_%d WHERE target_id = ? "
+                "AND kind = ? AND t >= ? AND t < ?" % table,
+                (tid, kind, start, end)):
+            buckets.setdefault(t - t % resolution, cls()) \
+                .merge(cls.load(json.loads(content)))
+        return resolution, [
+            (t, buckets.get(t, cls()))
+            for t in range(start, end, resolution)
+        ]
+
+
+def get_stores(rrdcached=None, **kwargs):
+    """Return the stores enabled in the online panel
+
+    The RRD store is always enabled.
+
+    :param rrdcached: rrdcached address (overrides the parameter)
+    :return: a list of ``StatsStore`` instances
+    """
+    if rrdcached is None:
+        rrdcached = parameters.get_admin("RRDCACHED_ADDRESS", app="stats")
+    stores = [RRDStore(
+        parameters.get_admin("RRD_ROOTDIR", app="stats"), rrdcached, **kwargs
+    )]
+    if parameters.get_admin("SQLITE_STORE", app="stats") == "yes":
+        stores.append(SQLiteStore(
+            parameters.get_admin("SQLITE_PATH", app="stats"), **kwargs
+        ))
+    return stores
+
+
+def get_query_store():
+    """Return the store used to answer queries
+
+    The SQLite store is preferred if it is enabled.
+
+    :return: a ``StatsStore`` instance
+    """
+    return get_stores()[-1]
@@ -0,0 +1,710 @@
+# coding: utf-8
+import os
+import sys
+import shutil
+import gzip
+import glob
+import tempfile
+from django.test import TestCase
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+from django.utils.http import http_date
+from modoboa.lib import parameters
+from modoboa.lib.tests import ModoTestCase
+from modoboa.core.models import Extension
+from modoboa.extensions.stats import Stats
+from modoboa.extensions.admin.factories import DomainFactory
+from modoboa.extensions.stats.management.commands.logparser import LogParser
+from modoboa.extensions.stats.storage import (
+    variables, heartbeat, RRDStore, SQLiteStore
+)
+from modoboa.extensions.stats.sketches import SpaceSaving
+from modoboa.extensions.stats.histograms import LogHistogram, ScoreHistogram
+
+
+MSG1 = """Oct 19 10:00:01 mx postfix/cleanup[1001]: 1A2B3C4D: message-id=<1@test.com>
+Oct 19 10:00:01 mx postfix/qmgr[1002]: 1A2B3C4D: from=<user@test.com>, size=1000, nrcpt=1 (queue active)
+Oct 19 10:00:02 mx postfix/smtp[1003]: 1A2B3C4D: to=<john@external.com>, relay=external.com[1.2.3.4]:25, delay=0.5, delays=0.1/0.1/0.2/0.1, dsn=2.0.0, status=sent (250 ok)
+"""
+
+MSG2 = """Oct 19 10:05:01 mx postfix/cleanup[1001]: 5E6F7A8B: message-id=<2@external.com>
+Oct 19 10:05:01 mx postfix/qmgr[1002]: 5E6F7A8B: from=<john@external.com>, size=2000, nrcpt=1 (queue active)
+Oct 19 10:05:02 mx postfix/virtual[1004]: 5E6F7A8B: to=<user@test.com>, relay=virtual, delay=0.3, delays=0.1/0/0/0.2, dsn=2.0.0, status=sent (delivered to maildir)
+"""
+
+BOUNCE = """Oct 19 10:10:01 mx postfix/qmgr[1002]: 9A9B9C9D: from=<user@test.com>, size=500, nrcpt=1 (queue active)
+Oct 19 10:10:02 mx postfix/smtp[1003]: 9A9B9C9D: to=<nobody@test.com>, relay=none, delay=0.2, delays=0.1/0/0.1/0, dsn=5.1.1, status=bounced (unknown user)
+"""
+
+REJECT = """Oct 19 10:15:01 mx postfix/smtpd[1005]: NOQUEUE: reject: RCPT from unknown[10.0.0.1]: 554 5.7.1 <user@test.com>: Relay access denied; from=<spam@spam.com> to=<user@test.com> proto=ESMTP helo=<spam>
+"""
+
+AMAVIS = """Oct 19 10:20:01 mx postfix/qmgr[1002]: 3C3C3C3C: from=<spam@spam.com>, size=3000, nrcpt=2 (queue active)
+Oct 19 10:20:02 mx amavis[2001]: (02001-01) Blocked SPAM {DiscardedInbound,Quarantined}, [10.0.0.1]:4321 [10.0.0.1] <spam@spam.com> -> <user@test.com>,<admin@test.com>, quarantine: spam-AbC.gz, Queue-ID: 3C3C3C3C, Message-ID: <3@spam.com>, mail_id: AbC, Hits: 12.5, size: 3000, 1200 ms
+Oct 19 10:20:02 mx postfix/smtp[1003]: 3C3C3C3C: to=<user@test.com>, relay=127.0.0.1[127.0.0.1]:10024, delay=1.3, delays=0.1/0/0/1.2, dsn=2.7.0, status=sent (250 2.7.0 Ok, discarded, id=02001-01 - spam)
+Oct 19 10:20:03 mx amavis[2002]: (02002-01) Blocked INFECTED (Eicar-Test-Signature) {DiscardedInbound,Quarantined}, [10.0.0.2]:4321 [10.0.0.2] <virus@spam.com> -> <user@test.com>, quarantine: virus-DeF, Queue-ID: 4D4D4D4D, Message-ID: <4@spam.com>, mail_id: DeF, Hits: -, size: 800, 300 ms
+Oct 19 10:20:04 mx amavis[2003]: (02003-01) Passed CLEAN {RelayedInbound}, [10.0.0.3]:4321 [10.0.0.3] <john@external.com> -> <user@test.com>, Queue-ID: 5E5E5E5E, Message-ID: <5@external.com>, mail_id: GhI, Hits: -1.2, size: 900, queued_as: 6F6F6F6F, 250 ms
+"""
+
+
+class SpaceSavingTestCase(TestCase):
+
+    def test_heavy_hitters(self):
+        """Check that frequent keys are kept with bounded errors."""
+        sketch = SpaceSaving(capacity=5)
+        for pos in range(100):
+            sketch.add("heavy")
+            sketch.add("other%d" % pos)
+        self.assertEqual(len(sketch), 5)
+        key, count, error = sketch.top(1)[0]
+        self.assertEqual(key, "heavy")
+        self.assertTrue(count - error <= 100 <= count)
+
+    def test_merge(self):
+        first = SpaceSaving.load([["a", 3, 0], ["b", 1, 0]])
+        second = SpaceSaving.load([["a", 1, 0], ["c", 2, 0]])
+        first.merge(second)
+        self.assertEqual(first.top(2), [("a", 4, 0), ("c", 2, 0)])
+        self.assertEqual(SpaceSaving.load(first.dump()), first)
+
+
+class LogHistogramTestCase(TestCase):
+
+    def test_percentiles(self):
+        """Check that percentiles are bounded by their bucket."""
+        histogram = LogHistogram()
+        self.assertIsNone(histogram.percentile(50))
+        for pos in range(1, 101):
+            histogram.add(pos / 10.0)
+        for p in [50, 95, 99]:
+            value = histogram.percentile(p)
+            self.assertTrue(p / 10.0 <= value <= p / 10.0 * 1.19)
+        histogram.add(0)
+        self.assertEqual(histogram.percentile(0), 0.01)
+
+    def test_scores(self):
+        histogram = ScoreHistogram()
+        for score in [-1.2, 3.5, 3.9, 12.5, 1000]:
+            histogram.add(score)
+        self.assertEqual(histogram.percentile(50), 4)
+        self.assertEqual(histogram.percentile(100), 51)
+        self.assertEqual(histogram.percentile(0), -1)
+
+    def test_merge(self):
+        first = LogHistogram()
+        first.add(1)
+        second = LogHistogram.load([[LogHistogram.index(100), 3]])
+        first.merge(second)
+        self.assertEqual(first.total, 4)
+        self.assertEqual(LogHistogram.load(first.dump()), first)
+        self.assertEqual(first.percentile(50), LogHistogram.upper_bound(
+            LogHistogram.index(100)
+        ))
+
+
+class LogParserTestCase(TestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        DomainFactory.create(name="test.com")
+        self.workdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.workdir, "mail.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _write(self, content, mode="a", path=None):
+        fp = open(path or self.logfile, mode)
+        fp.write(content)
+        fp.close()
+
+    def _parse(self, workdir=None, **options):
+        options.setdefault("logfile", self.logfile)
+        options.update(debug=False, verbose=False)
+        parser = LogParser(options, workdir or self.workdir)
+        parser.parse()
+        parser.save_checkpoint()
+        return parser
+
+    def _totals(self, parser, domain="test.com"):
+        totals = {}
+        for counters in parser.data[domain].values():
+            for name, value in counters.iteritems():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def test_incremental(self):
+        """Check that a second run only parses new lines."""
+        self._write(MSG1)
+        totals = self._totals(self._parse())
+        self.assertEqual(totals["sent"], 1)
+        self.assertEqual(totals["size_sent"], 1000)
+
+        self._write(MSG2)
+        totals = self._totals(self._parse())
+        self.assertEqual(totals["sent"], 0)
+        self.assertEqual(totals["recv"], 1)
+        self.assertEqual(totals["size_recv"], 2000)
+
+        totals = self._totals(self._parse())
+        self.assertEqual(totals, {})
+
+    def test_reset(self):
+        self._write(MSG1)
+        self._parse()
+        totals = self._totals(self._parse(reset=True))
+        self.assertEqual(totals["sent"], 1)
+
+    def test_partial_line(self):
+        """Check that a partial line is read again by the next run."""
+        lines = MSG1.splitlines(True)
+        self._write("".join(lines[:2]) + lines[2][:20])
+        totals = self._totals(self._parse())
+        self.assertEqual(totals, {})
+
+        self._write(lines[2][20:])
+        totals = self._totals(self._parse())
+        self.assertEqual(totals["sent"], 1)
+
+    def test_rotation(self):
+        """Check that the end of a rotated (compressed) file is read."""
+        lines = MSG2.splitlines(True)
+        self._write(MSG1 + lines[0])
+        self._parse()
+
+        self._write(lines[1])
+        fp = gzip.open("%s.1.gz" % self.logfile, "wb")
+        fp.write(open(self.logfile).read())
+        fp.close()
+        os.unlink(self.logfile)
+        self._write(lines[2])
+        totals = self._totals(self._parse())
+        self.assertEqual(totals["sent"], 0)
+        self.assertEqual(totals["recv"], 1)
+        self.assertEqual(totals["size_recv"], 2000)
+
+    def test_queue_id_removed(self):
+        """Check that a queue ID is forgotten once postfix removed it."""
+        self._write(
+            MSG1 + "Oct 19 10:00:02 mx postfix/qmgr[1002]: 1A2B3C4D: removed\n"
+        )
+        parser = self._parse()
+        self.assertEqual(parser.workdict, {})
+        self.assertEqual(parser.qstats["removed"], 1)
+
+    def test_queue_id_expired(self):
+        """Check that messages that never complete are evicted."""
+        lines = MSG1.splitlines(True)
+        self._write("".join(lines[:2]))
+        parser = self._parse()
+        self.assertIn("1A2B3C4D", parser.workdict)
+
+        self._write(
+            "Oct 21 10:00:02 mx postfix/qmgr[1002]: 9C9C9C9C: removed\n"
+            + lines[2].replace("Oct 19", "Oct 21")
+        )
+        parser = self._parse(max_queue_age=1)
+        self.assertEqual(parser.workdict, {})
+        self.assertEqual(parser.qstats["expired"], 1)
+        self.assertEqual(parser.qstats["unknown"], 1)
+
+    def test_parallel(self):
+        """Check that parallel parsing gives the same results."""
+        logfiles = []
+        for host, content in [("mx1", MSG1), ("mx2", MSG2), ("mx3", MSG1)]:
+            path = os.path.join(self.workdir, "%s.log" % host)
+            self._write(content.replace(" mx ", " %s " % host), path=path)
+            logfiles.append(path)
+        seqdir = tempfile.mkdtemp(dir=self.workdir)
+        pardir = tempfile.mkdtemp(dir=self.workdir)
+        sequential = self._parse(workdir=seqdir, logfile=logfiles)
+        parallel = self._parse(workdir=pardir, logfile=logfiles, jobs=2)
+        self.assertEqual(parallel.data, sequential.data)
+        self.assertEqual(parallel.qstats, sequential.qstats)
+        self.assertEqual(parallel.checkpoint, sequential.checkpoint)
+        self.assertEqual(self._totals(parallel)["sent"], 2)
+
+        for path in logfiles:
+            self._write(MSG2, path=path)
+        sequential = self._parse(workdir=seqdir, logfile=logfiles)
+        parallel = self._parse(workdir=pardir, logfile=logfiles, jobs=3)
+        self.assertEqual(parallel.data, sequential.data)
+        self.assertEqual(self._totals(parallel)["recv"], 3)
+
+    def test_talkers(self):
+        self._write(MSG1 + BOUNCE + REJECT)
+        parser = self._parse(year=2013)
+        buckets = parser.talkers["test.com"]
+        self.assertEqual(len(buckets), 1)
+        sketches = buckets.values()[0]
+        self.assertEqual(sketches["senders"].top(),
+                         [("user@test.com", 2, 0)])
+        self.assertEqual(sketches["bounced_recipients"].top(),
+                         [("nobody@test.com", 1, 0)])
+        self.assertEqual(sketches["rejected_clients"].top(),
+                         [("10.0.0.1", 1, 0)])
+        self.assertEqual(parser.talkers["global"], buckets)
+
+    def test_latencies(self):
+        self._write(MSG1 + MSG2)
+        parser = self._parse(year=2013)
+        self.assertEqual(len(parser.histograms["test.com"]), 2)
+        totals = dict.fromkeys(["queue", "delivery"], 0)
+        for histograms in parser.histograms["global"].values():
+            for kind, histogram in histograms.iteritems():
+                totals[kind] += histogram.total
+        self.assertEqual(totals, {"queue": 2, "delivery": 2})
+        t = min(parser.histograms["test.com"])
+        self.assertEqual(
+            parser.histograms["test.com"][t]["queue"].percentile(100),
+            LogHistogram.upper_bound(LogHistogram.index(0.2))
+        )
+
+    def test_amavis(self):
+        """Check that amavis lines feed spam and virus counters."""
+        self._write(AMAVIS)
+        parser = self._parse(year=2013)
+        totals = self._totals(parser)
+        self.assertEqual(totals["spam"], 2)
+        self.assertEqual(totals["virus"], 1)
+        self.assertEqual(totals["recv"], 0)
+        self.assertEqual(self._totals(parser, "global")["spam"], 2)
+        scores = ScoreHistogram()
+        for hists in parser.histograms["test.com"].values():
+            if "spam_score" in hists:
+                scores.merge(hists["spam_score"])
+        self.assertEqual(scores.dump(), [[-2, 1], [12, 1]])
+
+    def test_sqlite_store(self):
+        """Check that collected counters are recorded into the stores."""
+        self._write(MSG1 + MSG2)
+        store = SQLiteStore(os.path.join(self.workdir, "stats.db"))
+        parser = LogParser(
+            dict(logfile=self.logfile, debug=False, verbose=False),
+            self.workdir, year=2013, stores=[store]
+        )
+        parser.process()
+        start = min(parser.data["test.com"])
+        start -= start % 3600
+        step, rows = store.fetch("test.com", start, start + 3600, 3600)
+        self.assertEqual(step, 3600)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][1]["sent"], 1)
+        self.assertEqual(rows[0][1]["recv"], 1)
+        self.assertEqual(store.top("size_recv", start - 3600, start + 3600),
+                         [("test.com", 2000)])
+
+
+class FakeRRDtool(object):
+    """Records calls made to the rrdtool module."""
+
+    def __init__(self):
+        self.calls = []
+        self.info_result = {}
+
+    def create(self, fname, *args):
+        self.calls.append(("create", fname) + args)
+        open(fname, "w").close()
+
+    def info(self, fname, *args):
+        self.calls.append(("info", fname) + args)
+        return self.info_result
+
+    def tune(self, fname, *args):
+        self.calls.append(("tune", fname) + args)
+
+    def update(self, fname, *args):
+        self.calls.append(("update", fname) + args)
+
+    def last(self, fname, *args):
+        self.calls.append(("last", fname) + args)
+        return self.info_result["last_update"]
+
+    def graph(self, path, *args):
+        self.calls.append(("graph", path) + args)
+        open(path, "w").write("PNG")
+
+
+class FakeRRDtoolMixin(object):
+
+    def _install_rrdtool(self):
+        self.rrdtool = FakeRRDtool()
+        self.old_rrdtool = sys.modules.get("rrdtool")
+        sys.modules["rrdtool"] = self.rrdtool
+
+    def _uninstall_rrdtool(self):
+        if self.old_rrdtool is None:
+            del sys.modules["rrdtool"]
+        else:
+            sys.modules["rrdtool"] = self.old_rrdtool
+
+
+class RRDStoreTestCase(FakeRRDtoolMixin, TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self._install_rrdtool()
+
+    def tearDown(self):
+        self._uninstall_rrdtool()
+        shutil.rmtree(self.workdir)
+
+    def _points(self, times):
+        points = []
+        for t in times:
+            counters = dict.fromkeys(variables, 0)
+            counters["sent"] = 1
+            points.append((t, counters))
+        return points
+
+    def test_batched_update(self):
+        """Check that all minutes are sent in a single call."""
+        t0 = 1382176800
+        times = [t0, t0 + 60, t0 + 3600, t0 + 3 * heartbeat]
+        store = RRDStore(self.workdir)
+        self.assertEqual(store.update("test.com", self._points(times)), 4)
+
+        fname = os.path.join(self.workdir, "test.com.rrd")
+        create, update = self.rrdtool.calls
+        self.assertEqual(create[:4], ("create", fname, "--start", str(t0 - 60)))
+        self.assertIn("DS:sent:ABSOLUTE:%d:0:U" % heartbeat, create)
+        one = ":".join(["1"] + ["0"] * (len(variables) - 1))
+        zero = ":".join(["0"] * len(variables))
+        self.assertEqual(update, (
+            "update", fname, "-t", ":".join(variables),
+            "%d:%s" % (t0, one), "%d:%s" % (t0 + 60, one),
+            "%d:%s" % (t0 + 3540, zero), "%d:%s" % (t0 + 3600, one),
+            "%d:%s" % (t0 + 3600 + heartbeat, zero),
+            "%d:%s" % (t0 + 3600 + 2 * heartbeat, zero),
+            "%d:%s" % (t0 + 3 * heartbeat - 60, zero),
+            "%d:%s" % (t0 + 3 * heartbeat, one),
+        ))
+
+    def test_existing_rrd(self):
+        """Check that old files are tuned and recorded minutes skipped."""
+        t0 = 1382176800
+        open(os.path.join(self.workdir, "test.com.rrd"), "w").close()
+        self.rrdtool.info_result = {
+            "last_update": t0, "ds[sent].minimal_heartbeat": 120
+        }
+        store = RRDStore(self.workdir, "unix:/tmp/sock")
+        self.assertEqual(
+            store.update("test.com", self._points([t0, t0 + 60])), 1
+        )
+        info, tune, update = self.rrdtool.calls
+        self.assertEqual(info[2:], ("--daemon", "unix:/tmp/sock"))
+        self.assertEqual(tune[2:], ("--heartbeat", "sent:%d" % heartbeat))
+        self.assertEqual(update[2:6], (
+            "--daemon", "unix:/tmp/sock", "-t", ":".join(variables)
+        ))
+        self.assertEqual(len(update), 7)
+
+
+class SQLiteStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.store = SQLiteStore(os.path.join(self.workdir, "stats.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _points(self, times, **values):
+        points = []
+        for t in times:
+            counters = dict.fromkeys(variables, 0)
+            counters.update(values)
+            points.append((t, counters))
+        return points
+
+    def test_update(self):
+        """Check that recorded minutes are skipped."""
+        t0 = 1382176800
+        self.assertIsNone(self.store.last_update("test.com"))
+        self.assertEqual(
+            self.store.update("test.com", self._points([t0, t0 + 60], sent=1)),
+            2
+        )
+        self.assertEqual(
+            self.store.update("test.com", self._points([t0 + 60, t0 + 120],
+                                                       sent=1)),
+            1
+        )
+        self.assertEqual(self.store.last_update("test.com"), t0 + 120)
+        step, rows = self.store.fetch("test.com", t0, t0 + 240)
+        self.assertEqual(step, 60)
+        self.assertEqual([counters["sent"] for t, counters in rows],
+                         [1, 1, 1, 0])
+
+    def test_rollups(self):
+        """Check that coarse resolutions sum minutes."""
+        t0 = 1382176800
+        self.store.update(
+            "test.com", self._points(range(t0, t0 + 7200, 60), recv=2)
+        )
+        step, rows = self.store.fetch("test.com", t0 + 30, t0 + 3 * 3600, 5000)
+        self.assertEqual(step, 3600)
+        self.assertEqual([(t, counters["recv"]) for t, counters in rows],
+                         [(t0, 120), (t0 + 3600, 120), (t0 + 7200, 0)])
+        step, rows = self.store.fetch("unknown.com", t0, t0 + 3600)
+        self.assertEqual(rows, [])
+
+    def test_top(self):
+        t0 = 1382176800
+        self.store.update("global", self._points([t0], sent=6))
+        self.store.update("a.com", self._points([t0], sent=1))
+        self.store.update("b.com", self._points([t0, t0 + 60], sent=2))
+        self.store.update("c.com", self._points([t0 + 3600], sent=3))
+        self.assertEqual(self.store.top("sent", t0, t0 + 3600),
+                         [("b.com", 4), ("a.com", 1)])
+        self.assertEqual(self.store.top("sent", t0, t0 + 7200, limit=1),
+                         [("b.com", 4)])
+        self.assertRaises(ValueError, self.store.top, "unknown", t0, t0 + 60)
+
+    def test_latency(self):
+        """Check that histograms are merged into rollups."""
+        t0 = 1382176800
+        fast, slow = LogHistogram(), LogHistogram()
+        fast.add(0.1)
+        slow.add(10, 3)
+        self.store.update_histograms("test.com", "queue",
+                                  [(t0, fast), (t0 + 60, slow)])
+        self.store.update_histograms("test.com", "queue", [(t0 + 60, fast)])
+        step, rows = self.store.fetch_histograms("test.com", "queue", t0,
+                                                 t0 + 180)
+        self.assertEqual([histogram.total for t, histogram in rows], [1, 4, 0])
+        step, rows = self.store.fetch_histograms(
+            "test.com", "queue", t0, t0 + 3600, 3600
+        )
+        self.assertEqual(step, 3600)
+        self.assertEqual(rows[0][1].total, 5)
+        self.assertEqual(rows[0][1].percentile(50),
+                         LogHistogram.upper_bound(LogHistogram.index(10)))
+
+    def test_talkers(self):
+        """Check that sketches of the same hour are merged."""
+        t0 = 1382176800
+        self.store.update_talkers(
+            "test.com", t0, "senders", SpaceSaving.load([["a", 2, 0]])
+        )
+        self.store.update_talkers(
+            "test.com", t0, "senders", SpaceSaving.load([["b", 3, 0]])
+        )
+        self.store.update_talkers(
+            "test.com", t0 + 3600, "senders", SpaceSaving.load([["a", 2, 0]])
+        )
+        self.assertEqual(self.store.talkers("test.com", "senders", t0, t0 + 60),
+                         [("b", 3, 0), ("a", 2, 0)])
+        self.assertEqual(
+            self.store.talkers("test.com", "senders", t0, t0 + 7200, 1),
+            [("a", 4, 0)]
+        )
+        self.assertEqual(
+            self.store.talkers("test.com", "rejected_clients", t0, t0 + 60), []
+        )
+
+
+class GraphViewTestCase(FakeRRDtoolMixin, ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(GraphViewTestCase, self).setUp()
+        Extension.objects.create(name="stats", enabled=True)
+        Stats().load()
+        self.workdir = tempfile.mkdtemp()
+        for name in ["RRD_ROOTDIR", "IMG_ROOTDIR"]:
+            parameters.save_admin(name, self.workdir, app="stats")
+        open(os.path.join(self.workdir, "global.rrd"), "w").close()
+        self._install_rrdtool()
+        self.rrdtool.info_result["last_update"] = 1382176800
+        self.url = reverse("modoboa.extensions.stats.views.graph") \
+            + "?gset=mailtraffic&graph=avgtraffic&period=day"
+
+    def tearDown(self):
+        self._uninstall_rrdtool()
+        shutil.rmtree(self.workdir)
+
+    def _graph_calls(self):
+        return [call for call in self.rrdtool.calls if call[0] == "graph"]
+
+    def test_render_on_demand(self):
+        response = self.clt.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response["Last-Modified"], http_date(1382176800))
+        self.assertEqual(len(self._graph_calls()), 1)
+
+        response = self.clt.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self._graph_calls()), 1)
+
+        self.rrdtool.info_result["last_update"] += 60
+        response = self.clt.get(self.url)
+        self.assertEqual(len(self._graph_calls()), 2)
+        self.assertEqual(len(os.listdir(self.workdir)), 2)
+
+    def test_if_none_match(self):
+        etag = self.clt.get(self.url, HTTP_ACCEPT_LANGUAGE="en")["ETag"]
+        self.assertEqual(etag, '"1382176800-en"')
+        response = self.clt.get(
+            self.url, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_LANGUAGE="en"
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self._graph_calls()), 1)
+
+        # Graphs are translated
+        response = self.clt.get(
+            self.url, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_LANGUAGE="fr"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"1382176800-fr"')
+
+    def test_purge_custom_graphs(self):
+        url = self.url.replace("period=day", "period=custom") \
+            + "&start=2013-10-01&end=2013-10-20"
+        self.clt.get(url)
+        path = glob.glob(os.path.join(self.workdir, "*.png"))[0]
+        os.utime(path, (0, 0))
+        self.clt.get(url.replace("end=2013-10-20", "end=2013-10-19"))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(os.listdir(self.workdir)), 2)
+
+    def test_unknown_domain(self):
+        response = self.clt.get(self.url + "&domain=unknown.com")
+        self.assertEqual(response.status_code, 404)
+
+
+class SeriesViewTestCase(ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(SeriesViewTestCase, self).setUp()
+        Extension.objects.create(name="stats", enabled=True)
+        Stats().load()
+        self.workdir = tempfile.mkdtemp()
+        parameters.save_admin("SQLITE_STORE", "yes", app="stats")
+        parameters.save_admin(
+            "SQLITE_PATH", os.path.join(self.workdir, "stats.db"), app="stats"
+        )
+        self.t0 = 1382176800
+        points = []
+        for t in range(self.t0, self.t0 + 3600, 60):
+            counters = dict.fromkeys(variables, 0)
+            counters.update(sent=3, recv=1)
+            points.append((t, counters))
+        SQLiteStore(os.path.join(self.workdir, "stats.db")).update(
+            "global", points
+        )
+        self.url = reverse("modoboa.extensions.stats.views.series") \
+            + "?gset=mailtraffic&graph=avgtraffic"
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_predefined_period(self):
+        response = self.clt.get(self.url + "&period=day")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Last-Modified"],
+                         http_date(self.t0 + 3540))
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["end"], self.t0 + 3600)
+        self.assertEqual(content["step"], 180)
+        self.assertEqual(len(content["series"][0]["data"]), 480)
+        recv, sent = content["series"]
+        self.assertEqual((recv["name"], recv["total"]), ("recv", 60))
+        self.assertEqual((sent["name"], sent["total"]), ("sent", 180))
+        self.assertEqual(sent["data"][-1], [self.t0 + 3420, 3])
+
+        response = self.clt.get(
+            self.url + "&period=day",
+            HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_custom_period(self):
+        response = self.clt.get(
+            self.url + "&period=custom&start=2013-10-01&end=2013-10-20"
+        )
+        self.assertEqual(response.status_code, 200)
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["series"][1]["total"], 180)
+        self.assertTrue(len(content["series"][1]["data"]) <= 540)
+
+        histogram = LogHistogram()
+        histogram.add(0.5)
+        SQLiteStore(os.path.join(self.workdir, "stats.db")).update_histograms(
+            "global", "queue", [(self.t0, histogram)]
+        )
+        response = self.clt.get(
+            reverse("modoboa.extensions.stats.views.series")
+            + "?gset=latency&graph=queuelatency&period=custom"
+            + "&start=2013-10-01&end=2013-10-20"
+        )
+        content = simplejson.loads(response.content)
+        self.assertFalse(content["stacked"])
+        self.assertEqual([serie["name"] for serie in content["series"]],
+                         ["p50", "p95", "p99"])
+        values = [value for t, value in content["series"][0]["data"]
+                  if value is not None]
+        self.assertEqual(values, [LogHistogram.upper_bound(
+            LogHistogram.index(0.5)
+        )])
+
+        response = self.clt.get(
+            self.url + "&period=custom&start=2013-10-20&end=2013-10-01",
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["status"], "ko")
+
+    def test_latency_requires_sqlite(self):
+        parameters.save_admin("SQLITE_STORE", "no", app="stats")
+        response = self.clt.get(
+            reverse("modoboa.extensions.stats.views.series")
+            + "?gset=latency&graph=queuelatency&period=day",
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["status"], "ko")
+        self.assertEqual(content["respmsg"], "Unknown graphic set")
+
+
+class TalkersViewTestCase(ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(TalkersViewTestCase, self).setUp()
+        Extension.objects.create(name="stats", enabled=True)
+        Stats().load()
+        self.workdir = tempfile.mkdtemp()
+        self.url = reverse("modoboa.extensions.stats.views.talkers") \
+            + "?period=custom&start=2013-10-19&end=2013-10-20"
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_talkers(self):
+        path = os.path.join(self.workdir, "stats.db")
+        parameters.save_admin("SQLITE_STORE", "yes", app="stats")
+        parameters.save_admin("SQLITE_PATH", path, app="stats")
+        SQLiteStore(path).update_talkers(
+            "global", 1382176800, "senders",
+            SpaceSaving.load([["user@test.com", 2, 0]])
+        )
+        counters = dict.fromkeys(variables, 0)
+        counters.update(recv=5)
+        SQLiteStore(path).update("test.com", [(1382176800, counters)])
+        response = self.clt.get(self.url)
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["status"], "ok")
+        self.assertIn("user@test.com", content["content"])
+        # Domains are ranked on global statistics
+        self.assertIn("Domains receiving the most messages", content["content"])
+        self.assertIn("test.com</td><td>5</td>", content["content"])
+
+    def test_rrd_only(self):
+        response = self.clt.get(
+            self.url, HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        content = simplejson.loads(response.content)
+        self.assertEqual(content["status"], "ko")
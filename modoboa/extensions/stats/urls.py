@@ -5,4 +5,7 @@ urlpatterns = patterns(
     'modoboa.extensions.stats.views',
     url(r'^$', 'index', name='fullindex'),
     url(r'^graphs/$', "graphs"),
+    url(r'^graph/$', "graph"),
+    url(r'^series/$', "series"),
+    url(r'^talkers/$', "talkers"),
 )
@@ -1,6 +1,10 @@
 # coding: utf-8
+import time
 from django.shortcuts import render
-from django.utils.translation import ugettext as _
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import http_date
+from django.utils import translation
+from django.utils.translation import ugettext as _, ugettext_lazy
 from django.contrib.auth.decorators import (
     login_required, user_passes_test, permission_required
 )
@@ -13,6 +17,21 @@ from modoboa.extensions.admin.models import (
     Domain
 )
 from modoboa.extensions.stats.grapher import periods, str2Time, Grapher
+from modoboa.extensions.stats.storage import rrdstep, get_query_store
+from modoboa.extensions.stats.sketches import kinds
+
+talkers_labels = {
+    "senders": ugettext_lazy("Top senders"),
+    "rejected_clients": ugettext_lazy("Most rejected clients"),
+    "bounced_recipients": ugettext_lazy("Most bounced recipients")
+}
+
+# Domains are ranked by these variables on the global statistics
+rankings_labels = [
+    ("recv", ugettext_lazy("Domains receiving the most messages")),
+    ("sent", ugettext_lazy("Domains sending the most messages")),
+    ("reject", ugettext_lazy("Domains with the most rejected messages"))
+]
 
 
 @login_required
@@ -37,6 +56,24 @@ def index(request):
     })
 
 
+def check_domain_access(user, name):
+    """Check if a user can access statistics of a domain
+
+    :param user: a ``User`` instance
+    :param name: a domain name or "global"
+    """
+    if name == "global":
+        if not user.is_superuser:
+            raise PermDeniedException
+        return
+    try:
+        domain = Domain.objects.get(name=name)
+    except Domain.DoesNotExist:
+        raise Http404
+    if not user.can_access(domain):
+        raise PermDeniedException
+
+
 @login_required
 @user_passes_test(lambda u: u.group != "SimpleUsers")
 def graphs(request):
@@ -46,7 +83,7 @@ def graphs(request):
         raise ModoboaException(_("Unknown graphic set"))
     searchq = request.GET.get("searchquery", None)
     period = request.GET.get("period", "day")
-    tplvars = dict(graphs=[], period=period)
+    tplvars = dict(graphs=[], gset=gset, period=period)
     if searchq in [None, "global"]:
         if not request.user.is_superuser:
             if not Domain.objects.get_for_admin(request.user).count():
@@ -67,23 +104,212 @@ def graphs(request):
     if period == "custom":
         if not "start" in request.GET or not "end" in request.GET:
             raise ModoboaException(_("Bad custom period"))
-        start = request.GET["start"]
-        end = request.GET["end"]
-        G = Grapher()
-        period_name = "%s_%s" % (start.replace('-', ''), end.replace('-', ''))
-        for tpl in gsets[gset].get_graphs():
-            tplvars['graphs'].append(tpl.display_name)
-            G.process(
-                tplvars["domain"], period_name, str2Time(*start.split('-')),
-                str2Time(*end.split('-')), tpl
-            )
-        tplvars["period_name"] = period_name
-        tplvars["start"] = start
-        tplvars["end"] = end
-    else:
-        tplvars['graphs'] = gsets[gset].get_graph_names()
+        tplvars["start"] = request.GET["start"]
+        tplvars["end"] = request.GET["end"]
+    tplvars['graphs'] = gsets[gset].get_graph_names()
 
     return ajax_simple_response(dict(
         status="ok",
         content=_render_to_string(request, "stats/graphs.html", tplvars)
     ))
+
+
+def get_graph_request(request):
+    """Validate the parameters of a graph request
+
+    :param request: a ``Request`` instance
+    :return: a (graph template, domain, period, start, end) tuple
+    """
+    gsets = events.raiseDictEvent("GetGraphSets")
+    gset = request.GET.get("gset", None)
+    if not gset in gsets:
+        raise ModoboaException(_("Unknown graphic set"))
+    name = request.GET.get("graph", None)
+    for tpl in gsets[gset].get_graphs():
+        if tpl.display_name == name:
+            break
+    else:
+        raise ModoboaException(_("Unknown graphic"))
+    domain = request.GET.get("domain", "global")
+    check_domain_access(request.user, domain)
+    return (tpl, domain) + get_period(request)
+
+
+def get_period(request):
+    """Validate the period of a request
+
+    :param request: a ``Request`` instance
+    :return: a (period, start, end) tuple, start and end are None for
+             predefined periods
+    """
+    period = request.GET.get("period", "day")
+    start = end = None
+    if period == "custom":
+        try:
+            start = str2Time(*request.GET["start"].split('-'))
+            end = str2Time(*request.GET["end"].split('-'))
+        except (KeyError, TypeError):
+            start = end = 0
+        if not start or not end or start >= end:
+            raise ModoboaException(_("Bad custom period"))
+    elif not period in [p["name"] for p in periods]:
+        raise ModoboaException(_("Unknown period"))
+    return period, start, end
+
+
+def not_modified(request, last):
+    """Check the validator of a graph request
+
+    Graphs change when new data is recorded and when the language
+    changes (titles and legends are translated), so the ETag contains
+    both.
+
+    :param request: a ``Request`` instance
+    :param last: the last update of the statistics (epoch)
+    :return: a (ETag, ``HttpResponseNotModified`` or None) tuple
+    """
+    etag = '"%d-%s"' % (last, translation.get_language())
+    if request.META.get("HTTP_IF_NONE_MATCH") != etag:
+        return etag, None
+    response = HttpResponseNotModified()
+    response["ETag"] = etag
+    return etag, response
+
+
+@login_required
+@user_passes_test(lambda u: u.group != "SimpleUsers")
+def graph(request):
+    """Return a graph as a PNG image
+
+    Graphs are rendered on demand (see ``Grapher.render``). As an
+    image only changes when new data is recorded, conditional
+    requests are supported (see ``not_modified``).
+    """
+    tpl, domain, period, start, end = get_graph_request(request)
+    if tpl.histogram is not None:
+        raise ModoboaException(_("This graphic is only available as series"))
+    G = Grapher()
+    last = G.last_update(domain)
+    if last is None:
+        raise Http404
+    etag, response = not_modified(request, last)
+    if response is not None:
+        return response
+    path = G.render(domain, tpl, period, start, end)
+    if path is None:
+        raise Http404
+    fp = open(path, "rb")
+    try:
+        response = HttpResponse(fp.read(), content_type="image/png")
+    finally:
+        fp.close()
+    response["Last-Modified"] = http_date(last)
+    response["ETag"] = etag
+    return response
+
+
+@login_required
+@user_passes_test(lambda u: u.group != "SimpleUsers")
+def series(request):
+    """Return the data of a graph as JSON
+
+    The browser draws the chart itself. Counters are read from the
+    query store (see ``storage.get_query_store``) and consolidated
+    into about one point per pixel, so the response size does not
+    depend on the period. Values are given per minute, like the
+    PNG graphs.
+
+    Some graphs (latencies, spam scores) are built from histograms:
+    percentiles are computed for each point, missing values are null.
+    """
+    tpl, domain, period, start, end = get_graph_request(request)
+    store = get_query_store()
+    last = store.last_update(domain)
+    if last is None:
+        raise Http404
+    etag, response = not_modified(request, last)
+    if response is not None:
+        return response
+    if period != "custom":
+        end = last + rrdstep
+        start = end - [p["duration"] for p in periods
+                       if p["name"] == period][0]
+    resolution = max(rrdstep, (end - start) / tpl.width)
+    resolution += -resolution % rrdstep
+    content = {
+        "status": "ok", "title": u"%s: %s" % (domain, tpl.title),
+        "vertlabel": unicode(tpl.vertlabel), "start": start, "end": end,
+        "stacked": tpl.histogram is None, "series": []
+    }
+    if tpl.histogram is not None:
+        if not store.has_histograms:
+            raise ModoboaException(_("This graphic requires the SQLite store"))
+        step, rows = store.fetch_histograms(
+            domain, tpl.histogram, start, end, resolution
+        )
+        for name in sorted(tpl.vars.keys()):
+            content["series"].append({
+                "name": name, "legend": unicode(tpl.vars[name]["legend"]),
+                "color": tpl.vars[name]["color"], "total": None,
+                "data": [[t, histogram.percentile(int(name[1:]))]
+                         for t, histogram in rows]
+            })
+    else:
+        step, rows = store.fetch(domain, start, end, resolution)
+        for name in sorted(tpl.vars.keys()):
+            d = tpl.vars[name]
+            content["series"].append({
+                "name": name, "legend": unicode(d["legend"]),
+                "color": d["color"],
+                "total": sum([counters[name] for t, counters in rows]),
+                "data": [[t, round(counters[name] * 60.0 / step, 3)]
+                         for t, counters in rows]
+            })
+    content["step"] = step
+    response = ajax_simple_response(content)
+    response["Last-Modified"] = http_date(last)
+    response["ETag"] = etag
+    return response
+
+
+@login_required
+@user_passes_test(lambda u: u.group != "SimpleUsers")
+def talkers(request):
+    """Return the top talkers of a domain over a period
+
+    Top talkers are only recorded by the SQLite store. With global
+    statistics, domains are also ranked (see ``StatsStore.top``).
+    """
+    domain = request.GET.get("domain", "global")
+    check_domain_access(request.user, domain)
+    period, start, end = get_period(request)
+    if period != "custom":
+        end = int(time.time())
+        start = end - [p["duration"] for p in periods
+                       if p["name"] == period][0]
+    try:
+        limit = int(request.GET.get("limit", 10))
+    except ValueError:
+        raise ModoboaException(_("Invalid request"))
+    store = get_query_store()
+    if not store.has_talkers:
+        raise ModoboaException(_("Top talkers require the SQLite store"))
+    tables = []
+    for kind in kinds:
+        tables.append({
+            "label": talkers_labels[kind],
+            "entries": store.talkers(domain, kind, start, end, limit)
+        })
+    rows = [tables]
+    if domain == "global":
+        rows.append([{
+            "label": label,
+            "entries": [(name, total, 0) for name, total
+                        in store.top(variable, start, end, limit)]
+        } for variable, label in rankings_labels])
+    return ajax_simple_response(dict(
+        status="ok",
+        content=_render_to_string(request, "stats/talkers.html", {
+            "rows": rows
+        })
+    ))
@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+:mod:`cacheutils` --- data kept in memory by each process
+---------------------------------------------------------
+
+Some data (administrative parameters, state of extensions...) is
+loaded once by each process and loaded again when its version changes.
+Versions are stored inside Django's cache, so a modification made by
+one process is seen by all the others.
+
+That only works if the cache backend is shared by all processes. With
+a backend local to each process (``LocMemCache``, the default one), a
+new version can't be seen by other processes: data is then only kept
+until the end of the current request.
+
+"""
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+
+version_timeout = 24 * 3600
+_local = threading.local()
+
+
+def _start_request(**kwargs):
+    _local.request = object()
+
+
+def _finish_request(**kwargs):
+    _local.request = None
+
+request_started.connect(_start_request)
+request_finished.connect(_finish_request)
+
+
+def get_request():
+    """Return a token identifying the current request
+
+    :return: an object, or None outside requests
+    """
+    return getattr(_local, "request", None)
+
+
+def is_shared():
+    """Tell if the cache backend is shared by all processes
+
+    Local memory and dummy backends are considered as local to each
+    process. The ``MODOBOA_SHARED_CACHE`` setting overrides this
+    detection.
+
+    :return: a boolean
+    """
+    shared = getattr(settings, "MODOBOA_SHARED_CACHE", None)
+    if shared is not None:
+        return shared
+    from django.core.cache.backends.locmem import LocMemCache
+    from django.core.cache.backends.dummy import DummyCache
+
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def get_version(key):
+    """Return the current version stored under ``key``
+
+    :param key: the cache key of the version
+    :return: a string
+    """
+    version = cache.get(key)
+    if version is None:
+        version = bump_version(key)
+    return version
+
+
+def bump_version(key):
+    """Change the version stored under ``key``
+
+    :param key: the cache key of the version
+    :return: the new version (a string)
+    """
+    version = "%.6f" % time.time()
+    cache.set(key, version, version_timeout)
+    return version
+
+
+class ProcessCache(object):
+    """Data loaded once and kept in memory by each process
+
+    The version of the data is checked at most once per request and
+    the data is loaded again when it has changed (see ``invalidate``).
+    If the cache backend is not shared, the data is loaded once per
+    request (and on each access outside requests).
+
+    :param key: the cache key of the version
+    :param loader: a function returning the data
+    """
+    def __init__(self, key, loader):
+        self.key = key
+        self.loader = loader
+        self.value = None
+        self.version = None
+        self._local = threading.local()
+
+    def get(self):
+        """Return the data, loaded again if needed"""
+        request = get_request()
+        if not is_shared():
+            if request is None \
+                    or getattr(self._local, "request", None) is not request:
+                self._local.value = self.loader()
+                self._local.request = request
+            return self._local.value
+        if request is not None and self.value is not None \
+                and getattr(self._local, "checked", None) is request:
+            return self.value
+        version = get_version(self.key)
+        if self.value is None or version != self.version:
+            self.value = self.loader()
+            self.version = version
+        self._local.checked = request
+        return self.value
+
+    def invalidate(self):
+        """Must be called each time the data is modified"""
+        self.value = None
+        self._local = threading.local()
+        bump_version(self.key)
@@ -29,6 +29,10 @@ class Page(object):
         self.has_previous = has_previous
         self.has_next = has_next
         self.baseurl = baseurl
+        # Optional keyset pagination: positions of the first and last
+        # items of this page
+        self.previous_cursor = None
+        self.next_cursor = None
 
     def previous_page_number(self):
         if not self.has_previous:
@@ -9,13 +9,26 @@ core application and additional components.
 
 """
 from functools import wraps
-import inspect
 import re
+import sys
+import threading
+import time
 from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
 
 events = []
 callbacks = {}
 
+# Dispatch statistics, recorded when the MODOBOA_EVENTS_PROFILING
+# setting is True. Each process accumulates its own statistics and
+# merges them into the cache at the end of each request, so they can
+# be read by other processes (see get_stats).
+stats_key = "events:stats"
+stats_timeout = 7 * 24 * 3600
+_stats = {}
+_local = threading.local()
+
 
 def declare(nevents):
     """Declare new events
@@ -54,10 +67,15 @@ class observe(object):
     check before each call if the extension is enabled or not. If
     that's not the case, the callback is not called.
 
-    .. note::
+    The state of extensions is cached by ``exts_pool`` so this check
+    doesn't query the database.
 
-        That's not a really optimized behaviour but I haven't found
-        another solution to achieve that feature.
+    Callbacks doing slow work which doesn't need to be finished
+    before the end of the request can be declared with
+    ``async=True``. When the ``MODOBOA_ASYNC_EVENTS`` setting is True,
+    they are stored inside a job queue (see ``defer``) and called
+    later by the ``runjobs`` command. Their answer is always an empty
+    list.
 
     :param evtname: the event's name
     """
@@ -65,6 +83,7 @@ class observe(object):
         self.evtnames = evtnames
         if "extname" in kwargs:
             self.extname = kwargs["extname"]
+        self.async = kwargs.get("async", False)
 
     def __guess_extension_name(self, modname):
         if modname.startswith('modoboa.extensions'):
@@ -74,32 +93,79 @@ class observe(object):
         return None
 
     def __call__(self, f):
-        modname = inspect.getmodule(inspect.stack()[1][0]).__name__
+        modname = sys._getframe(1).f_globals["__name__"]
         extname = self.extname if hasattr(self, "extname") \
             else self.__guess_extension_name(modname)
 
-        @wraps(f)
-        def wrapped_f(*args, **kwargs):
+        def is_enabled():
             if extname:
-                from modoboa.core.models import Extension
                 from modoboa.core.extensions import exts_pool
-                try:
-                    ext = Extension.objects.get(name=extname)
-                except Extension.DoesNotExist:
-                    extdef = exts_pool.get_extension(extname)
-                    if not extdef.always_active:
-                        return []
-                else:
-                    if not ext.enabled:
-                        return []
-            elif not modname in settings.MODOBOA_APPS:
+                return exts_pool.is_enabled(extname)
+            return modname in settings.MODOBOA_APPS
+
+        @wraps(f)
+        def wrapped_f(*args, **kwargs):
+            if not is_enabled():
+                return []
+            if self.async and is_async():
+                defer(wrapped_f, args, kwargs)
                 return []
             return f(*args, **kwargs)
+        # Called by the job queue
+        wrapped_f.original = f
+        wrapped_f.is_enabled = is_enabled
         for evt in self.evtnames:
             register(evt, wrapped_f)
         return wrapped_f
 
 
+def is_async():
+    """Tell if asynchronous callbacks must be deferred
+
+    :return: a boolean
+    """
+    return getattr(settings, "MODOBOA_ASYNC_EVENTS", False)
+
+
+def get_job_key(args):
+    """Return the key used to order the jobs of an object
+
+    The object is the last model instance found inside the arguments
+    of the callback (a domain for ``CreateDomain(user, domain)``).
+
+    :param args: the arguments of the callback
+    :return: a string
+    """
+    from django.db.models import Model
+
+    for arg in reversed(args):
+        if isinstance(arg, Model):
+            return "%s.%s:%s" % (arg._meta.app_label,
+                                 arg._meta.object_name.lower(), arg.pk)
+    return ""
+
+
+def defer(callback, args, kwargs):
+    """Store a call to a callback inside the job queue
+
+    Arguments are pickled, so model instances are passed with their
+    state at the time the event was raised (even if they are deleted
+    in the meantime).
+
+    :param callback: a function decorated by ``observe``
+    :param args: positional arguments
+    :param kwargs: keyword arguments
+    """
+    from .models import EventJob
+
+    job = EventJob(
+        callback="%s.%s" % (callback.__module__, callback.__name__),
+        key=get_job_key(args)
+    )
+    job.set_arguments(args, kwargs)
+    job.save()
+
+
 def unregister(event, callback):
     """Unregister a callback for a specific event
 
@@ -117,6 +183,136 @@ def unregister(event, callback):
         pass
 
 
+def is_profiling():
+    """Tell if the dispatch of events must be profiled
+
+    :return: a boolean
+    """
+    return getattr(settings, "MODOBOA_EVENTS_PROFILING", False)
+
+
+def _record(stats, event, name, duration, queries):
+    """Add a call to statistics
+
+    :param stats: a dictionary ((event, callback name) => statistics)
+    :param name: the callback's name (None for the event itself)
+    :param duration: duration of the call (in seconds)
+    :param queries: number of SQL queries sent during the call
+    """
+    entry = stats.setdefault(
+        (event, name), {"calls": 0, "total": 0, "max": 0, "queries": 0}
+    )
+    entry["calls"] += 1
+    entry["total"] += duration
+    entry["max"] = max(entry["max"], duration)
+    entry["queries"] += queries
+
+
+def _merge(stats, other):
+    for key, entry in other.iteritems():
+        if not key in stats:
+            stats[key] = dict(entry)
+            continue
+        stats[key]["calls"] += entry["calls"]
+        stats[key]["total"] += entry["total"]
+        stats[key]["max"] = max(stats[key]["max"], entry["max"])
+        stats[key]["queries"] += entry["queries"]
+
+
+def _profile(event, name, func):
+    """Call a function and record its duration and SQL queries
+
+    SQL queries are only counted on the default connection. They are
+    logged during the call (even if DEBUG is False) and the log is
+    truncated after the outermost profiled call.
+    """
+    from django.db import connection
+
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    nqueries = len(connection.queries)
+    start = time.time()
+    try:
+        return func()
+    finally:
+        duration = time.time() - start
+        _local.depth = depth
+        _record(_stats, event, name, duration,
+                len(connection.queries) - nqueries)
+        if not depth:
+            connection.use_debug_cursor = debug_cursor
+            if not settings.DEBUG:
+                del connection.queries[nqueries:]
+
+
+def _dispatch(event, call):
+    """Call the callbacks of an event
+
+    :param event: the event's name
+    :param call: a function calling the callback it receives
+    :return: the list of callbacks answers
+    """
+    if not is_profiling():
+        return [call(callback) for callback in callbacks[event].values()]
+    return _profile(event, None, lambda: [
+        _profile(event, name, lambda: call(callback))
+        for name, callback in callbacks[event].items()
+    ])
+
+
+def flush_stats(**kwargs):
+    """Merge the statistics of this process into the cache"""
+    if not _stats:
+        return
+    stats = cache.get(stats_key) or {}
+    _merge(stats, _stats)
+    cache.set(stats_key, stats, stats_timeout)
+    _stats.clear()
+
+request_finished.connect(flush_stats)
+
+
+def get_stats():
+    """Return the statistics of all processes
+
+    :return: a dictionary ((event, callback name) => dictionary with
+             ``calls``, ``total``, ``max`` and ``queries`` keys). The
+             callback name is None for the statistics of the event
+             itself.
+    """
+    flush_stats()
+    return cache.get(stats_key) or {}
+
+
+def group_stats(stats, order="total"):
+    """Group statistics by event
+
+    :param stats: statistics returned by ``get_stats``
+    :param order: the key used to sort events and callbacks
+    :return: a list of (event name, event statistics, list of
+             (callback name, callback statistics)) tuples
+    """
+    result = {}
+    for (event, name), entry in stats.iteritems():
+        item = result.setdefault(event, [event, None, []])
+        if name is None:
+            item[1] = entry
+        else:
+            item[2].append((name, entry))
+    result = [tuple(item) for item in result.values() if item[1] is not None]
+    for item in result:
+        item[2].sort(key=lambda cb: cb[1][order], reverse=True)
+    return sorted(result, key=lambda item: item[1][order], reverse=True)
+
+
+def reset_stats():
+    """Forget the statistics of all processes"""
+    _stats.clear()
+    cache.delete(stats_key)
+
+
 def raiseEvent(event, *args, **kwargs):
     """Raise a specific event
 
@@ -127,8 +323,7 @@ def raiseEvent(event, *args, **kwargs):
     """
     if not event in events or not event in callbacks.keys():
         return 0
-    for callback in callbacks[event].values():
-        callback(*args, **kwargs)
+    _dispatch(event, lambda callback: callback(*args, **kwargs))
     return 1
 
 
@@ -143,8 +338,8 @@ def raiseQueryEvent(event, *args):
     result = []
     if not event in events or not event in callbacks.keys():
         return result
-    for callback in callbacks[event].values():
-        result += callback(*args)
+    for answer in _dispatch(event, lambda callback: callback(*args)):
+        result += answer
     return result
 
 
@@ -160,8 +355,7 @@ def raiseDictEvent(event, *args):
     result = {}
     if not event in events or not event in callbacks.keys():
         return result
-    for callback in callbacks[event].values():
-        tmp = callback(*args)
+    for tmp in _dispatch(event, lambda callback: callback(*args)):
         for k, v in tmp.iteritems():
             result[k] = v
     return result
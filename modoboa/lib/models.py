@@ -1,6 +1,9 @@
+import base64
+import cPickle
 import reversion
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
 
 class Parameter(models.Model):
@@ -25,3 +28,33 @@ class UserParameter(models.Model):
     @property
     def shortname(self):
         return self.name.split(".")[1].lower()
+
+
+class EventJob(models.Model):
+    """A deferred call to an event callback (see ``events.defer``)
+
+    Jobs sharing the same key (they concern the same object) are run
+    in creation order.
+    """
+    callback = models.CharField(max_length=255)
+    arguments = models.TextField()
+    key = models.CharField(max_length=255, db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_try = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.callback
+
+    def set_arguments(self, args, kwargs):
+        self.arguments = base64.b64encode(
+            cPickle.dumps((args, kwargs), cPickle.HIGHEST_PROTOCOL)
+        )
+
+    def get_arguments(self):
+        """Return the arguments of the callback
+
+        :return: a tuple (args, kwargs)
+        """
+        return cPickle.loads(base64.b64decode(self.arguments))
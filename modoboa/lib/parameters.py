@@ -8,13 +8,81 @@ will be available and modifiable directly from the web interface.
 
 Only super users will be able to access this part of the web interface.
 """
-import inspect
 import re
+import sys
+import threading
 from django import forms
+from django.core.signals import request_started, request_finished
 from exceptions import ModoboaException
+from cacheutils import ProcessCache
 
 
 _params = {'A': {}, 'U': {}}
+_app_names = {}
+
+# Administrative parameters are kept by each process (see
+# cacheutils). User parameters are loaded once per request.
+version_key = "parameters:version"
+_local = threading.local()
+
+
+def _start_request(**kwargs):
+    _local.users = {}
+
+
+def _finish_request(**kwargs):
+    _local.users = None
+
+request_started.connect(_start_request)
+request_finished.connect(_finish_request)
+
+
+def _load_admin_values():
+    from .models import Parameter
+
+    return dict(
+        (p.name, p.value.decode("unicode_escape"))
+        for p in Parameter.objects.all()
+    )
+
+_admin_values = ProcessCache(version_key, _load_admin_values)
+
+
+def _get_user_values(user):
+    """Return the values of all the parameters of a user
+
+    Inside a request, values are loaded only once.
+
+    :param ``User`` user: the desired user
+    :return: a dictionary (full name => value)
+    """
+    from .models import UserParameter
+
+    users = getattr(_local, "users", None)
+    if users is not None and user.pk in users:
+        return users[user.pk]
+    values = dict(
+        (p.name, p.value.decode("unicode_escape"))
+        for p in UserParameter.objects.filter(user=user)
+    )
+    if users is not None:
+        users[user.pk] = values
+    return values
+
+
+def _invalidate(p):
+    """Drop cached values after a parameter is modified
+
+    :param p: a ``Parameter`` or ``UserParameter`` instance
+    """
+    from .models import Parameter
+
+    if isinstance(p, Parameter):
+        _admin_values.invalidate()
+        return
+    users = getattr(_local, "users", None)
+    if users is not None:
+        users.pop(p.user_id, None)
 
 
 class NotDefined(ModoboaException):
@@ -61,6 +129,7 @@ class GenericParametersForm(forms.Form):
         else:
             p.value = str(value)
         p.save()
+        _invalidate(p)
 
     def save(self):
         raise NotImplementedError
@@ -185,16 +254,32 @@ def __is_defined(app, level, name):
         raise NotDefined(app, name)
 
 
-def __guess_extension():
-    """Tries to guess the application's name by inspecting the stack
+def get_app_name(modname):
+    """Return the name of the application owning a module
+
+    Results are cached since there is a small number of modules.
 
+    :param modname: a module name
     :return: a string or None
     """
-    modname = inspect.getmodule(inspect.stack()[2][0]).__name__
+    try:
+        return _app_names[modname]
+    except KeyError:
+        pass
     m = re.match("(?:modoboa\.)?(?:extensions\.)?([^\.$]+)", modname)
-    if m:
-        return m.group(1)
-    return None
+    _app_names[modname] = m.group(1) if m else None
+    return _app_names[modname]
+
+
+def __guess_extension():
+    """Tries to guess the application's name from the caller's module
+
+    Only the caller's frame is read (``inspect.stack()`` reads the
+    source of every frame).
+
+    :return: a string or None
+    """
+    return get_app_name(sys._getframe(2).f_globals["__name__"])
 
 
 def save_admin(name, value, app=None):
@@ -240,8 +325,6 @@ def get_admin(name, app=None, raise_error=True):
     :param app: the application owning the parameter
     :return: the corresponding value as a string
     """
-    from .models import Parameter
-
     if app is None:
         app = __guess_extension()
     try:
@@ -250,11 +333,11 @@ def get_admin(name, app=None, raise_error=True):
         if raise_error:
             raise
         return None
-    try:
-        p = Parameter.objects.get(name="%s.%s" % (app, name))
-    except Parameter.DoesNotExist:
+    values = _admin_values.get()
+    fullname = "%s.%s" % (app, name)
+    if not fullname in values:
         return _params["A"][app]["defaults"][name]
-    return p.value.decode("unicode_escape")
+    return values[fullname]
 
 
 def get_user(user, name, app=None, raise_error=True):
@@ -267,8 +350,6 @@ def get_user(user, name, app=None, raise_error=True):
     :param app: the application owning the parameter
     :return: the corresponding value as a string
     """
-    from .models import UserParameter
-
     if app is None:
         app = __guess_extension()
     try:
@@ -277,11 +358,11 @@ def get_user(user, name, app=None, raise_error=True):
         if raise_error:
             raise
         return None
-    try:
-        p = UserParameter.objects.get(user=user, name="%s.%s" % (app, name))
-    except UserParameter.DoesNotExist:
+    values = _get_user_values(user)
+    fullname = "%s.%s" % (app, name)
+    if not fullname in values:
         return _params["U"][app]["defaults"][name]
-    return p.value.decode("unicode_escape")
+    return values[fullname]
 
 
 def get_sorted_apps(level, first="core"):
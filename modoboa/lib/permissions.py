@@ -1,11 +1,14 @@
 # coding: utf-8
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from modoboa.core.models import ObjectAccess
+from cacheutils import ProcessCache
 import events
 from exceptions import ModoboaException
 
+superusers_version_key = "permissions:superusers_version"
+
 
 def get_account_roles(user):
     """Return the list of supported account roles
@@ -24,6 +27,63 @@ def get_account_roles(user):
     return sorted(std_roles, key=lambda role: role[1])
 
 
+def _load_superuser_ids():
+    from modoboa.core.models import User
+
+    return list(
+        User.objects.filter(is_superuser=True).values_list("id", flat=True)
+    )
+
+_superuser_ids = ProcessCache(superusers_version_key, _load_superuser_ids)
+
+
+def get_superuser_ids():
+    """Return the ids of super administrators
+
+    The list is kept in memory by each process (see
+    ``cacheutils.ProcessCache``) and invalidated each time an account
+    gains or loses the super administrator role.
+
+    :return: a list of integers
+    """
+    return _superuser_ids.get()
+
+
+def invalidate_superuser_ids():
+    """Forget the list of super administrators kept by all processes"""
+    _superuser_ids.invalidate()
+
+
+def _create_accesses(accesses):
+    """Create several ``ObjectAccess`` entries at once
+
+    Entries must not exist. If one was created by another process in
+    the meantime, the others are created one by one. Each insertion
+    runs inside a savepoint, so a failure doesn't abort the current
+    transaction (PostgreSQL).
+
+    :param accesses: a list of ``ObjectAccess`` objects
+    """
+    if not accesses:
+        return
+    sid = transaction.savepoint()
+    try:
+        ObjectAccess.objects.bulk_create(accesses)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+    else:
+        transaction.savepoint_commit(sid)
+        return
+    for access in accesses:
+        sid = transaction.savepoint()
+        try:
+            access.save()
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+
+
 def grant_access_to_object(user, obj, is_owner=False):
     """Grant access to an object for a given user
 
@@ -41,47 +101,77 @@ def grant_access_to_object(user, obj, is_owner=False):
     :param is_owner: the user is the unique object's owner
     """
     ct = ContentType.objects.get_for_model(obj)
-    try:
-        entry = user.objectaccess_set.get(content_type=ct, object_id=obj.id)
-        entry.is_owner = is_owner
-        entry.save()
-    except ObjectAccess.DoesNotExist:
-        pass
-    else:
+    user_ids = [user.id]
+    if is_owner:
+        user_ids += [uid for uid in get_superuser_ids() if uid != user.id]
+    existing = dict(
+        ObjectAccess.objects.filter(
+            content_type=ct, object_id=obj.id, user__in=user_ids
+        ).values_list("user_id", "is_owner")
+    )
+    if user.id in existing:
+        if existing[user.id] != is_owner:
+            ObjectAccess.objects.filter(
+                user=user, content_type=ct, object_id=obj.id
+            ).update(is_owner=is_owner)
         return
-
     try:
-        ObjectAccess.objects.create(user=user, content_type=ct, 
+        ObjectAccess.objects.create(user=user, content_type=ct,
                                     object_id=obj.id, is_owner=is_owner)
-        if is_owner:
-            from modoboa.core.models import User
-            for su in User.objects.filter(is_superuser=True):
-                if su == user:
-                    continue
-                try:
-                    ObjectAccess.objects.create(user=su, content_type=ct, object_id=obj.id)
-                except IntegrityError:
-                    pass
-
     except IntegrityError, e:
         raise ModoboaException(_("Failed to grant access (%s)" % str(e)))
+    _create_accesses([
+        ObjectAccess(user_id=uid, content_type=ct, object_id=obj.id)
+        for uid in user_ids[1:] if not uid in existing
+    ])
+
+
+def grant_access_to_users(users, obj):
+    """Grant access to an object for several users at once
+
+    Users already allowed to access the object are ignored.
+
+    :param users: a list of ``User`` objects
+    :param obj: an admin. object (Domain, Mailbox, ...)
+    """
+    ct = ContentType.objects.get_for_model(obj)
+    user_ids = set(user.id for user in users)
+    if not user_ids:
+        return
+    existing = set(
+        ObjectAccess.objects.filter(
+            content_type=ct, object_id=obj.id, user__in=user_ids
+        ).values_list("user_id", flat=True)
+    )
+    _create_accesses([
+        ObjectAccess(user_id=uid, content_type=ct, object_id=obj.id)
+        for uid in user_ids if not uid in existing
+    ])
 
 
 def grant_access_to_objects(user, objects, ct):
     """Grant access to a collection of objects
 
     All objects in the collection must share the same type (ie. ``ct``
-    applies to all objects).
+    applies to all objects). Objects the user can already access are
+    ignored.
 
     :param user: a ``User`` object
-    :param objects: a list of objects
+    :param objects: a list of objects (or a ``QuerySet``)
     :param ct: the content type
     """
-    for obj in objects:
-        try:
-            ObjectAccess.objects.create(user=user, content_type=ct, object_id=obj.id)
-        except IntegrityError:
-            pass
+    if hasattr(objects, "values_list"):
+        object_ids = objects.values_list("id", flat=True)
+    else:
+        object_ids = [obj.id for obj in objects]
+    existing = set(
+        ObjectAccess.objects.filter(user=user, content_type=ct)
+        .values_list("object_id", flat=True)
+    )
+    _create_accesses([
+        ObjectAccess(user=user, content_type=ct, object_id=oid)
+        for oid in object_ids if not oid in existing
+    ])
 
 
 def ungrant_access_to_object(obj, user=None):
@@ -4,11 +4,22 @@ from django.test.client import Client
 from django.utils import simplejson
 from django import forms
 from django.core.urlresolvers import reverse
-from modoboa.lib import parameters
+from django.test.utils import override_settings
+from modoboa.lib import parameters, events, cacheutils
 
 
 class ModoTestCase(TestCase):
 
+    def _pre_setup(self):
+        from modoboa.core.extensions import exts_pool
+        from modoboa.lib.permissions import invalidate_superuser_ids
+
+        super(ModoTestCase, self)._pre_setup()
+        # Cached values may come from rolled back transactions
+        exts_pool.invalidate()
+        parameters._admin_values.invalidate()
+        invalidate_superuser_ids()
+
     def setUp(self, username="admin", password="password"):
         self.clt = Client()
         self.assertEqual(self.clt.login(username=username, password=password), True)
@@ -68,6 +79,8 @@ class ParameterTestCase(TestCase):
         parameters.register(TestParams, "Test")
         parameters.register(TestUserParams, "TestUser")
         self.user = User.objects.create(username="tester")
+        # Values cached by previous tests were rolled back
+        parameters._admin_values.invalidate()
 
     def test_register_form(self):
         self.assertIn("test", parameters._params['A'])
@@ -100,3 +113,219 @@ class ParameterTestCase(TestCase):
     def test_save_user(self):
         parameters.save_user(self.user, "PARAM1", "pouet", "test")
         self.assertEqual(parameters.get_user(self.user, "PARAM1", "test"), "pouet")
+
+    @override_settings(MODOBOA_SHARED_CACHE=True)
+    def test_admin_cache(self):
+        from django.core.cache import cache
+
+        parameters.save_admin("PARAM1", "45", app="test")
+        with self.assertNumQueries(1):
+            parameters.get_admin("PARAM1", app="test")
+            parameters.get_admin("PARAM2", app="test")
+        # Another process modified a parameter
+        cache.set(parameters.version_key, "other")
+        with self.assertNumQueries(1):
+            self.assertEqual(parameters.get_admin("PARAM1", app="test"), "45")
+
+    def test_admin_cache_local_backend(self):
+        self.assertFalse(cacheutils.is_shared())
+        parameters.save_admin("PARAM1", "45", app="test")
+        for i in range(2):
+            # Other processes can't notify modifications: values are
+            # loaded again by each request
+            cacheutils._start_request()
+            try:
+                with self.assertNumQueries(1):
+                    parameters.get_admin("PARAM1", app="test")
+                    parameters.get_admin("PARAM2", app="test")
+            finally:
+                cacheutils._finish_request()
+
+    def test_user_cache(self):
+        parameters.save_user(self.user, "PARAM1", "pouet", "test")
+        parameters._start_request()
+        try:
+            with self.assertNumQueries(1):
+                parameters.get_user(self.user, "PARAM1", "test")
+                parameters.get_user(self.user, "PARAM2", "test")
+            parameters.save_user(self.user, "PARAM1", "toto", "test")
+            self.assertEqual(
+                parameters.get_user(self.user, "PARAM1", "test"), "toto"
+            )
+        finally:
+            parameters._finish_request()
+
+
+def count_users(user):
+    from modoboa.core.models import User
+    return [User.objects.count()]
+
+
+def do_nothing(user):
+    return []
+
+
+@override_settings(MODOBOA_EVENTS_PROFILING=True)
+class EventsProfilingTestCase(TestCase):
+
+    def setUp(self):
+        events.declare(["TestEvent"])
+        events.register("TestEvent", count_users)
+        events.register("TestEvent", do_nothing)
+        events.reset_stats()
+
+    def tearDown(self):
+        events.unregister("TestEvent", count_users)
+        events.unregister("TestEvent", do_nothing)
+        events.reset_stats()
+
+    def test_stats(self):
+        for i in range(3):
+            self.assertEqual(events.raiseQueryEvent("TestEvent", None), [0])
+        stats = events.get_stats()
+        self.assertEqual(stats[("TestEvent", None)]["calls"], 3)
+        self.assertEqual(stats[("TestEvent", None)]["queries"], 3)
+        entry = stats[("TestEvent", "modoboa.lib.tests.count_users")]
+        self.assertEqual(entry["calls"], 3)
+        self.assertEqual(entry["queries"], 3)
+        self.assertTrue(entry["max"] <= entry["total"])
+        entry = stats[("TestEvent", "modoboa.lib.tests.do_nothing")]
+        self.assertEqual(entry["queries"], 0)
+
+        grouped = events.group_stats(stats, "queries")
+        self.assertEqual(grouped[0][0], "TestEvent")
+        self.assertEqual(grouped[0][2][0][0], "modoboa.lib.tests.count_users")
+
+    def test_command(self):
+        import sys
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        events.raiseQueryEvent("TestEvent", None)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command("eventstats", sort="calls")
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn("TestEvent", output)
+        self.assertIn("  modoboa.lib.tests.count_users", output)
+        call_command("eventstats", reset=True)
+        self.assertEqual(events.get_stats(), {})
+
+    def test_disabled(self):
+        with self.settings(MODOBOA_EVENTS_PROFILING=False):
+            events.raiseQueryEvent("TestEvent", None)
+        self.assertEqual(events.get_stats(), {})
+
+
+calls = []
+
+
+def record(value, obj=None):
+    calls.append(value)
+    return [value]
+
+
+def fail(value, obj=None):
+    raise RuntimeError(value)
+
+
+@override_settings(MODOBOA_ASYNC_EVENTS=True)
+class EventJobsTestCase(TestCase):
+
+    def setUp(self):
+        from modoboa.core.models import User, Extension
+
+        Extension.objects.create(name="postfix_autoreply", enabled=True)
+        events.declare(["TestAsyncEvent"])
+        self.callback = events.observe(
+            "TestAsyncEvent", async=True, extname="postfix_autoreply"
+        )(record)
+        self.user1 = User.objects.create(username="user1")
+        self.user2 = User.objects.create(username="user2")
+        del calls[:]
+
+    def tearDown(self):
+        events.unregister("TestAsyncEvent", record)
+
+    def test_job_key(self):
+        self.assertEqual(events.get_job_key((None, self.user1, 1)),
+                         "core.user:%d" % self.user1.pk)
+        self.assertEqual(events.get_job_key((1, "test")), "")
+
+    def test_defer(self):
+        from modoboa.core.management.commands.runjobs import Command
+        from .models import EventJob
+
+        self.assertEqual(
+            events.raiseQueryEvent("TestAsyncEvent", 1, self.user1), []
+        )
+        self.assertEqual(calls, [])
+        job = EventJob.objects.get()
+        self.assertEqual(job.callback, "modoboa.lib.tests.record")
+        self.assertEqual(job.key, "core.user:%d" % self.user1.pk)
+
+        self.assertEqual(Command().run_jobs(), (1, 0))
+        self.assertEqual(calls, [1])
+        self.assertEqual(EventJob.objects.count(), 0)
+
+        with self.settings(MODOBOA_ASYNC_EVENTS=False):
+            self.assertEqual(
+                events.raiseQueryEvent("TestAsyncEvent", 2, self.user1), [2]
+            )
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(EventJob.objects.count(), 0)
+
+    def test_ordering(self):
+        from django.utils import timezone
+        from modoboa.core.management.commands.runjobs import Command
+        from .models import EventJob
+
+        events.defer(fail, (1, self.user1), {})
+        events.defer(record, (2, self.user1), {})
+        events.defer(record, (3, self.user2), {})
+        cmd = Command()
+        self.assertEqual(cmd.run_jobs(), (1, 1))
+        self.assertEqual(calls, [3])
+        job = EventJob.objects.order_by("id")[0]
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("RuntimeError", job.last_error)
+        self.assertTrue(job.next_try > timezone.now())
+
+        # The failed job waits for its retry and blocks the next one
+        self.assertEqual(cmd.run_jobs(), (0, 0))
+
+        EventJob.objects.filter(pk=job.pk).update(
+            callback="modoboa.lib.tests.record", next_try=timezone.now()
+        )
+        self.assertEqual(cmd.run_jobs(), (2, 0))
+        self.assertEqual(calls, [3, 1, 2])
+
+    def test_disabled_extension(self):
+        from modoboa.core.extensions import exts_pool
+        from modoboa.core.models import Extension
+        from modoboa.core.management.commands.runjobs import Command
+        from .models import EventJob
+
+        events.raiseQueryEvent("TestAsyncEvent", 1, self.user1)
+        Extension.objects.filter(name="postfix_autoreply") \
+            .update(enabled=False)
+        exts_pool.invalidate()
+        # The job queue finds the decorated callback by its name
+        globals()["record"] = self.callback
+        try:
+            self.assertEqual(Command().run_jobs(), (1, 0))
+        finally:
+            globals()["record"] = self.callback.original
+        self.assertEqual(calls, [])
+        self.assertEqual(EventJob.objects.count(), 0)
+
+    def test_given_up(self):
+        from modoboa.core.management.commands.runjobs import Command
+        from .models import EventJob
+
+        events.defer(fail, (1, self.user1), {})
+        EventJob.objects.update(attempts=5)
+        self.assertEqual(Command().run_jobs(max_attempts=5), (0, 0))
+        self.assertEqual(EventJob.objects.count(), 1)
@@ -0,0 +1,157 @@
+# coding: utf-8
+"""
+Benchmark of administrative listings.
+
+Mailboxes and accounts are generated inside the test database of a
+Modoboa instance, then listed for a super administrator and for a
+domain administrator with the previous queries (``IN`` subqueries
+over ``ObjectAccess``) and the current ones (joins). Usage::
+
+  $ cd <modoboa_site>
+  $ PYTHONPATH=. DJANGO_SETTINGS_MODULE=<modoboa_site>.settings \\
+      python <path to>/tests/bench_admin_listing.py --mailboxes 100000
+
+A test database is created, existing data is not modified.
+
+"""
+import time
+from optparse import OptionParser
+
+
+def generate(nbmailboxes, nbdomains):
+    """Create domains, accounts and mailboxes
+
+    The super administrator can access everything, the domain
+    administrator can access the first domain.
+
+    :return: a tuple (super administrator, domain administrator)
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from modoboa.core.models import User, ObjectAccess
+    from modoboa.extensions.admin.models import Domain, Mailbox
+    from modoboa.extensions.admin.models.base import ObjectDates
+
+    dates = ObjectDates.objects.create()
+    sadmin = User.objects.create(username="admin", is_superuser=True)
+    dadmin = User.objects.create(username="dadmin")
+    Domain.objects.bulk_create([
+        Domain(name="domain%d.com" % idx, quota=0, enabled=True,
+               dates=dates)
+        for idx in range(nbdomains)
+    ])
+    domains = list(Domain.objects.order_by("id"))
+    User.objects.bulk_create([
+        User(username="user%d@%s" % (idx, domains[idx % nbdomains].name))
+        for idx in range(nbmailboxes)
+    ])
+    users = list(User.objects.exclude(pk__in=[sadmin.pk, dadmin.pk])
+                 .order_by("id").values_list("id", flat=True))
+    Mailbox.objects.bulk_create([
+        Mailbox(address="user%d" % idx, quota=0, user_id=uid,
+                domain=domains[idx % nbdomains], dates=dates)
+        for idx, uid in enumerate(users)
+    ])
+    mailboxes = list(Mailbox.objects.order_by("id")
+                     .values_list("id", "user_id", "domain_id"))
+
+    accesses = []
+    for ct, ids in [(ContentType.objects.get_for_model(Domain),
+                     [d.id for d in domains]),
+                    (ContentType.objects.get_for_model(User), users),
+                    (ContentType.objects.get_for_model(Mailbox),
+                     [mb[0] for mb in mailboxes])]:
+        accesses += [ObjectAccess(user=sadmin, content_type=ct, object_id=oid,
+                                  is_owner=True) for oid in ids]
+    mbct = ContentType.objects.get_for_model(Mailbox)
+    uct = ContentType.objects.get_for_model(User)
+    accesses.append(ObjectAccess(
+        user=dadmin, content_type=ContentType.objects.get_for_model(Domain),
+        object_id=domains[0].id
+    ))
+    for mbid, uid, domid in mailboxes:
+        if domid != domains[0].id:
+            continue
+        accesses += [
+            ObjectAccess(user=dadmin, content_type=mbct, object_id=mbid),
+            ObjectAccess(user=dadmin, content_type=uct, object_id=uid)
+        ]
+    for pos in range(0, len(accesses), 10000):
+        ObjectAccess.objects.bulk_create(accesses[pos:pos + 10000])
+    return sadmin, dadmin
+
+
+def legacy_mailboxes(admin):
+    """The previous implementation of Mailbox.objects.get_for_admin"""
+    from django.contrib.contenttypes.models import ContentType
+    from modoboa.extensions.admin.models import Mailbox
+
+    ids = admin.objectaccess_set \
+        .filter(content_type=ContentType.objects.get_for_model(Mailbox)) \
+        .values_list('object_id', flat=True)
+    return Mailbox.objects.filter(pk__in=ids)
+
+
+def legacy_accounts(admin):
+    """The accounts part of the previous get_identities"""
+    from django.contrib.contenttypes.models import ContentType
+    from modoboa.core.models import User
+
+    ids = admin.objectaccess_set \
+        .filter(content_type=ContentType.objects.get_for_model(admin)) \
+        .values_list('object_id', flat=True)
+    return User.objects.select_related().filter(pk__in=ids)
+
+
+def current_accounts(admin):
+    """The accounts part of the current get_identities"""
+    from django.db.models import Q
+    from modoboa.core.models import User
+
+    q = Q() if admin.is_superuser else Q(owners__user=admin)
+    return User.objects.select_related().filter(q)
+
+
+def measure(name, qs, page_size=30):
+    """Count the results and fetch the first page"""
+    start = time.time()
+    count = qs.count()
+    list(qs.order_by("-id")[:page_size])
+    print "%-34s %8.3fs  %d results" % (name, time.time() - start, count)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--mailboxes", type="int", default=100000,
+                      help="Number of generated mailboxes (default: 100000)")
+    parser.add_option("--domains", type="int", default=100,
+                      help="Number of generated domains (default: 100)")
+    options, args = parser.parse_args()
+
+    # Settings must be loaded before django.db is imported
+    from django.conf import settings
+    settings.INSTALLED_APPS
+    from django.db import transaction
+    from django.test.simple import DjangoTestSuiteRunner
+    from modoboa.extensions.admin.models import Mailbox
+
+    runner = DjangoTestSuiteRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        start = time.time()
+        sadmin, dadmin = generate(options.mailboxes, options.domains)
+        transaction.commit_unless_managed()
+        print "%-34s %8.2fs" % ("generate", time.time() - start)
+
+        for label, admin in [("super admin", sadmin),
+                             ("domain admin", dadmin)]:
+            measure("mailboxes, legacy (%s)" % label, legacy_mailboxes(admin))
+            measure("mailboxes, current (%s)" % label,
+                    Mailbox.objects.get_for_admin(admin))
+            measure("accounts, legacy (%s)" % label, legacy_accounts(admin))
+            measure("accounts, current (%s)" % label, current_accounts(admin))
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == "__main__":
+    main()
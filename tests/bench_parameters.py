@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Micro-benchmark of parameters lookups.
+
+Measures the cost of guessing the application owning a parameter
+(when ``app`` is not given) with the previous implementation
+(``inspect.stack()``) and the current one, then the cost of a whole
+``get_admin`` call. Usage::
+
+  $ cd <modoboa_site>
+  $ PYTHONPATH=. DJANGO_SETTINGS_MODULE=<modoboa_site>.settings \\
+      python <path to>/tests/bench_parameters.py --calls 10000
+
+A test database is created, existing data is not modified.
+
+"""
+import inspect
+import re
+import timeit
+from optparse import OptionParser
+
+
+def legacy_guess_extension():
+    """The previous implementation of parameters.__guess_extension"""
+    modname = inspect.getmodule(inspect.stack()[2][0]).__name__
+    m = re.match("(?:modoboa\.)?(?:extensions\.)?([^\.$]+)", modname)
+    if m:
+        return m.group(1)
+    return None
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--calls", type="int", default=10000,
+                      help="Number of calls per measure (default: 10000)")
+    options, args = parser.parse_args()
+
+    # Settings must be loaded before django.db is imported
+    from django.conf import settings
+    settings.INSTALLED_APPS
+    from django.test.simple import DjangoTestSuiteRunner
+    from modoboa.core import load_settings
+    from modoboa.lib import parameters
+
+    runner = DjangoTestSuiteRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        load_settings()
+        guess = parameters.__guess_extension
+
+        # Both functions are called like from get_admin (the owning
+        # module is the caller of the caller)
+        def legacy():
+            return legacy_guess_extension()
+
+        def current():
+            return guess()
+
+        calls = [
+            ("legacy guess", lambda: legacy()),
+            ("guess", lambda: current()),
+            ("get_admin", lambda: parameters.get_admin(
+                "AUTHENTICATION_TYPE", app="core")),
+        ]
+        for name, func in calls:
+            func()
+            duration = timeit.timeit(func, number=options.calls)
+            print "%-14s %10.2fus/call" % (
+                name, duration * 1000000 / options.calls
+            )
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == "__main__":
+    main()
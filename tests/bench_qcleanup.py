@@ -0,0 +1,131 @@
+# coding: utf-8
+"""
+Benchmark of the quarantine cleanup (qcleanup command).
+
+A quarantine is generated inside the test database of a Modoboa
+instance, then cleaned up. Usage::
+
+  $ cd <modoboa_site>
+  $ PYTHONPATH=. DJANGO_SETTINGS_MODULE=<modoboa_site>.settings \\
+      python <path to>/tests/bench_qcleanup.py --messages 100000 --legacy
+
+The instance must enable the amavis extension and define an ``amavis``
+database (a test database is created, existing data is not modified).
+``--legacy`` also measures the previous implementation (one query per
+message and per address), which is slow on big datasets.
+
+"""
+import random
+import time
+from optparse import OptionParser
+
+
+def generate(cursor, nbmessages, nbaddresses, flags, tmin, tmax):
+    """Fill the amavis tables
+
+    Each message has two recipients; one out of ten has its
+    recipients marked with one of ``flags``.
+    """
+    from modoboa.extensions.amavis.tests import amavis_schema
+
+    for table in ["quarantine", "msgrcpt", "msgs", "maddr"]:
+        cursor.execute("DROP TABLE IF EXISTS %s" % table)
+    for statement in amavis_schema:
+        cursor.execute(statement)
+    cursor.executemany(
+        "INSERT INTO maddr (id, email, domain) VALUES (%s, %s, 'com.test')",
+        [(idx, "user%d@test.com" % idx) for idx in range(1, nbaddresses + 1)]
+    )
+    msgs, rcpts, contents = [], [], []
+    for idx in range(nbmessages):
+        mail_id = "m%010d" % idx
+        msgs.append((mail_id, random.randint(tmin, tmax),
+                     random.randint(1, nbaddresses)))
+        rs = random.choice(flags) if idx % 10 == 0 else ""
+        for rid in random.sample(range(1, nbaddresses + 1), 2):
+            rcpts.append((mail_id, rid, rs))
+        contents.append((mail_id, ))
+    cursor.executemany(
+        "INSERT INTO msgs (mail_id, am_id, time_num, time_iso, sid, size, "
+        "host) VALUES (%s, '', %s, '', %s, 100, 'localhost')", msgs
+    )
+    cursor.executemany(
+        "INSERT INTO msgrcpt (mail_id, rid, ds, rs) VALUES (%s, %s, 'D', %s)",
+        rcpts
+    )
+    cursor.executemany(
+        "INSERT INTO quarantine (mail_id, chunk_ind, mail_text) "
+        "VALUES (%s, 1, 'content')", contents
+    )
+
+
+def legacy_cleanup(flags, limit):
+    """The previous implementation of qcleanup"""
+    from modoboa.extensions.amavis.models import Msgrcpt, Msgs, Maddr
+
+    ids = Msgrcpt.objects.filter(rs__in=flags).values("mail_id")
+    for msg in Msgs.objects.filter(mail_id__in=ids):
+        if not msg.msgrcpt_set.exclude(rs__in=flags).count():
+            msg.delete()
+    Msgs.objects.filter(time_num__lt=limit).delete()
+    for maddr in Maddr.objects.all():
+        if not maddr.msgs_set.count() and not maddr.msgrcpt_set.count():
+            maddr.delete()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--messages", type="int", default=10000,
+                      help="Number of generated messages (default: 10000)")
+    parser.add_option("--addresses", type="int", default=2000,
+                      help="Number of generated addresses (default: 2000)")
+    parser.add_option("--days", type="int", default=30,
+                      help="Age of the oldest message (default: 30)")
+    parser.add_option("--legacy", action="store_true", default=False,
+                      help="Also measure the previous implementation")
+    options, args = parser.parse_args()
+
+    # Settings must be loaded before django.db is imported
+    from django.conf import settings
+    settings.INSTALLED_APPS
+    from django.db import connections, transaction
+    from django.test.simple import DjangoTestSuiteRunner
+    from modoboa.extensions.amavis.management.commands.qcleanup import Command
+
+    runner = DjangoTestSuiteRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        now = int(time.time())
+        tmin = now - options.days * 24 * 3600
+        limit = now - options.days * 24 * 3600 / 2
+        flags = ["D", "R"]
+        implementations = [
+            ("qcleanup", lambda: Command().cleanup(flags, limit, 24 * 3600))
+        ]
+        if options.legacy:
+            implementations.append(
+                ("legacy", lambda: legacy_cleanup(flags, limit))
+            )
+        for name, func in implementations:
+            random.seed(0)
+            cursor = connections["amavis"].cursor()
+            generate(cursor, options.messages, options.addresses, flags,
+                     tmin, now)
+            transaction.commit_unless_managed(using="amavis")
+            start = time.time()
+            func()
+            transaction.commit_unless_managed(using="amavis")
+            duration = time.time() - start
+            counts = []
+            for table in ["msgs", "msgrcpt", "quarantine", "maddr"]:
+                cursor.execute("SELECT COUNT(*) FROM %s" % table)
+                counts.append("%s=%d" % (table, cursor.fetchone()[0]))
+            print "%-10s %8.2fs  remaining: %s" % (
+                name, duration, " ".join(counts)
+            )
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# coding: utf-8
+"""
+Benchmark of the quarantine search.
+
+A quarantine is generated inside the test database of a Modoboa
+instance, indexed with the ``qindex`` command, then searched with
+both the ``LIKE`` filters and the search index. Usage::
+
+  $ cd <modoboa_site>
+  $ PYTHONPATH=. DJANGO_SETTINGS_MODULE=<modoboa_site>.settings \\
+      python <path to>/tests/bench_qsearch.py --messages 1000000
+
+The instance must enable the amavis extension and define an ``amavis``
+database (a test database is created, existing data is not modified).
+
+"""
+import random
+import time
+from optparse import OptionParser
+
+words = [
+    "invoice", "meeting", "report", "offer", "cheap", "watches", "urgent",
+    "account", "password", "delivery", "failure", "newsletter", "weekly",
+    "pharmacy", "discount", "winner", "lottery", "project", "budget", "review"
+]
+
+
+def generate(cursor, nbmessages, nbaddresses):
+    """Fill the amavis tables
+
+    Each message has two recipients and a subject made of three
+    random words.
+    """
+    from modoboa.extensions.amavis.tests import amavis_schema
+    from modoboa.extensions.amavis.search import schema
+
+    for table in ["msgterm", "quarantine", "msgrcpt", "msgs", "maddr"]:
+        cursor.execute("DROP TABLE IF EXISTS %s" % table)
+    for statement in amavis_schema + schema:
+        cursor.execute(statement)
+    cursor.executemany(
+        "INSERT INTO maddr (id, email, domain) VALUES (%s, %s, 'com.test')",
+        [(idx, "user%d@test.com" % idx) for idx in range(1, nbaddresses + 1)]
+    )
+    now = int(time.time())
+    for pos in range(0, nbmessages, 10000):
+        msgs, rcpts, contents = [], [], []
+        for idx in range(pos, min(pos + 10000, nbmessages)):
+            mail_id = "m%010d" % idx
+            sid = random.randint(1, nbaddresses)
+            msgs.append((mail_id, now - idx, sid, "user%d@test.com" % sid,
+                         " ".join(random.sample(words, 3))))
+            for rid in random.sample(range(1, nbaddresses + 1), 2):
+                rcpts.append((mail_id, rid))
+            contents.append((mail_id, ))
+        cursor.executemany(
+            "INSERT INTO msgs (mail_id, am_id, time_num, time_iso, sid, size, "
+            "content, from_addr, subject, host) "
+            "VALUES (%s, '', %s, '', %s, 100, 'S', %s, %s, 'localhost')", msgs
+        )
+        cursor.executemany(
+            "INSERT INTO msgrcpt (mail_id, rid, ds, rs) VALUES (%s, %s, 'D', '')",
+            rcpts
+        )
+        cursor.executemany(
+            "INSERT INTO quarantine (mail_id, chunk_ind, mail_text) "
+            "VALUES (%s, 1, 'content')", contents
+        )
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--messages", type="int", default=100000,
+                      help="Number of generated messages (default: 100000)")
+    parser.add_option("--addresses", type="int", default=5000,
+                      help="Number of generated addresses (default: 5000)")
+    parser.add_option("--pattern", type="string", default="user42@test.com",
+                      help="Searched pattern (default: user42@test.com)")
+    options, args = parser.parse_args()
+
+    # Settings must be loaded before django.db is imported
+    from django.conf import settings
+    settings.INSTALLED_APPS
+    from django.db import connections, transaction
+    from django.db.models import Q
+    from django.test.simple import DjangoTestSuiteRunner
+    from modoboa.extensions.amavis.search import Indexer, get_search_filter
+    from modoboa.extensions.amavis.sql_listing import SQLconnector
+
+    runner = DjangoTestSuiteRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        random.seed(0)
+        cursor = connections["amavis"].cursor()
+        start = time.time()
+        generate(cursor, options.messages, options.addresses)
+        transaction.commit_unless_managed(using="amavis")
+        print "%-10s %8.2fs" % ("generate", time.time() - start)
+
+        start = time.time()
+        Indexer(batch=5000).run()
+        print "%-10s %8.2fs" % ("qindex", time.time() - start)
+
+        pattern = options.pattern
+        filters = [
+            ("like", Q(mail__from_addr__contains=pattern)
+             | Q(mail__subject__contains=pattern)),
+            ("index", get_search_filter(pattern, ["from_addr", "subject"]))
+        ]
+        for name, flt in filters:
+            start = time.time()
+            connector = SQLconnector(filter=flt)
+            count = connector.messages_count(order="-date")
+            if count:
+                connector.fetch(1, min(count, 40))
+            print "%-10s %8.2fs  %d results" % (
+                name, time.time() - start, count
+            )
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == "__main__":
+    main()